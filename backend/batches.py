@@ -0,0 +1,416 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import time
+import uuid
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, IO, List, Optional, Set, Tuple
+
+# 处理一行请求：输入 (batch_id, 请求体)，返回 Ollama 响应；失败时抛出 BatchLineError
+LineProcessor = Callable[[str, Dict[str, Any]], Awaitable[Dict[str, Any]]]
+
+FINAL_STATUSES = {"completed", "cancelled", "failed"}
+
+
+class BatchNotFound(KeyError):
+    pass
+
+
+class BatchTooLarge(ValueError):
+    pass
+
+
+class BatchLineError(Exception):
+    def __init__(self, status_code: int, detail: Any) -> None:
+        super().__init__(str(detail))
+        self.status_code = status_code
+        self.detail = detail
+
+
+def _atomic_write_json(path: str, data: Dict[str, Any]) -> None:
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _count_lines(path: str) -> int:
+    with open(path, "rb") as f:
+        return sum(1 for line in f if line.strip())
+
+
+def _read_lines(
+    path: str, offset: int, index: int, limit: int
+) -> Tuple[List[Tuple[int, bytes]], int, int]:
+    """从字节偏移 offset 起读取至多 limit 个非空行，返回 (行列表, 新偏移, 新行号)。"""
+    lines: List[Tuple[int, bytes]] = []
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while len(lines) < limit:
+            raw = f.readline()
+            if not raw:
+                break
+            if raw.strip():
+                lines.append((index, raw))
+                index += 1
+        return lines, f.tell(), index
+
+
+def _load_finished(path: str) -> Tuple[Set[int], int]:
+    """读取已写出的结果行号；进程崩溃留下的半行会被截掉，保证后续追加的是完整 JSONL。"""
+    done: Set[int] = set()
+    failed = 0
+    if not os.path.exists(path):
+        return done, failed
+    with open(path, "rb+") as f:
+        valid_end = 0
+        for raw in iter(f.readline, b""):
+            if not raw.endswith(b"\n"):
+                break
+            valid_end += len(raw)
+            try:
+                record = json.loads(raw)
+            except ValueError:
+                continue
+            if not isinstance(record, dict) or record.get("line") is None:
+                continue
+            done.add(record["line"])
+            if record.get("error") is not None:
+                failed += 1
+        f.truncate(valid_end)
+    return done, failed
+
+
+class Batch:
+    def __init__(self, directory: str, meta: Dict[str, Any]) -> None:
+        self.directory = directory
+        self.meta = meta
+        self._last_persist = 0.0
+
+    @property
+    def id(self) -> str:
+        return self.meta["id"]
+
+    @property
+    def input_path(self) -> str:
+        return os.path.join(self.directory, "input.jsonl")
+
+    @property
+    def output_path(self) -> str:
+        return os.path.join(self.directory, "output.jsonl")
+
+    @property
+    def meta_path(self) -> str:
+        return os.path.join(self.directory, "meta.json")
+
+    async def persist(self, force: bool = True) -> None:
+        # 进度频繁变化，非强制写入时最多每秒落盘一次；恢复时以 output.jsonl 为准
+        now = time.monotonic()
+        if not force and now - self._last_persist < 1.0:
+            return
+        self._last_persist = now
+        await asyncio.to_thread(_atomic_write_json, self.meta_path, dict(self.meta))
+
+    def snapshot(self) -> Dict[str, Any]:
+        meta = dict(self.meta)
+        done = meta["completed"] + meta["failed"]
+        started = meta.get("started_at")
+        if started and meta["status"] == "running" and meta.get("processed_this_run"):
+            rate = meta["processed_this_run"] / max(1e-6, time.time() - started)
+            meta["lines_per_s"] = round(rate, 2)
+            if meta.get("total") is not None and rate > 0:
+                meta["eta_s"] = round((meta["total"] - done) / rate, 1)
+        if meta.get("total"):
+            meta["progress"] = round(done / meta["total"], 4)
+        return meta
+
+
+class BatchManager:
+    """
+    离线批处理：上传的 JSONL 按行写入 batch_dir/<id>/input.jsonl，后台按批次顺序处理，
+    每个批次内以有界并发调用 process，结果逐行追加到 output.jsonl（与输入顺序无关，以 line 标识）。
+    重启后未完成的批次自动恢复，output.jsonl 中已有结果的行不会重做。
+    """
+
+    def __init__(
+        self,
+        batch_dir: str,
+        process: LineProcessor,
+        default_concurrency: int = 2,
+        max_concurrency: int = 16,
+        max_upload_bytes: int = 512 * 1024 * 1024,
+    ) -> None:
+        self.batch_dir = batch_dir
+        self.process = process
+        self.default_concurrency = default_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_upload_bytes = max_upload_bytes
+        self._batches: Dict[str, Batch] = {}
+        self._queue: "asyncio.Queue[str]" = asyncio.Queue()
+        self._runner: Optional[asyncio.Task] = None
+        self._current: Optional[asyncio.Task] = None
+        self._current_id: Optional[str] = None
+
+    def _batch(self, batch_id: str) -> Batch:
+        batch = self._batches.get(batch_id)
+        if batch is None:
+            raise BatchNotFound(batch_id)
+        return batch
+
+    def get(self, batch_id: str) -> Dict[str, Any]:
+        return self._batch(batch_id).snapshot()
+
+    def list(self) -> List[Dict[str, Any]]:
+        batches = sorted(self._batches.values(), key=lambda b: b.meta["created_at"], reverse=True)
+        return [batch.snapshot() for batch in batches]
+
+    def output_path(self, batch_id: str) -> str:
+        return self._batch(batch_id).output_path
+
+    async def create(
+        self,
+        chunks: AsyncIterator[bytes],
+        concurrency: Optional[int] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        batch_id = f"batch_{uuid.uuid4().hex[:16]}"
+        directory = os.path.join(self.batch_dir, batch_id)
+        await asyncio.to_thread(os.makedirs, directory, exist_ok=True)
+        concurrency = max(1, min(concurrency or self.default_concurrency, self.max_concurrency))
+        batch = Batch(
+            directory,
+            {
+                "id": batch_id,
+                "status": "uploading",
+                "created_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "concurrency": concurrency,
+                "total": None,
+                "completed": 0,
+                "failed": 0,
+                "metadata": metadata or {},
+                "error": None,
+            },
+        )
+        # 上传内容直接流式写盘，不在内存中保留整个文件
+        size = 0
+        f: IO[bytes] = await asyncio.to_thread(open, batch.input_path, "wb")
+        try:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > self.max_upload_bytes:
+                    raise BatchTooLarge(f"batch input exceeds {self.max_upload_bytes} bytes")
+                await asyncio.to_thread(f.write, chunk)
+        except BaseException:
+            await asyncio.to_thread(f.close)
+            await asyncio.to_thread(_remove_tree, directory)
+            raise
+        await asyncio.to_thread(f.close)
+
+        batch.meta["total"] = await asyncio.to_thread(_count_lines, batch.input_path)
+        batch.meta["status"] = "queued"
+        await batch.persist()
+        self._batches[batch_id] = batch
+        self._queue.put_nowait(batch_id)
+        print(f"[INFO] queued batch {batch_id} lines={batch.meta['total']} concurrency={concurrency}")
+        return batch.snapshot()
+
+    async def cancel(self, batch_id: str) -> Dict[str, Any]:
+        batch = self._batch(batch_id)
+        if batch.meta["status"] in FINAL_STATUSES:
+            return batch.snapshot()
+        batch.meta["status"] = "cancelled"
+        batch.meta["finished_at"] = time.time()
+        if self._current_id == batch_id and self._current is not None:
+            self._current.cancel()
+        await batch.persist()
+        return batch.snapshot()
+
+    async def _run_batch(self, batch: Batch) -> None:
+        done, failed = await asyncio.to_thread(_load_finished, batch.output_path)
+        batch.meta.update(
+            status="running",
+            started_at=time.time(),
+            completed=len(done) - failed,
+            failed=failed,
+            processed_this_run=0,
+        )
+        if done:
+            print(f"[INFO] resuming batch {batch.id}: {len(done)} lines already finished")
+        await batch.persist()
+
+        concurrency = batch.meta["concurrency"]
+        pending: "asyncio.Queue[Optional[Tuple[int, bytes]]]" = asyncio.Queue(concurrency * 2)
+        output: IO[str] = await asyncio.to_thread(open, batch.output_path, "a", encoding="utf-8")
+        write_lock = asyncio.Lock()
+
+        async def produce() -> None:
+            offset, index = 0, 0
+            while True:
+                lines, offset, index = await asyncio.to_thread(
+                    _read_lines, batch.input_path, offset, index, 256
+                )
+                if not lines:
+                    break
+                for item in lines:
+                    if item[0] not in done:
+                        await pending.put(item)
+            for _ in range(concurrency):
+                await pending.put(None)
+
+        async def handle(index: int, raw: bytes) -> Dict[str, Any]:
+            record: Dict[str, Any] = {
+                "line": index,
+                "custom_id": None,
+                "response": None,
+                "error": None,
+            }
+            try:
+                body = json.loads(raw)
+                if not isinstance(body, dict):
+                    raise ValueError("line is not a JSON object")
+                # 同时支持裸请求体与 {"custom_id": ..., "body": {...}} 两种行格式
+                record["custom_id"] = body.get("custom_id")
+                if isinstance(body.get("body"), dict):
+                    body = body["body"]
+                record["response"] = await self.process(batch.id, body)
+            except ValueError as exc:
+                record["error"] = {"status_code": 400, "detail": str(exc)}
+            except BatchLineError as exc:
+                record["error"] = {"status_code": exc.status_code, "detail": exc.detail}
+            except Exception as exc:
+                # 单行的意外错误只记在该行，不能让 worker 退出、拖垮整个批次
+                print(f"[WARN] batch {batch.id} line {index} failed: {exc!r}")
+                record["error"] = {"status_code": 500, "detail": str(exc) or type(exc).__name__}
+            return record
+
+        async def work() -> None:
+            while True:
+                item = await pending.get()
+                if item is None:
+                    return
+                record = await handle(*item)
+                line = json.dumps(record, ensure_ascii=False) + "\n"
+                async with write_lock:
+                    await asyncio.to_thread(_write_and_flush, output, line)
+                batch.meta["failed" if record["error"] else "completed"] += 1
+                batch.meta["processed_this_run"] += 1
+                await batch.persist(force=False)
+
+        producer = asyncio.create_task(produce())
+        workers = [asyncio.create_task(work()) for _ in range(concurrency)]
+        try:
+            await asyncio.gather(producer, *workers)
+        except BaseException:
+            producer.cancel()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(producer, *workers, return_exceptions=True)
+            raise
+        finally:
+            await asyncio.to_thread(output.close)
+
+        batch.meta["status"] = "completed"
+        batch.meta["finished_at"] = time.time()
+        await batch.persist()
+        print(
+            f"[INFO] batch {batch.id} completed: {batch.meta['completed']} ok, "
+            f"{batch.meta['failed']} failed"
+        )
+
+    async def _run(self) -> None:
+        # 批次按提交顺序逐个处理，避免多个批次叠加并发挤占交互流量
+        while True:
+            batch_id = await self._queue.get()
+            batch = self._batches.get(batch_id)
+            if batch is None or batch.meta["status"] in FINAL_STATUSES:
+                continue
+            self._current_id = batch_id
+            self._current = asyncio.create_task(self._run_batch(batch))
+            try:
+                await self._current
+            except asyncio.CancelledError:
+                if batch.meta["status"] != "cancelled":
+                    # 关闭网关：保持 running 状态，下次启动时恢复
+                    raise
+                print(f"[INFO] batch {batch_id} cancelled")
+            except Exception as exc:
+                batch.meta["status"] = "failed"
+                batch.meta["error"] = str(exc)
+                batch.meta["finished_at"] = time.time()
+                await batch.persist()
+                print(f"[ERROR] batch {batch_id} failed: {exc}")
+            finally:
+                self._current = None
+                self._current_id = None
+
+    def _load_existing(self) -> List[Batch]:
+        batches: List[Batch] = []
+        for name in sorted(os.listdir(self.batch_dir)):
+            meta_path = os.path.join(self.batch_dir, name, "meta.json")
+            try:
+                with open(meta_path, "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+            batches.append(Batch(os.path.join(self.batch_dir, name), meta))
+        return batches
+
+    async def start(self) -> None:
+        if self._runner is not None:
+            return
+        try:
+            await asyncio.to_thread(os.makedirs, self.batch_dir, exist_ok=True)
+            existing = await asyncio.to_thread(self._load_existing)
+        except OSError as exc:
+            print(f"[ERROR] failed to prepare batch dir {self.batch_dir}: {exc}")
+            existing = []
+        for batch in sorted(existing, key=lambda b: b.meta["created_at"]):
+            self._batches[batch.id] = batch
+            if batch.meta["status"] in ("queued", "running"):
+                self._queue.put_nowait(batch.id)
+            elif batch.meta["status"] == "uploading":
+                # 上传中途重启，输入不完整，不能处理
+                batch.meta["status"] = "failed"
+                batch.meta["error"] = "upload interrupted"
+                await batch.persist()
+        self._runner = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._runner is None:
+            return
+        self._runner.cancel()
+        if self._current is not None:
+            self._current.cancel()
+        await asyncio.gather(
+            *(task for task in (self._runner, self._current) if task is not None),
+            return_exceptions=True,
+        )
+        self._runner = None
+        for batch in self._batches.values():
+            if batch.meta["status"] == "running":
+                await batch.persist()
+
+    def snapshot(self) -> Dict[str, Any]:
+        statuses: Dict[str, int] = {}
+        for batch in self._batches.values():
+            statuses[batch.meta["status"]] = statuses.get(batch.meta["status"], 0) + 1
+        return {
+            "batch_dir": self.batch_dir,
+            "current": self._current_id,
+            "queued": self._queue.qsize(),
+            "by_status": statuses,
+        }
+
+
+def _write_and_flush(f: IO[str], line: str) -> None:
+    f.write(line)
+    f.flush()
+
+
+def _remove_tree(directory: str) -> None:
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
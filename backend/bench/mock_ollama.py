@@ -0,0 +1,217 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import random
+import re
+import time
+from typing import Any, Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# 压测用的 Ollama 模拟服务：按配置的首 token 延迟、生成速率与错误率返回 /api/chat，
+# 并以 time.monotonic() 记录每个请求的服务端时间线，供压测脚本计算网关自身开销。
+# 启动示例：BENCH_MOCK_TOKEN_RATE=50 python -m uvicorn backend.bench.mock_ollama:app --port 11500
+
+# 每秒生成的 token 数
+MOCK_TOKEN_RATE = float(os.getenv("BENCH_MOCK_TOKEN_RATE", "50"))
+# 首 token 延迟（秒），模拟 prompt 处理
+MOCK_TTFT = float(os.getenv("BENCH_MOCK_TTFT", "0.2"))
+# 每个回复生成的 token 数（请求中的 options.num_predict 优先）
+MOCK_TOKENS = int(os.getenv("BENCH_MOCK_TOKENS", "64"))
+# 延迟抖动比例，0.1 表示在 ±10% 内随机
+MOCK_JITTER = float(os.getenv("BENCH_MOCK_JITTER", "0"))
+# 直接返回 500 的请求比例
+MOCK_ERROR_RATE = float(os.getenv("BENCH_MOCK_ERROR_RATE", "0"))
+# 流式输出到一半时断开连接的请求比例
+MOCK_STREAM_ABORT_RATE = float(os.getenv("BENCH_MOCK_STREAM_ABORT_RATE", "0"))
+# 随机数种子，便于复现错误注入的分布
+MOCK_SEED = os.getenv("BENCH_MOCK_SEED", "")
+
+# 压测客户端在消息文本中嵌入的请求标识
+BENCH_MARKER = re.compile(r"\[bench:([0-9A-Za-z_-]+)\]")
+
+
+def find_bench_id(messages: List[Dict[str, Any]]) -> Optional[str]:
+    for message in reversed(messages):
+        content = message.get("content")
+        if isinstance(content, str):
+            match = BENCH_MARKER.search(content)
+            if match:
+                return match.group(1)
+    return None
+
+
+class MockOllama:
+    def __init__(
+        self,
+        token_rate: float = MOCK_TOKEN_RATE,
+        ttft: float = MOCK_TTFT,
+        tokens: int = MOCK_TOKENS,
+        jitter: float = MOCK_JITTER,
+        error_rate: float = MOCK_ERROR_RATE,
+        stream_abort_rate: float = MOCK_STREAM_ABORT_RATE,
+        seed: Optional[int] = None,
+    ) -> None:
+        self.token_rate = token_rate
+        self.ttft = ttft
+        self.tokens = tokens
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.stream_abort_rate = stream_abort_rate
+        self.random = random.Random(seed)
+        self.records: List[Dict[str, Any]] = []
+        self.loaded: Dict[str, float] = {}
+
+    def delay(self, seconds: float) -> float:
+        if self.jitter <= 0:
+            return seconds
+        return max(0.0, seconds * (1 + self.random.uniform(-self.jitter, self.jitter)))
+
+    def _record(self, body: Dict[str, Any], received: float) -> Dict[str, Any]:
+        messages = body.get("messages") or []
+        record = {
+            "id": find_bench_id(messages),
+            "model": body.get("model"),
+            "stream": bool(body.get("stream")),
+            "images": sum(len(message.get("images") or ()) for message in messages),
+            "received": received,
+            "first_token": None,
+            "finished": None,
+            "status": "ok",
+        }
+        self.records.append(record)
+        self.loaded[body.get("model") or ""] = time.time()
+        return record
+
+    def _chunk(self, model: str, index: int) -> bytes:
+        message = {"role": "assistant", "content": f"tok{index} "}
+        return (json.dumps({"model": model, "message": message, "done": False}) + "\n").encode()
+
+    def _final(self, model: str, tokens: int, started: float, content: str = "") -> Dict[str, Any]:
+        elapsed_ns = int((time.monotonic() - started) * 1e9)
+        return {
+            "model": model,
+            "message": {"role": "assistant", "content": content},
+            "done": True,
+            "done_reason": "stop",
+            "prompt_eval_count": 16,
+            "prompt_eval_duration": int(self.ttft * 1e9),
+            "eval_count": tokens,
+            "eval_duration": max(0, elapsed_ns - int(self.ttft * 1e9)),
+            "load_duration": 0,
+            "total_duration": elapsed_ns,
+        }
+
+    async def chat(self, request: Request):
+        received = time.monotonic()
+        body = json.loads(await request.body())
+        record = self._record(body, received)
+        model = body.get("model") or ""
+        tokens = int((body.get("options") or {}).get("num_predict") or self.tokens)
+        if tokens < 0:
+            tokens = self.tokens
+        if self.random.random() < self.error_rate:
+            record["status"] = "injected_error"
+            record["finished"] = time.monotonic()
+            return JSONResponse({"error": "injected error"}, status_code=500)
+        interval = 1.0 / self.token_rate if self.token_rate > 0 else 0.0
+
+        if not body.get("stream"):
+            await asyncio.sleep(self.delay(self.ttft + interval * tokens))
+            content = "".join(f"tok{index} " for index in range(tokens))
+            record["first_token"] = record["finished"] = time.monotonic()
+            return self._final(model, tokens, received, content)
+
+        abort_at = tokens // 2 if self.random.random() < self.stream_abort_rate else None
+
+        async def generate():
+            # 按绝对时间排程，避免 sleep 误差逐 token 累积
+            deadline = received + self.delay(self.ttft)
+            for index in range(tokens):
+                await asyncio.sleep(max(0.0, deadline - time.monotonic()))
+                if index == abort_at:
+                    record["status"] = "injected_abort"
+                    record["finished"] = time.monotonic()
+                    raise RuntimeError("injected stream abort")
+                yield self._chunk(model, index)
+                if record["first_token"] is None:
+                    record["first_token"] = time.monotonic()
+                deadline += self.delay(interval)
+            yield (json.dumps(self._final(model, tokens, received)) + "\n").encode()
+            record["finished"] = time.monotonic()
+
+        return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
+def create_app(mock: Optional[MockOllama] = None) -> FastAPI:
+    mock = mock or MockOllama(seed=int(MOCK_SEED) if MOCK_SEED else None)
+    mock_app = FastAPI()
+    mock_app.state.mock = mock
+
+    @mock_app.post("/api/chat")
+    async def chat(request: Request):
+        return await mock.chat(request)
+
+    @mock_app.post("/api/generate")
+    async def generate(request: Request):
+        body = json.loads(await request.body())
+        model = body.get("model") or ""
+        if body.get("keep_alive") == 0:
+            mock.loaded.pop(model, None)
+            return {"model": model, "done": True, "done_reason": "unload"}
+        mock.loaded[model] = time.time()
+        return {"model": model, "done": True, "done_reason": "load"}
+
+    @mock_app.post("/api/embed")
+    async def embed(request: Request):
+        body = json.loads(await request.body())
+        texts = body.get("input")
+        texts = texts if isinstance(texts, list) else [texts]
+        await asyncio.sleep(mock.delay(mock.ttft / 4))
+        return {
+            "model": body.get("model"),
+            "embeddings": [[float(len(text)), 1.0, 0.0] for text in texts],
+            "prompt_eval_count": sum(len(text) // 4 + 1 for text in texts),
+        }
+
+    @mock_app.get("/api/ps")
+    async def ps():
+        return {
+            "models": [
+                {"name": name, "model": name, "size_vram": 1 << 30, "expires_at": "2099-01-01T00:00:00Z"}
+                for name in mock.loaded
+            ]
+        }
+
+    @mock_app.get("/api/tags")
+    async def tags():
+        return {"models": [{"name": name} for name in mock.loaded]}
+
+    @mock_app.get("/api/version")
+    async def version():
+        return {"version": "bench-mock"}
+
+    # 压测脚本读取并清空服务端时间线
+    @mock_app.post("/bench/records")
+    async def drain_records():
+        records, mock.records = mock.records, []
+        return records
+
+    @mock_app.get("/bench/config")
+    async def config():
+        return {
+            "token_rate": mock.token_rate,
+            "ttft": mock.ttft,
+            "tokens": mock.tokens,
+            "jitter": mock.jitter,
+            "error_rate": mock.error_rate,
+            "stream_abort_rate": mock.stream_abort_rate,
+        }
+
+    return mock_app
+
+
+app = create_app()
@@ -0,0 +1,706 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import os
+import random
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import zlib
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+
+# 网关压测：启动 backend.bench.mock_ollama 作为上游，再按给定并发驱动网关（或已运行的网关），
+# 用请求中嵌入的 [bench:<id>] 标识把客户端时间线与 mock 记录的服务端时间线对齐，
+# 得到网关自身引入的延迟、首 token 延迟放大、吞吐、事件循环延迟和 RSS，结果写为 JSON 便于对比。
+#
+#   python -m backend.bench.run --concurrency 32 --requests 500 --stream-ratio 0.5 \
+#       --image-ratio 0.2 --output bench-results/base.json
+#   python -m backend.bench.run --replay traffic.jsonl --baseline bench-results/base.json
+#
+# 两个进程的时间戳都取 time.monotonic()；Linux 上它是系统级时钟，同机进程间可以直接相减。
+
+RESULT_VERSION = 1
+PERCENTILES = (50, 95, 99)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100.0
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def _distribution_ms(values: List[float]) -> Dict[str, Optional[float]]:
+    result: Dict[str, Optional[float]] = {}
+    for pct in PERCENTILES:
+        value = percentile(values, pct)
+        result[f"p{pct}"] = round(value * 1000, 3) if value is not None else None
+    result["max"] = round(max(values) * 1000, 3) if values else None
+    return result
+
+
+# ---------------------------------------------------------------------------
+# 请求构造
+# ---------------------------------------------------------------------------
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return (
+        struct.pack(">I", len(data))
+        + kind
+        + data
+        + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+    )
+
+
+def make_png(target_bytes: int, seed: int = 0) -> bytes:
+    """生成体积约为 target_bytes 的随机噪声 RGB PNG（噪声几乎不可压缩，体积可控）。"""
+    side = max(8, int((target_bytes / 3) ** 0.5))
+    rng = random.Random(seed)
+    row_bytes = side * 3
+    raw = b"".join(b"\x00" + rng.randbytes(row_bytes) for _ in range(side))
+    header = struct.pack(">IIBBBBB", side, side, 8, 2, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + _png_chunk(b"IHDR", header)
+        + _png_chunk(b"IDAT", zlib.compress(raw, 1))
+        + _png_chunk(b"IEND", b"")
+    )
+
+
+def unique_png(base: bytes, tag: str) -> bytes:
+    # 在 IEND 前插入 tEXt 块，使每个请求的图片内容哈希不同，避免网关按内容去重
+    return base[:-12] + _png_chunk(b"tEXt", b"bench\x00" + tag.encode()) + base[-12:]
+
+
+def _mark(body: Dict[str, Any], bench_id: str) -> Dict[str, Any]:
+    """在最后一条消息的文本中追加 [bench:<id>]，同时让每个请求唯一，绕开响应缓存与合并。"""
+    body = dict(body)
+    messages = [dict(message) for message in body.get("messages") or []]
+    if not messages:
+        messages = [{"role": "user", "content": ""}]
+    last = messages[-1]
+    marker = f"[bench:{bench_id}]"
+    content = last.get("content")
+    if isinstance(content, list):
+        last["content"] = list(content) + [{"type": "text", "text": marker}]
+    else:
+        last["content"] = f"{content or ''} {marker}".strip()
+    body["messages"] = messages
+    return body
+
+
+def load_replay(path: str, model: str) -> List[Dict[str, Any]]:
+    """
+    读取回放文件，每行一个请求，支持：
+    - 聊天请求体（含 messages），或 {"custom_id": ..., "body": {...}}（与 /v1/batches 输入相同）；
+    - {"body": "<文本>"} / {"prompt": "<文本>"}，文本作为单条 user 消息（title 作为 system 消息）。
+    """
+    bodies: List[Dict[str, Any]] = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if isinstance(record.get("body"), dict):
+                body = dict(record["body"])
+            elif "messages" in record:
+                body = dict(record)
+            else:
+                text = record.get("body") or record.get("prompt")
+                if not isinstance(text, str):
+                    continue
+                messages = [{"role": "user", "content": text}]
+                if isinstance(record.get("title"), str):
+                    messages.insert(0, {"role": "system", "content": record["title"]})
+                body = {"messages": messages}
+            body.setdefault("model", model)
+            bodies.append(body)
+    if not bodies:
+        raise SystemExit(f"no usable requests in {path}")
+    return bodies
+
+
+class TrafficPlan:
+    """按比例生成 流式/非流式 × 纯文本/带图片 的请求，或循环回放文件中的请求。"""
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.replay = load_replay(args.replay, args.model) if args.replay else None
+        self.base_png = make_png(args.image_kb * 1024, args.seed) if args.image_ratio > 0 else b""
+
+    def __iter__(self) -> Iterator[Tuple[str, Dict[str, Any], str]]:
+        source = itertools.cycle(self.replay) if self.replay else None
+        while True:
+            bench_id = uuid.uuid4().hex[:16]
+            if source is not None:
+                body = dict(next(source))
+                if "stream" not in body:
+                    body["stream"] = self.rng.random() < self.args.stream_ratio
+                has_image = any(
+                    isinstance(message.get("content"), list)
+                    and any(part.get("type") == "image_url" for part in message["content"])
+                    for message in body.get("messages") or []
+                )
+            else:
+                has_image = self.rng.random() < self.args.image_ratio
+                body = {
+                    "model": self.args.vl_model if has_image else self.args.model,
+                    "stream": self.rng.random() < self.args.stream_ratio,
+                    "messages": [
+                        {"role": "system", "content": "You are a helpful assistant."},
+                        {"role": "user", "content": self._prompt(has_image, bench_id)},
+                    ],
+                }
+            if self.args.stream_format and body.get("stream"):
+                body["stream_format"] = self.args.stream_format
+            if self.args.tokens:
+                body["options"] = {**(body.get("options") or {}), "num_predict": self.args.tokens}
+            kind = ("stream" if body.get("stream") else "nonstream") + (
+                "_image" if has_image else "_text"
+            )
+            yield bench_id, _mark(body, bench_id), kind
+
+    def _prompt(self, has_image: bool, bench_id: str) -> Any:
+        text = "Describe the following in detail. " * max(1, self.args.prompt_words // 6)
+        if not has_image:
+            return text
+        png = unique_png(self.base_png, bench_id)
+        url = "data:image/png;base64," + base64.b64encode(png).decode("ascii")
+        return [{"type": "text", "text": text}, {"type": "image_url", "image_url": {"url": url}}]
+
+
+# ---------------------------------------------------------------------------
+# 客户端
+# ---------------------------------------------------------------------------
+
+
+async def _send(
+    client: httpx.AsyncClient, bench_id: str, body: Dict[str, Any], kind: str
+) -> Dict[str, Any]:
+    payload = json.dumps(body).encode("utf-8")
+    result: Dict[str, Any] = {
+        "id": bench_id,
+        "kind": kind,
+        "request_bytes": len(payload),
+        "status": None,
+        "ok": False,
+        "error": None,
+    }
+    headers = {"content-type": "application/json"}
+    started = time.monotonic()
+    result["started"] = started
+    first: Optional[float] = None
+    try:
+        if body.get("stream"):
+            tail = b""
+            size = 0
+            async with client.stream(
+                "POST", "/v1/chat/completions", content=payload, headers=headers
+            ) as response:
+                result["status"] = response.status_code
+                async for chunk in response.aiter_bytes():
+                    if first is None and chunk.strip():
+                        first = time.monotonic()
+                    size += len(chunk)
+                    tail = (tail + chunk)[-512:]
+            result["response_bytes"] = size
+            finished = time.monotonic()
+            completed = b'"done":true' in tail.replace(b" ", b"") or b"[DONE]" in tail
+            result["ok"] = response.status_code == 200 and completed
+            if response.status_code == 200 and not completed:
+                result["error"] = "incomplete_stream"
+        else:
+            response = await client.post("/v1/chat/completions", content=payload, headers=headers)
+            first = finished = time.monotonic()
+            result["status"] = response.status_code
+            result["response_bytes"] = len(response.content)
+            result["ok"] = response.status_code == 200
+    except httpx.HTTPError as exc:
+        finished = time.monotonic()
+        result["error"] = type(exc).__name__
+    if not result["ok"] and result["error"] is None:
+        result["error"] = f"http_{result['status']}"
+    result["first_byte"] = first
+    result["finished"] = finished
+    return result
+
+
+async def _worker(
+    client: httpx.AsyncClient,
+    plan: Iterator[Tuple[str, Dict[str, Any], str]],
+    remaining: List[int],
+    deadline: Optional[float],
+    results: List[Dict[str, Any]],
+) -> None:
+    while True:
+        if deadline is not None and time.monotonic() >= deadline:
+            return
+        if remaining[0] <= 0:
+            return
+        remaining[0] -= 1
+        bench_id, body, kind = next(plan)
+        results.append(await _send(client, bench_id, body, kind))
+
+
+class ProcessSampler:
+    """周期读取 /proc/<pid>/status 的 RSS，并轮询网关 /admin/loop 采样事件循环延迟。"""
+
+    def __init__(self, client: httpx.AsyncClient, pid: Optional[int], interval: float) -> None:
+        self.client = client
+        self.pid = pid
+        self.interval = interval
+        self.rss: List[int] = []
+        self.loop_samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def read_status(self) -> Dict[str, int]:
+        values: Dict[str, int] = {}
+        if self.pid is None:
+            return values
+        try:
+            with open(f"/proc/{self.pid}/status", "r", encoding="ascii") as f:
+                for line in f:
+                    key, _, rest = line.partition(":")
+                    if key in ("VmRSS", "VmHWM"):
+                        values[key] = int(rest.split()[0]) * 1024
+        except OSError:
+            pass
+        return values
+
+    async def loop_snapshot(self) -> Optional[Dict[str, Any]]:
+        try:
+            response = await self.client.get("/admin/loop", timeout=5)
+            return response.json() if response.status_code == 200 else None
+        except httpx.HTTPError:
+            return None
+
+    async def _run(self) -> None:
+        while True:
+            rss = self.read_status().get("VmRSS")
+            if rss is not None:
+                self.rss.append(rss)
+            snapshot = await self.loop_snapshot()
+            if snapshot is not None:
+                self.loop_samples.append(snapshot["last_ms"] / 1000.0)
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+# ---------------------------------------------------------------------------
+# 汇总
+# ---------------------------------------------------------------------------
+
+
+def join_records(results: List[Dict[str, Any]], records: List[Dict[str, Any]]) -> None:
+    """把 mock 的服务端时间线并入客户端结果；同一请求被重试时以最后一次上游调用为准。"""
+    by_id: Dict[str, List[Dict[str, Any]]] = {}
+    for record in records:
+        if record.get("id"):
+            by_id.setdefault(record["id"], []).append(record)
+    for result in results:
+        attempts = sorted(by_id.get(result["id"], []), key=lambda record: record["received"])
+        result["upstream_attempts"] = len(attempts)
+        result["upstream_status"] = attempts[-1]["status"] if attempts else None
+        last = attempts[-1] if attempts else None
+        result["overhead"] = None
+        result["ttft_inflation"] = None
+        if last is None or last.get("finished") is None or result["finished"] is None:
+            continue
+        latency = result["finished"] - result["started"]
+        # 网关开销 = 客户端总耗时 - 最后一次上游调用耗时（包含排队与重试时间）
+        result["overhead"] = latency - (last["finished"] - last["received"])
+        result["pre_upstream"] = last["received"] - result["started"]
+        if result["kind"].startswith("stream") and last.get("first_token") and result["first_byte"]:
+            result["ttft_inflation"] = result["first_byte"] - last["first_token"]
+
+
+def summarize(results: List[Dict[str, Any]], wall: float, tokens: int) -> Dict[str, Any]:
+    groups: Dict[str, List[Dict[str, Any]]] = {"all": results}
+    for result in results:
+        groups.setdefault(result["kind"], []).append(result)
+    summary: Dict[str, Any] = {}
+    for name, items in sorted(groups.items()):
+        ok = [item for item in items if item["ok"]]
+        errors: Dict[str, int] = {}
+        for item in items:
+            if not item["ok"]:
+                errors[item["error"]] = errors.get(item["error"], 0) + 1
+        streams = [item for item in ok if item["kind"].startswith("stream") and item["first_byte"]]
+        summary[name] = {
+            "requests": len(items),
+            "ok": len(ok),
+            "errors": errors,
+            "error_rate": round(1 - len(ok) / len(items), 4) if items else 0.0,
+            "throughput_rps": round(len(ok) / wall, 3) if wall else 0.0,
+            "tokens_per_s": round(len(ok) * tokens / wall, 1) if wall and tokens else None,
+            "latency_ms": _distribution_ms([item["finished"] - item["started"] for item in ok]),
+            "ttft_ms": _distribution_ms([item["first_byte"] - item["started"] for item in streams]),
+            "overhead_ms": _distribution_ms(
+                [item["overhead"] for item in ok if item.get("overhead") is not None]
+            ),
+            "pre_upstream_ms": _distribution_ms(
+                [item["pre_upstream"] for item in ok if item.get("pre_upstream") is not None]
+            ),
+            "ttft_inflation_ms": _distribution_ms(
+                [item["ttft_inflation"] for item in ok if item.get("ttft_inflation") is not None]
+            ),
+            "upstream_retries": sum(max(0, item["upstream_attempts"] - 1) for item in items),
+            "request_bytes_avg": round(sum(item["request_bytes"] for item in items) / len(items))
+            if items
+            else 0,
+        }
+    return summary
+
+
+# 对比时关注的指标：(路径, 越大越差)
+COMPARE_METRICS = (
+    ("summary.all.overhead_ms.p50", True),
+    ("summary.all.overhead_ms.p95", True),
+    ("summary.all.overhead_ms.p99", True),
+    ("summary.all.ttft_inflation_ms.p50", True),
+    ("summary.all.ttft_inflation_ms.p95", True),
+    ("summary.all.throughput_rps", False),
+    ("summary.all.error_rate", True),
+    ("gateway.rss.peak_bytes", True),
+    ("gateway.loop_lag.avg_ms", True),
+    ("gateway.loop_lag.p99_ms", True),
+)
+
+
+def _lookup(data: Dict[str, Any], path: str) -> Optional[float]:
+    value: Any = data
+    for key in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value if isinstance(value, (int, float)) else None
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> Dict[str, Any]:
+    rows: Dict[str, Any] = {}
+    for path, higher_is_worse in COMPARE_METRICS:
+        new, old = _lookup(current, path), _lookup(baseline, path)
+        if new is None or old is None:
+            continue
+        change = (new - old) / old if old else None
+        if change is None:
+            # 基线为 0（例如错误率）时无法算比例，只要变差就标记
+            regression = new > old if higher_is_worse else new < old
+        else:
+            regression = change > 0 if higher_is_worse else change < 0
+        rows[path] = {
+            "baseline": old,
+            "current": new,
+            "change": round(change, 4) if change is not None else None,
+            "worse": regression,
+        }
+    return rows
+
+
+def print_report(result: Dict[str, Any]) -> None:
+    print(f"\nwall {result['wall_s']}s, concurrency {result['config']['concurrency']}")
+    header = f"{'kind':<18}{'n':>6}{'ok':>6}{'rps':>8}  {'overhead p50/p95/p99 ms':<28}{'ttft+ p50/p95 ms':<20}"
+    print(header)
+    for name, row in result["summary"].items():
+        overhead = row["overhead_ms"]
+        inflation = row["ttft_inflation_ms"]
+        print(
+            f"{name:<18}{row['requests']:>6}{row['ok']:>6}{row['throughput_rps']:>8}  "
+            f"{_fmt(overhead['p50'])}/{_fmt(overhead['p95'])}/{_fmt(overhead['p99']):<12}"
+            f"{_fmt(inflation['p50'])}/{_fmt(inflation['p95']):<10}"
+        )
+    gateway = result["gateway"]
+    if gateway["rss"]:
+        rss = gateway["rss"]
+        print(
+            f"gateway RSS start {rss['start_bytes'] >> 20} MB, peak {rss['peak_bytes'] >> 20} MB, "
+            f"end {rss['end_bytes'] >> 20} MB"
+        )
+    if gateway["loop_lag"]:
+        lag = gateway["loop_lag"]
+        print(f"gateway loop lag avg {lag['avg_ms']} ms, p99 {lag['p99_ms']} ms, max {lag['max_ms']} ms")
+    for path, row in (result.get("comparison") or {}).items():
+        flag = "WORSE" if row["worse"] else ""
+        change = f"{row['change']:+.1%}" if row["change"] is not None else "n/a"
+        print(f"  {path:<40}{row['baseline']:>12} -> {row['current']:<12}{change:>9} {flag}")
+
+
+def _fmt(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value:.1f}"
+
+
+# ---------------------------------------------------------------------------
+# 进程管理
+# ---------------------------------------------------------------------------
+
+
+def _spawn(module_app: str, port: int, env: Dict[str, str], log_path: str) -> subprocess.Popen:
+    log = open(log_path, "wb")
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", module_app, "--port", str(port), "--log-level", "warning"],
+        env={**os.environ, **env},
+        stdout=log,
+        stderr=subprocess.STDOUT,
+        cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    )
+
+
+async def _wait_ready(url: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url, timeout=1)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+    raise SystemExit(f"timed out waiting for {url}")
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    workdir = tempfile.mkdtemp(prefix="gateway-bench-")
+    processes: List[subprocess.Popen] = []
+    mock_port = args.mock_port or _free_port()
+    mock_url = f"http://127.0.0.1:{mock_port}"
+    mock_env = {
+        "BENCH_MOCK_TOKEN_RATE": str(args.token_rate),
+        "BENCH_MOCK_TTFT": str(args.ttft),
+        "BENCH_MOCK_TOKENS": str(args.tokens),
+        "BENCH_MOCK_JITTER": str(args.jitter),
+        "BENCH_MOCK_ERROR_RATE": str(args.error_rate),
+        "BENCH_MOCK_STREAM_ABORT_RATE": str(args.abort_rate),
+        "BENCH_MOCK_SEED": str(args.seed),
+    }
+    gateway_pid = args.gateway_pid
+    try:
+        processes.append(
+            _spawn("backend.bench.mock_ollama:app", mock_port, mock_env, f"{workdir}/mock.log")
+        )
+        await _wait_ready(f"{mock_url}/api/version")
+        if args.gateway_url:
+            gateway_url = args.gateway_url.rstrip("/")
+        else:
+            gateway_port = args.gateway_port or _free_port()
+            gateway_url = f"http://127.0.0.1:{gateway_port}"
+            gateway_env = {
+                "OLLAMA_URL": f"{mock_url}/api/chat",
+                "IMAGE_DIR": f"{workdir}/images",
+                "IMAGE_BASE_URL": f"{gateway_url}/images",
+                "BATCH_DIR": f"{workdir}/batches",
+                # 默认放开准入上限，测网关本身而不是排队；需要时用 --gateway-env 覆盖
+                "ADMISSION_MAX_IN_FLIGHT": str(args.concurrency),
+                "ADMISSION_MAX_QUEUE": str(args.concurrency * 4),
+            }
+            for item in args.gateway_env:
+                key, _, value = item.partition("=")
+                gateway_env[key] = value
+            os.makedirs(gateway_env["IMAGE_DIR"], exist_ok=True)
+            gateway = _spawn("backend.main:app", gateway_port, gateway_env, f"{workdir}/gateway.log")
+            processes.append(gateway)
+            gateway_pid = gateway.pid
+            await _wait_ready(f"{gateway_url}/admin/loop")
+
+        limits = httpx.Limits(max_connections=args.concurrency + 4, max_keepalive_connections=args.concurrency + 4)
+        timeout = httpx.Timeout(args.timeout)
+        async with httpx.AsyncClient(base_url=gateway_url, limits=limits, timeout=timeout) as client:
+            plan = iter(TrafficPlan(args))
+            if args.warmup:
+                await _worker(client, plan, [args.warmup], None, [])
+            async with httpx.AsyncClient(base_url=mock_url) as mock_client:
+                await mock_client.post("/bench/records")
+
+                sampler = ProcessSampler(client, gateway_pid, args.sample_interval)
+                loop_before = await sampler.loop_snapshot()
+                rss_before = sampler.read_status().get("VmRSS")
+                sampler.start()
+                results: List[Dict[str, Any]] = []
+                remaining = [args.requests if args.requests else sys.maxsize]
+                deadline = time.monotonic() + args.duration if args.duration else None
+                started = time.monotonic()
+                await asyncio.gather(
+                    *(
+                        _worker(client, plan, remaining, deadline, results)
+                        for _ in range(args.concurrency)
+                    )
+                )
+                wall = time.monotonic() - started
+                await sampler.stop()
+                loop_after = await sampler.loop_snapshot()
+                status_after = sampler.read_status()
+                records = (await mock_client.post("/bench/records")).json()
+                mock_config = (await mock_client.get("/bench/config")).json()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        # 保留日志，删除压测产生的图片
+        shutil.rmtree(f"{workdir}/images", ignore_errors=True)
+
+    join_records(results, records)
+    rss: Optional[Dict[str, Any]] = None
+    if sampler.rss:
+        rss = {
+            "start_bytes": rss_before or sampler.rss[0],
+            "peak_bytes": max(sampler.rss),
+            "end_bytes": status_after.get("VmRSS", sampler.rss[-1]),
+            # 进程生命周期内的峰值（含预热）
+            "hwm_bytes": status_after.get("VmHWM"),
+        }
+    loop_lag: Optional[Dict[str, Any]] = None
+    if loop_before and loop_after:
+        samples = loop_after["samples"] - loop_before["samples"]
+        total_ms = loop_after["avg_ms"] * loop_after["samples"] - loop_before["avg_ms"] * loop_before["samples"]
+        p99 = percentile(sampler.loop_samples, 99)
+        loop_lag = {
+            "avg_ms": round(total_ms / samples, 3) if samples else None,
+            "p99_ms": round(p99 * 1000, 3) if p99 is not None else None,
+            "max_ms": loop_after["max_ms"],
+            "samples": samples,
+        }
+    result = {
+        "version": RESULT_VERSION,
+        "created_at": time.time(),
+        "git_commit": _git_commit(),
+        "config": {
+            key: value for key, value in vars(args).items() if key not in ("baseline", "output")
+        },
+        "mock": mock_config,
+        "wall_s": round(wall, 3),
+        "summary": summarize(results, wall, args.tokens),
+        "gateway": {"url": gateway_url, "pid": gateway_pid, "rss": rss, "loop_lag": loop_lag},
+        "workdir": workdir,
+    }
+    if args.raw:
+        result["requests"] = results
+    return result
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m backend.bench.run", description="Benchmark the chat gateway against a mock Ollama."
+    )
+    load = parser.add_argument_group("load")
+    load.add_argument("--concurrency", type=int, default=16)
+    load.add_argument("--requests", type=int, default=200, help="total requests (0 = until --duration)")
+    load.add_argument("--duration", type=float, default=0, help="stop after N seconds")
+    load.add_argument("--warmup", type=int, default=8, help="sequential requests before measuring")
+    load.add_argument("--stream-ratio", type=float, default=0.5)
+    load.add_argument("--stream-format", choices=["ndjson", "openai"], default=None)
+    load.add_argument("--image-ratio", type=float, default=0.0)
+    load.add_argument("--image-kb", type=int, default=512)
+    load.add_argument("--prompt-words", type=int, default=60)
+    load.add_argument("--model", default="qwen3:8b")
+    load.add_argument("--vl-model", default="qwen3-vl:32b")
+    load.add_argument("--replay", help="JSONL file of chat request bodies to replay")
+    load.add_argument("--timeout", type=float, default=300)
+    load.add_argument("--seed", type=int, default=1)
+
+    mock = parser.add_argument_group("mock Ollama")
+    mock.add_argument("--tokens", type=int, default=64, help="tokens per completion")
+    mock.add_argument("--token-rate", type=float, default=50, help="tokens per second")
+    mock.add_argument("--ttft", type=float, default=0.2, help="upstream time to first token (s)")
+    mock.add_argument("--jitter", type=float, default=0.0)
+    mock.add_argument("--error-rate", type=float, default=0.0, help="fraction answered with HTTP 500")
+    mock.add_argument("--abort-rate", type=float, default=0.0, help="fraction of streams cut mid-way")
+    mock.add_argument("--mock-port", type=int, default=0)
+
+    gateway = parser.add_argument_group("gateway")
+    gateway.add_argument("--gateway-url", help="use an already running gateway instead of spawning one")
+    gateway.add_argument("--gateway-pid", type=int, help="pid of --gateway-url, for RSS sampling")
+    gateway.add_argument("--gateway-port", type=int, default=0)
+    gateway.add_argument(
+        "--gateway-env", action="append", default=[], metavar="KEY=VALUE",
+        help="extra environment for the spawned gateway (repeatable)",
+    )
+    gateway.add_argument("--sample-interval", type=float, default=0.25)
+
+    output = parser.add_argument_group("output")
+    output.add_argument("--output", help="write JSON results to this file")
+    output.add_argument("--baseline", help="compare against a previous JSON result")
+    output.add_argument(
+        "--max-regression", type=float, default=None,
+        help="exit 1 if any compared metric is worse than baseline by more than this fraction",
+    )
+    output.add_argument("--raw", action="store_true", help="include per-request timelines in the output")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    if not args.requests and not args.duration:
+        print("[ERROR] one of --requests or --duration must be positive")
+        return 2
+    if args.gateway_url and not args.mock_port:
+        # 已运行的网关需要事先把 OLLAMA_URL 指向 mock 的固定端口
+        print("[ERROR] --gateway-url requires --mock-port matching the gateway's OLLAMA_URL")
+        return 2
+    result = asyncio.run(run(args))
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            result["comparison"] = compare(result, json.load(f))
+    print_report(result)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"[INFO] results written to {args.output}")
+    if args.max_regression is not None and result.get("comparison"):
+        worse = [
+            path
+            for path, row in result["comparison"].items()
+            if row["worse"] and (row["change"] is None or abs(row["change"]) > args.max_regression)
+        ]
+        if worse:
+            print(f"[ERROR] regression beyond {args.max_regression:.0%}: {', '.join(worse)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import asyncio
+from collections import defaultdict
+from typing import Any, Dict, Optional
+
+from starlette.requests import Request
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+async def wait_for_disconnect(request: Request) -> None:
+    """请求体读取完毕后，下一次 receive 会一直阻塞到客户端断开。"""
+    while True:
+        message = await request.receive()
+        if message.get("type") == "http.disconnect":
+            return
+
+
+async def run_until_disconnect(request: Request, awaitable: Any) -> Any:
+    """执行 awaitable，若客户端先断开则取消它并抛出 ClientDisconnected。"""
+    task = asyncio.ensure_future(awaitable)
+    watcher = asyncio.create_task(wait_for_disconnect(request))
+    try:
+        done, _ = await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if task in done:
+        return task.result()
+    task.cancel()
+    try:
+        await task
+    except (asyncio.CancelledError, Exception):
+        pass
+    raise ClientDisconnected()
+
+
+class _ModelProfile:
+    """按模型记录完成长度与生成速度的指数滑动平均，用于估算取消节省的量。"""
+
+    __slots__ = ("completion_tokens", "tokens_per_second")
+
+    def __init__(self) -> None:
+        self.completion_tokens: Optional[float] = None
+        self.tokens_per_second: Optional[float] = None
+
+
+class CancellationTracker:
+    def __init__(self, smoothing: float = 0.2) -> None:
+        self.smoothing = smoothing
+        self._profiles: Dict[str, _ModelProfile] = defaultdict(_ModelProfile)
+        self.cancelled: Dict[str, int] = defaultdict(int)
+        self.tokens_saved: Dict[str, float] = defaultdict(float)
+        self.seconds_saved: Dict[str, float] = defaultdict(float)
+
+    def _ema(self, previous: Optional[float], value: float) -> float:
+        if previous is None:
+            return value
+        return previous + self.smoothing * (value - previous)
+
+    def observe_completion(self, model: str, final_chunk: Optional[Dict[str, Any]]) -> None:
+        if not final_chunk:
+            return
+        eval_count = final_chunk.get("eval_count")
+        eval_duration = final_chunk.get("eval_duration")
+        if not eval_count:
+            return
+        profile = self._profiles[model]
+        profile.completion_tokens = self._ema(profile.completion_tokens, float(eval_count))
+        if eval_duration:
+            rate = eval_count / (eval_duration / 1e9)
+            profile.tokens_per_second = self._ema(profile.tokens_per_second, rate)
+
+    def record_cancel(
+        self,
+        model: str,
+        generated_tokens: Optional[int],
+        elapsed: float,
+        num_predict: Optional[int] = None,
+    ) -> None:
+        """
+        记录一次取消。预计完成长度取该模型的平均完成长度（不超过 num_predict），
+        已生成量在非流式场景下按平均速度和已耗时间估算。
+        """
+        self.cancelled[model] += 1
+        profile = self._profiles.get(model)
+        expected = profile.completion_tokens if profile else None
+        if num_predict is not None and num_predict > 0:
+            expected = min(expected, num_predict) if expected is not None else float(num_predict)
+        rate = profile.tokens_per_second if profile else None
+        if expected is None:
+            return
+        if generated_tokens is None:
+            generated_tokens = int(elapsed * rate) if rate else 0
+        remaining = max(0.0, expected - generated_tokens)
+        self.tokens_saved[model] += remaining
+        if rate:
+            self.seconds_saved[model] += remaining / rate
+
+    def snapshot(self) -> Dict[str, Any]:
+        models = sorted(set(self.cancelled) | set(self._profiles))
+        return {
+            model: {
+                "cancelled": self.cancelled.get(model, 0),
+                "tokens_saved": round(self.tokens_saved.get(model, 0.0)),
+                "seconds_saved": round(self.seconds_saved.get(model, 0.0), 2),
+                "avg_completion_tokens": (
+                    round(self._profiles[model].completion_tokens or 0.0, 1)
+                    if model in self._profiles
+                    else None
+                ),
+            }
+            for model in models
+        }
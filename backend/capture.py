@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+REDACT_MODES = {"none", "truncate", "redact"}
+
+
+def _scrub_image(b64_data: str, mode: str, keep_chars: int) -> str:
+    if mode == "truncate":
+        return f"{b64_data[:keep_chars]}...<{len(b64_data)} base64 chars>"
+    return f"<{len(b64_data)} base64 chars>"
+
+
+def scrub_payload(payload: Dict[str, Any], mode: str, keep_chars: int = 64) -> Dict[str, Any]:
+    """返回 payload 的浅拷贝，按 mode 截断或替换其中的 base64 图片，原对象不受影响。"""
+    if mode == "none":
+        return payload
+    messages = []
+    for message in payload.get("messages") or []:
+        images = message.get("images") if isinstance(message, dict) else None
+        if images:
+            message = {
+                **message,
+                "images": [_scrub_image(str(item), mode, keep_chars) for item in images],
+            }
+        messages.append(message)
+    return {**payload, "messages": messages}
+
+
+def payload_summary(payload: Dict[str, Any]) -> Dict[str, Any]:
+    messages = payload.get("messages") or []
+    image_count = 0
+    image_chars = 0
+    for message in messages:
+        for item in (message.get("images") or []) if isinstance(message, dict) else []:
+            image_count += 1
+            image_chars += len(item)
+    return {
+        "model": payload.get("model"),
+        "stream": payload.get("stream", False),
+        "messages": len(messages),
+        "images": image_count,
+        "image_b64_chars": image_chars,
+    }
+
+
+class CaptureBuffer:
+    """
+    抽样记录发往 Ollama 的 payload：保存在内存环形缓冲区中，
+    可选由后台任务批量写入 capture_dir 下按天滚动的 JSONL 文件，请求路径上不做磁盘 I/O。
+    """
+
+    def __init__(
+        self,
+        sample_rate: float,
+        capacity: int,
+        redact_mode: str = "redact",
+        keep_chars: int = 64,
+        capture_dir: Optional[str] = None,
+        flush_interval: float = 2.0,
+    ) -> None:
+        if redact_mode not in REDACT_MODES:
+            print(f"[WARN] unknown capture redact mode {redact_mode}, fallback to redact")
+            redact_mode = "redact"
+        self.sample_rate = sample_rate
+        self.redact_mode = redact_mode
+        self.keep_chars = keep_chars
+        self.capture_dir = capture_dir
+        self.flush_interval = flush_interval
+        self._ring: Deque[Dict[str, Any]] = deque(maxlen=max(1, capacity))
+        self._pending: Deque[Dict[str, Any]] = deque(maxlen=self._ring.maxlen)
+        self._writer: Optional[asyncio.Task] = None
+        self.captured = 0
+        self.written = 0
+        self.dropped_writes = 0
+
+    def maybe_capture(self, payload: Dict[str, Any], **meta: Any) -> Optional[str]:
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        capture_id = uuid.uuid4().hex[:12]
+        record = {
+            "id": capture_id,
+            "ts": time.time(),
+            "summary": payload_summary(payload),
+            "meta": meta,
+            "payload": scrub_payload(payload, self.redact_mode, self.keep_chars),
+        }
+        self._ring.append(record)
+        self.captured += 1
+        if self.capture_dir and self._writer is not None:
+            # 写盘队列与环形缓冲区同样有界，磁盘跟不上时丢弃最旧的待写记录
+            if len(self._pending) == self._pending.maxlen:
+                self.dropped_writes += 1
+            self._pending.append(record)
+        return capture_id
+
+    def recent(self) -> List[Dict[str, Any]]:
+        return [
+            {"id": item["id"], "ts": item["ts"], **item["summary"], "meta": item["meta"]}
+            for item in reversed(self._ring)
+        ]
+
+    def get(self, capture_id: str) -> Optional[Dict[str, Any]]:
+        for item in self._ring:
+            if item["id"] == capture_id:
+                return item
+        return None
+
+    def _write_batch(self, batch: List[Dict[str, Any]]) -> None:
+        day = time.strftime("%Y%m%d")
+        path = os.path.join(self.capture_dir or "", f"capture-{day}.jsonl")
+        with open(path, "a", encoding="utf-8") as f:
+            for record in batch:
+                f.write(json.dumps(record, ensure_ascii=False))
+                f.write("\n")
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+        batch = list(self._pending)
+        self._pending.clear()
+        try:
+            await asyncio.to_thread(self._write_batch, batch)
+            self.written += len(batch)
+        except OSError as exc:
+            self.dropped_writes += len(batch)
+            print(f"[WARN] failed to write captures to {self.capture_dir}: {exc}")
+
+    async def _writer_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self) -> None:
+        if not self.capture_dir or self._writer is not None:
+            return
+        try:
+            os.makedirs(self.capture_dir, exist_ok=True)
+        except OSError as exc:
+            print(f"[ERROR] failed to create capture dir {self.capture_dir}: {exc}")
+            return
+        self._writer = asyncio.create_task(self._writer_loop())
+
+    async def stop(self) -> None:
+        if self._writer is None:
+            return
+        self._writer.cancel()
+        try:
+            await self._writer
+        except asyncio.CancelledError:
+            pass
+        self._writer = None
+        await self.flush()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "sample_rate": self.sample_rate,
+            "redact_mode": self.redact_mode,
+            "capacity": self._ring.maxlen,
+            "buffered": len(self._ring),
+            "captured": self.captured,
+            "pending_writes": len(self._pending),
+            "written": self.written,
+            "dropped_writes": self.dropped_writes,
+            "capture_dir": self.capture_dir,
+        }
@@ -0,0 +1,332 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+try:  # tokenizers 为可选依赖，配置了 tokenizer 文件时用于精确计数
+    from tokenizers import Tokenizer
+except ImportError:  # pragma: no cover - 取决于部署环境
+    Tokenizer = None  # type: ignore[assignment]
+
+# none：只按提示词长度选择 num_ctx，不裁剪
+# oldest：超出上限时从最早的非 system 消息开始丢弃
+# images_first：先去掉较早消息中的图片，仍超出时再按 oldest 丢弃消息
+TRIM_POLICIES = {"none", "oldest", "images_first"}
+
+# 每条消息的角色标记、分隔符等模板开销（token）
+_MESSAGE_OVERHEAD = 4
+# 中日韩字符大多一个字一个 token，其余文本按约 4 字符一个 token 估算
+_CJK = re.compile(r"[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+def approx_tokens(text: str) -> int:
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class ContextModel:
+    """
+    单个模型的上下文配置：最大 num_ctx、每张图片的 token 开销、可选 tokenizer 文件，
+    以及 num_ctx 的下限 min_ctx（常驻模型可调高，避免档位增长触发重新加载）。
+    """
+
+    __slots__ = ("max_ctx", "image_tokens", "tokenizer_path", "trim", "min_ctx")
+
+    def __init__(
+        self,
+        max_ctx: int,
+        image_tokens: int,
+        tokenizer_path: Optional[str] = None,
+        trim: str = "images_first",
+        min_ctx: int = 0,
+    ) -> None:
+        if trim not in TRIM_POLICIES:
+            raise ValueError(
+                f"unknown trim policy {trim!r}, expected one of {sorted(TRIM_POLICIES)}"
+            )
+        self.max_ctx = max_ctx
+        self.image_tokens = image_tokens
+        self.tokenizer_path = tokenizer_path
+        self.trim = trim
+        self.min_ctx = min_ctx
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "max_ctx": self.max_ctx,
+            "min_ctx": self.min_ctx,
+            "image_tokens": self.image_tokens,
+            "tokenizer": self.tokenizer_path,
+            "trim": self.trim,
+        }
+
+
+def parse_context_models(raw: str, default: ContextModel) -> Dict[str, ContextModel]:
+    """
+    解析 CONTEXT_MODELS（JSON 对象），未列出的字段沿用默认配置，例如：
+    {"qwen3-vl:32b": {"max_ctx": 32768, "min_ctx": 8192, "tokenizer": "/models/qwen3/tokenizer.json"},
+     "gemma3:27b": {"max_ctx": 8192, "image_tokens": 256, "trim": "oldest"}}
+    """
+    if not raw.strip():
+        return {}
+    return {
+        model: ContextModel(
+            int(entry.get("max_ctx", default.max_ctx)),
+            int(entry.get("image_tokens", default.image_tokens)),
+            entry.get("tokenizer", default.tokenizer_path),
+            entry.get("trim", default.trim),
+            int(entry.get("min_ctx", default.min_ctx)),
+        )
+        for model, entry in json.loads(raw).items()
+    }
+
+
+class _ModelStats:
+    __slots__ = (
+        "requests",
+        "buckets",
+        "trimmed_messages",
+        "dropped_images",
+        "overflows",
+        "current_ctx",
+        "last_used",
+        "prompt_tokens",
+    )
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.buckets: Dict[int, int] = {}
+        self.trimmed_messages = 0
+        self.dropped_images = 0
+        self.overflows = 0
+        self.current_ctx = 0
+        self.last_used = 0.0
+        self.prompt_tokens = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "current_num_ctx": self.current_ctx,
+            "avg_prompt_tokens": round(self.prompt_tokens / self.requests, 1)
+            if self.requests
+            else 0.0,
+            "num_ctx_buckets": {str(k): v for k, v in sorted(self.buckets.items())},
+            "trimmed_messages": self.trimmed_messages,
+            "dropped_images": self.dropped_images,
+            "overflows": self.overflows,
+        }
+
+
+class ContextWindowManager:
+    """
+    按请求估算提示词 token 数，为 Ollama 选择能容纳“提示词 + max_tokens”的最小 num_ctx 档位，
+    超出模型上限时按策略裁剪历史（保留 system 消息与最新消息）。
+
+    只管理 CONTEXT_MODELS 中列出的模型，其余模型的请求原样转发（不设置 num_ctx、不裁剪），
+    default_model 只提供列出模型未填写字段的默认值。
+
+    Ollama 的 num_ctx 变化会导致模型重新加载，所以档位只升不降：
+    模型空闲 shrink_after 秒后才允许回到更小的档位。预加载模型时应使用 num_ctx_for
+    给出的值，与首个请求选择的档位一致。
+    """
+
+    def __init__(
+        self,
+        buckets: Iterable[int],
+        default_model: ContextModel,
+        models: Optional[Dict[str, ContextModel]] = None,
+        default_completion_tokens: int = 1024,
+        shrink_after: float = 300.0,
+        count_cache_size: int = 4096,
+    ) -> None:
+        self.buckets = sorted(set(buckets))
+        self.default_model = default_model
+        self.models = models or {}
+        self.default_completion_tokens = default_completion_tokens
+        self.shrink_after = shrink_after
+        self.tokenizers_available = Tokenizer is not None
+        self._tokenizers: Dict[str, Any] = {}
+        # (tokenizer 路径, 文本) -> token 数；会话模式下每轮重发的历史消息是同一批字符串
+        self._counts: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+        self._counts_lock = threading.Lock()
+        self._count_cache_size = count_cache_size
+        self._stats: Dict[str, _ModelStats] = {}
+        for model, config in self.models.items():
+            self._load_tokenizer(model, config)
+
+    def config_for(self, model: str) -> Optional[ContextModel]:
+        return self.models.get(model)
+
+    def num_ctx_for(self, model: str) -> Optional[int]:
+        """该模型下一个小请求会使用的 num_ctx；未配置的模型返回 None。"""
+        config = self.config_for(model)
+        if config is None:
+            return None
+        stats = self._stats.get(model)
+        if stats is not None and time.time() - stats.last_used < self.shrink_after:
+            return stats.current_ctx
+        return self._bucket_for(config.min_ctx, config.max_ctx)
+
+    def _load_tokenizer(self, model: str, config: ContextModel) -> None:
+        # 启动时加载并校验 tokenizer 文件，失败时退回近似估算
+        path = config.tokenizer_path
+        if not path or path in self._tokenizers:
+            return
+        if Tokenizer is None:
+            print(f"[WARN] tokenizers is not installed, approximate token counts for {model}")
+            return
+        try:
+            self._tokenizers[path] = Tokenizer.from_file(path)
+        except Exception as exc:
+            print(f"[WARN] failed to load tokenizer {path} for {model}: {exc}")
+
+    def _exact_tokens(self, tokenizer: Any, path: str, text: str) -> int:
+        key = (path, text)
+        with self._counts_lock:
+            cached = self._counts.get(key)
+            if cached is not None:
+                self._counts.move_to_end(key)
+                return cached
+        count = len(tokenizer.encode(text, add_special_tokens=False).ids)
+        with self._counts_lock:
+            self._counts[key] = count
+            while len(self._counts) > self._count_cache_size:
+                self._counts.popitem(last=False)
+        return count
+
+    def _message_tokens(
+        self, messages: List[Dict[str, Any]], config: ContextModel
+    ) -> List[int]:
+        tokenizer = self._tokenizers.get(config.tokenizer_path or "")
+        counts = []
+        for message in messages:
+            text = message.get("content") or ""
+            if tokenizer is not None:
+                tokens = self._exact_tokens(tokenizer, config.tokenizer_path, text)
+            else:
+                tokens = approx_tokens(text)
+            tokens += _MESSAGE_OVERHEAD + config.image_tokens * len(message.get("images") or ())
+            counts.append(tokens)
+        return counts
+
+    def _bucket_for(self, needed: int, limit: int) -> int:
+        for bucket in self.buckets:
+            if bucket >= needed and bucket <= limit:
+                return bucket
+        return limit
+
+    def _trim(
+        self,
+        messages: List[Dict[str, Any]],
+        counts: List[int],
+        budget: int,
+        config: ContextModel,
+        stats: _ModelStats,
+    ) -> Tuple[List[Dict[str, Any]], List[int]]:
+        """在 budget 以内保留尽量多的历史；system 消息与最新一条用户消息及其之后的消息始终保留。"""
+        total = sum(counts)
+        if total <= budget or config.trim == "none":
+            return messages, counts
+        messages = list(messages)
+        counts = list(counts)
+        # 最新一条用户消息中的图片是本轮提问的对象，不丢弃
+        current = max(
+            (i for i, m in enumerate(messages) if m.get("role") == "user"),
+            default=len(messages) - 1,
+        )
+        if config.trim == "images_first":
+            for index in range(len(messages)):
+                if total <= budget:
+                    break
+                if index == current:
+                    continue
+                images = messages[index].get("images")
+                if not images:
+                    continue
+                messages[index] = {k: v for k, v in messages[index].items() if k != "images"}
+                saved = config.image_tokens * len(images)
+                counts[index] -= saved
+                total -= saved
+                stats.dropped_images += len(images)
+        # 从最早的一轮开始整轮丢弃（user 及其后的 assistant/tool 消息一起），
+        # system 消息、最新一条用户消息及其之后的消息始终保留
+        index = 0
+        while total > budget and index < current:
+            if messages[index].get("role") == "system":
+                index += 1
+                continue
+            end = index + 1
+            while end < current and messages[end].get("role") not in ("user", "system"):
+                end += 1
+            total -= sum(counts[index:end])
+            stats.trimmed_messages += end - index
+            del messages[index:end]
+            del counts[index:end]
+            current -= end - index
+        return messages, counts
+
+    def _fit(self, payload: Dict[str, Any], config: ContextModel, counts: List[int]) -> None:
+        model = payload["model"]
+        stats = self._stats.setdefault(model, _ModelStats())
+        options = payload.setdefault("options", {})
+        completion = options.get("num_predict")
+        if completion is None or completion < 0:
+            completion = self.default_completion_tokens
+        # 客户端显式指定的 num_ctx 优先，仍按它裁剪历史
+        limit = int(options.get("num_ctx") or config.max_ctx)
+        messages = payload.get("messages") or []
+        # 为生成预留的 token 最多占窗口的一半，否则 num_predict 过大时历史会被裁空
+        budget = limit - min(completion, limit // 2)
+        messages, counts = self._trim(messages, counts, budget, config, stats)
+        payload["messages"] = messages
+        prompt_tokens = sum(counts)
+        needed = prompt_tokens + completion
+        if needed > limit:
+            stats.overflows += 1
+            print(
+                f"[WARN] prompt for {model} needs ~{needed} tokens, "
+                f"exceeds context window {limit} after trimming"
+            )
+        if "num_ctx" not in options:
+            num_ctx = self._bucket_for(max(needed, config.min_ctx), limit)
+            now = time.time()
+            if now - stats.last_used < self.shrink_after and stats.current_ctx > num_ctx:
+                num_ctx = min(stats.current_ctx, limit)
+            options["num_ctx"] = num_ctx
+            stats.current_ctx = num_ctx
+            stats.last_used = now
+        stats.requests += 1
+        stats.prompt_tokens += prompt_tokens
+        stats.buckets[options["num_ctx"]] = stats.buckets.get(options["num_ctx"], 0) + 1
+
+    async def apply(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """就地设置 payload 的 options.num_ctx，必要时裁剪 messages；未配置的模型不做处理。"""
+        config = self.config_for(payload["model"])
+        if config is None:
+            return payload
+        messages = payload.get("messages") or []
+        if config.tokenizer_path in self._tokenizers:
+            # 精确分词是 CPU 密集操作，放到线程中执行；裁剪与统计仍在事件循环线程中完成
+            counts = await asyncio.to_thread(self._message_tokens, messages, config)
+        else:
+            counts = self._message_tokens(messages, config)
+        self._fit(payload, config, counts)
+        return payload
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "buckets": self.buckets,
+            "default": self.default_model.snapshot(),
+            "models": {model: config.snapshot() for model, config in self.models.items()},
+            "tokenizers_available": self.tokenizers_available,
+            "tokenizers_loaded": sorted(self._tokenizers),
+            "default_completion_tokens": self.default_completion_tokens,
+            "shrink_after_s": self.shrink_after,
+            "by_model": {model: stats.snapshot() for model, stats in self._stats.items()},
+        }
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+# 一次上游调用：(model, texts) -> (每条文本的向量, 本批 prompt token 数)
+EmbedSender = Callable[[str, List[str]], Awaitable[Tuple[List[List[float]], int]]]
+# 单条结果：(向量, 按文本长度分摊的 token 数)
+EmbeddingResult = Tuple[List[float], int]
+
+
+class EmbeddingCache:
+    """以 (模型, 文本 sha256) 为键的 LRU，按条目数限额。"""
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], EmbeddingResult]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(model: str, text: str) -> Tuple[str, str]:
+        return model, hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, model: str, text: str) -> Optional[EmbeddingResult]:
+        key = self.key(model, text)
+        result = self._entries.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, model: str, text: str, result: EmbeddingResult) -> None:
+        key = self.key(model, text)
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class _ModelQueue:
+    __slots__ = ("pending", "timer")
+
+    def __init__(self) -> None:
+        # 同一批次内相同文本只发送一次，多个调用方共享同一个 Future
+        self.pending: "OrderedDict[str, asyncio.Future[EmbeddingResult]]" = OrderedDict()
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class EmbeddingBatcher:
+    """
+    动态微批：同一模型的并发请求在 max_wait 窗口内汇总为一次 /api/embed 调用，
+    凑满 max_batch 条立即发送，结果再按文本拆分回各个调用方。
+    """
+
+    def __init__(
+        self,
+        send: EmbedSender,
+        max_batch: int = 64,
+        max_wait: float = 0.01,
+        cache: Optional[EmbeddingCache] = None,
+    ) -> None:
+        self.send = send
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self.cache = cache
+        self._queues: Dict[str, _ModelQueue] = {}
+        self._inflight: set = set()
+        self.requests = 0
+        self.texts = 0
+        self.batches = 0
+        self.batched_texts = 0
+        self.max_batch_seen = 0
+        self.upstream_seconds = 0.0
+        self.errors = 0
+
+    async def embed(self, model: str, texts: List[str]) -> List[EmbeddingResult]:
+        self.requests += 1
+        self.texts += len(texts)
+        results: List[Optional[EmbeddingResult]] = [None] * len(texts)
+        waiting: List[Tuple[int, "asyncio.Future[EmbeddingResult]"]] = []
+        for index, text in enumerate(texts):
+            cached = self.cache.get(model, text) if self.cache is not None else None
+            if cached is not None:
+                results[index] = cached
+            else:
+                waiting.append((index, self._enqueue(model, text)))
+        if waiting:
+            # shield：单个调用方取消不影响同批次的其他调用方
+            values = await asyncio.gather(*(asyncio.shield(future) for _, future in waiting))
+            for (index, _), value in zip(waiting, values):
+                results[index] = value
+        return results  # type: ignore[return-value]
+
+    def _enqueue(self, model: str, text: str) -> "asyncio.Future[EmbeddingResult]":
+        queue = self._queues.get(model)
+        if queue is None:
+            queue = self._queues[model] = _ModelQueue()
+        future = queue.pending.get(text)
+        if future is not None:
+            return future
+        future = asyncio.get_running_loop().create_future()
+        queue.pending[text] = future
+        if len(queue.pending) >= self.max_batch:
+            self._flush(model)
+        elif queue.timer is None:
+            queue.timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush, model)
+        return future
+
+    def _flush(self, model: str) -> None:
+        queue = self._queues.get(model)
+        if queue is None:
+            return
+        if queue.timer is not None:
+            queue.timer.cancel()
+            queue.timer = None
+        while queue.pending:
+            batch: List[Tuple[str, "asyncio.Future[EmbeddingResult]"]] = []
+            while queue.pending and len(batch) < self.max_batch:
+                batch.append(queue.pending.popitem(last=False))
+            task = asyncio.create_task(self._run_batch(model, batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _run_batch(
+        self, model: str, batch: List[Tuple[str, "asyncio.Future[EmbeddingResult]"]]
+    ) -> None:
+        texts = [text for text, _ in batch]
+        self.batches += 1
+        self.batched_texts += len(texts)
+        self.max_batch_seen = max(self.max_batch_seen, len(texts))
+        started = time.perf_counter()
+        try:
+            vectors, prompt_tokens = await self.send(model, texts)
+            if len(vectors) != len(texts):
+                raise RuntimeError(
+                    f"Ollama returned {len(vectors)} embeddings for {len(texts)} inputs"
+                )
+        except Exception as exc:
+            self.errors += 1
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+                    # 调用方都已取消时避免 "exception was never retrieved" 警告
+                    future.exception()
+            return
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        finally:
+            self.upstream_seconds += time.perf_counter() - started
+
+        # Ollama 只返回整批的 token 数，按文本长度分摊给每条输入
+        total_chars = sum(len(text) for text in texts) or 1
+        for (text, future), vector in zip(batch, vectors):
+            result = (vector, round(prompt_tokens * len(text) / total_chars))
+            if self.cache is not None:
+                self.cache.put(model, text, result)
+            if not future.done():
+                future.set_result(result)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "max_batch": self.max_batch,
+            "max_wait_ms": round(self.max_wait * 1000, 3),
+            "requests": self.requests,
+            "texts": self.texts,
+            "upstream_batches": self.batches,
+            "avg_batch_size": round(self.batched_texts / self.batches, 2) if self.batches else 0.0,
+            "max_batch_size": self.max_batch_seen,
+            "upstream_avg_ms": (
+                round(self.upstream_seconds / self.batches * 1000, 2) if self.batches else 0.0
+            ),
+            "errors": self.errors,
+            "cache": self.cache.snapshot() if self.cache is not None else None,
+        }
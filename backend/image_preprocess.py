@@ -0,0 +1,326 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import io
+import json
+import math
+import os
+import time
+import uuid
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from backend.image_store import ImageStore
+
+try:  # Pillow 为可选依赖，未安装时图片原样发送
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover - 取决于部署环境
+    Image = None  # type: ignore[assignment]
+    ImageOps = None  # type: ignore[assignment]
+
+OUTPUT_FORMATS = {"jpeg", "webp", "png"}
+
+# Image.info 中属于元数据（而非解码参数）的字段
+_METADATA_KEYS = {"exif", "xmp", "XML:com.adobe.xmp", "comment", "photoshop"}
+
+
+class ImagePolicy:
+    """单个模型的图片预处理参数：像素上限、输出格式与质量。"""
+
+    __slots__ = ("max_pixels", "format", "quality")
+
+    def __init__(self, max_pixels: int, format: str = "jpeg", quality: int = 85) -> None:
+        format = format.lower()
+        if format not in OUTPUT_FORMATS:
+            raise ValueError(
+                f"unsupported image format {format!r}, expected one of {sorted(OUTPUT_FORMATS)}"
+            )
+        self.max_pixels = max_pixels
+        self.format = format
+        self.quality = quality
+
+    @property
+    def key(self) -> str:
+        return f"{self.max_pixels}-{self.format}-{self.quality}"
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"max_pixels": self.max_pixels, "format": self.format, "quality": self.quality}
+
+
+def parse_image_policies(raw: str, default: ImagePolicy) -> Dict[str, Optional[ImagePolicy]]:
+    """
+    解析 IMAGE_MODEL_POLICIES（JSON 对象），未列出的字段沿用默认策略，
+    值为 null 表示该模型不做预处理，例如：
+    {"gemma3:27b": {"max_pixels": 802816}, "qwen2.5vl:32b": {"format": "webp", "quality": 80}}
+    """
+    if not raw.strip():
+        return {}
+    policies: Dict[str, Optional[ImagePolicy]] = {}
+    for model, entry in json.loads(raw).items():
+        if not entry:
+            policies[model] = None
+            continue
+        policies[model] = ImagePolicy(
+            int(entry.get("max_pixels", default.max_pixels)),
+            entry.get("format", default.format),
+            int(entry.get("quality", default.quality)),
+        )
+    return policies
+
+
+def _to_rgb(image: Any) -> Any:
+    # JPEG 不支持透明通道，透明区域铺白底
+    if image.mode in ("RGB", "L"):
+        return image
+    if "A" in image.getbands() or image.mode == "P":
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    return image.convert("RGB")
+
+
+def _has_metadata(image: Any) -> bool:
+    # EXIF（含方向标记）、XMP、注释以及 PNG 文本块（如生成参数）都算元数据
+    if image.getexif() or _METADATA_KEYS.intersection(image.info):
+        return True
+    return bool(getattr(image, "text", None))
+
+
+def preprocess_image(data: bytes, policy: ImagePolicy) -> Tuple[bytes, Dict[str, Any]]:
+    """
+    按像素预算缩放并重新编码图片，重新编码时不写入 EXIF 等元数据。
+    原图未缩放、不带元数据且重新编码后反而更大时保留原图。返回 (图片字节, 处理信息)。
+    """
+    with Image.open(io.BytesIO(data)) as source:
+        width, height = source.size
+        has_metadata = _has_metadata(source)
+        scale = min(1.0, math.sqrt(policy.max_pixels / float(width * height)))
+        if scale < 1.0 and source.format == "JPEG":
+            # JPEG 可在解码阶段按 1/2、1/4、1/8 降采样（不会小于目标尺寸），大幅减少解码耗时
+            source.draft("RGB", (int(width * scale), int(height * scale)))
+        # 先按 EXIF 方向旋转，再丢弃元数据
+        image = ImageOps.exif_transpose(source)
+        current_width, current_height = image.size
+        remaining = math.sqrt(policy.max_pixels / float(current_width * current_height))
+        if remaining < 1.0:
+            target = (
+                max(1, int(current_width * remaining)),
+                max(1, int(current_height * remaining)),
+            )
+            resample = getattr(Image, "Resampling", Image).LANCZOS
+            image = image.resize(target, resample)
+
+        if policy.format == "jpeg":
+            image = _to_rgb(image)
+
+        buffer = io.BytesIO()
+        if policy.format == "jpeg":
+            image.save(buffer, "JPEG", quality=policy.quality, optimize=True)
+        elif policy.format == "webp":
+            image.save(buffer, "WEBP", quality=policy.quality, method=4)
+        else:
+            image.save(buffer, "PNG", optimize=True)
+        encoded = buffer.getvalue()
+        info = {
+            "original_size": [width, height],
+            "sent_size": list(image.size),
+            "resized": scale < 1.0,
+            "kept_original": False,
+        }
+
+    # 带元数据（尤其是 EXIF 方向）的原图不能原样发送：既泄露元数据，方向也未校正
+    if scale >= 1.0 and not has_metadata and len(encoded) >= len(data):
+        info["kept_original"] = True
+        return data, info
+    return encoded, info
+
+
+def make_thumbnail(data: bytes, size: int, quality: int = 80) -> bytes:
+    """按 EXIF 方向旋转后等比缩小到 size x size 以内，编码为 JPEG。"""
+    with Image.open(io.BytesIO(data)) as source:
+        if source.format == "JPEG":
+            source.draft("RGB", (size, size))
+        image = ImageOps.exif_transpose(source)
+        image.thumbnail((size, size), getattr(Image, "Resampling", Image).LANCZOS)
+        buffer = io.BytesIO()
+        _to_rgb(image).save(buffer, "JPEG", quality=quality, optimize=True)
+        return buffer.getvalue()
+
+
+class ThumbnailCache:
+    """
+    聊天记录预览用的缩略图：按需生成，落盘到 thumb_dir 后直接复用；
+    同一缩略图的并发请求只生成一次。尺寸限定在 sizes 中，避免缓存被任意尺寸撑大。
+    """
+
+    def __init__(self, image_store: ImageStore, thumb_dir: str, sizes: Iterable[int]) -> None:
+        self.image_store = image_store
+        self.thumb_dir = thumb_dir
+        self.sizes = sorted(set(sizes))
+        self.available = Image is not None
+        self._pending: Dict[str, "asyncio.Future[str]"] = {}
+        self.counters: Dict[str, int] = {"generated": 0, "disk_hits": 0, "failures": 0}
+
+    @staticmethod
+    def thumb_name(filename: str, size: int) -> str:
+        return f"{os.path.splitext(os.path.basename(filename))[0]}-{size}.jpg"
+
+    def path_for(self, filename: str, size: int) -> str:
+        return os.path.join(self.thumb_dir, self.thumb_name(filename, size))
+
+    def _generate(self, filename: str, size: int) -> Tuple[str, bool]:
+        path = self.path_for(filename, size)
+        if os.path.exists(path):
+            return path, False
+        with open(self.image_store.path_for(filename), "rb") as f:
+            data = f.read()
+        thumbnail = make_thumbnail(data, size)
+        os.makedirs(self.thumb_dir, exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(thumbnail)
+        os.replace(tmp_path, path)
+        return path, True
+
+    async def _create(self, filename: str, size: int) -> str:
+        try:
+            path, created = await self.image_store.run_in_worker(self._generate, filename, size)
+        except OSError:
+            raise
+        except Exception as exc:  # Pillow 无法识别的图片
+            self.counters["failures"] += 1
+            raise ValueError(f"cannot create thumbnail for {filename}: {exc}") from exc
+        self.counters["generated" if created else "disk_hits"] += 1
+        return path
+
+    async def get(self, filename: str, size: int) -> str:
+        """返回缩略图路径；原图不存在时抛出 FileNotFoundError，无法解码时抛出 ValueError。"""
+        key = self.thumb_name(filename, size)
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._create(filename, size))
+            self._pending[key] = task
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        # 单个请求断开不应取消其他请求共享的生成任务
+        return await asyncio.shield(task)
+
+    def _remove(self, filename: str) -> None:
+        for size in self.sizes:
+            try:
+                os.remove(self.path_for(filename, size))
+            except FileNotFoundError:
+                pass
+
+    async def remove(self, filename: str) -> None:
+        await self.image_store.run_in_worker(self._remove, filename)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "available": self.available,
+            "sizes": self.sizes,
+            "thumb_dir": self.thumb_dir,
+            **self.counters,
+        }
+
+
+class ImagePreprocessor:
+    """
+    发送给 VL 模型前的图片预处理：在 ImageStore 的工作线程池中缩放/重新编码，
+    结果的 base64 以“内容哈希 + 策略”为键放入 ImageStore 的 LRU，同一图片在多轮对话中只处理一次。
+    """
+
+    def __init__(
+        self,
+        image_store: ImageStore,
+        default_policy: ImagePolicy,
+        model_policies: Optional[Dict[str, Optional[ImagePolicy]]] = None,
+        enabled: bool = True,
+    ) -> None:
+        self.image_store = image_store
+        self.default_policy = default_policy
+        self.model_policies = model_policies or {}
+        self.available = Image is not None
+        self.enabled = enabled and self.available
+        if enabled and not self.available:
+            print("[WARN] Pillow is not installed, image preprocessing disabled")
+        self.counters: Dict[str, int] = {
+            "processed": 0,
+            "cache_hits": 0,
+            "resized": 0,
+            "kept_original": 0,
+            "failures": 0,
+        }
+        self.original_bytes = 0
+        self.sent_bytes = 0
+        self.seconds = 0.0
+
+    def policy_for(self, model: str) -> Optional[ImagePolicy]:
+        if not self.enabled:
+            return None
+        return self.model_policies.get(model, self.default_policy)
+
+    def _read_and_process(
+        self, filename: str, policy: ImagePolicy
+    ) -> Tuple[str, int, int, Dict[str, Any]]:
+        with open(self.image_store.path_for(filename), "rb") as f:
+            data = f.read()
+        try:
+            processed, info = preprocess_image(data, policy)
+        except Exception as exc:  # Pillow 无法识别的图片原样发送
+            processed, info = data, {"error": str(exc)}
+        return base64.b64encode(processed).decode("ascii"), len(data), len(processed), info
+
+    async def load_base64(self, filename: str, model: str) -> str:
+        """返回发送给 model 的图片 base64；无需预处理时等同于 ImageStore.load_base64。"""
+        policy = self.policy_for(model)
+        if policy is None:
+            return await self.image_store.load_base64(filename)
+        key = f"{self.image_store.cache_key(filename)}@{policy.key}"
+        cached = self.image_store.get_cached_base64(key)
+        if cached is not None:
+            self.counters["cache_hits"] += 1
+            return cached
+
+        started = time.perf_counter()
+        encoded, original, sent, info = await self.image_store.run_in_worker(
+            self._read_and_process, filename, policy
+        )
+        self.seconds += time.perf_counter() - started
+        if "error" in info:
+            self.counters["failures"] += 1
+            print(
+                f"[WARN] image preprocessing failed for {filename}, "
+                f"sending original: {info['error']}"
+            )
+        else:
+            self.counters["processed"] += 1
+            self.counters["resized"] += int(info["resized"])
+            self.counters["kept_original"] += int(info["kept_original"])
+            print(
+                f"[DEBUG] preprocessed {filename} for {model}: "
+                f"{info['original_size']}->{info['sent_size']} bytes {original}->{sent}"
+            )
+        self.original_bytes += original
+        self.sent_bytes += sent
+        self.image_store.remember_base64(key, encoded)
+        return encoded
+
+    def snapshot(self) -> Dict[str, Any]:
+        processed = self.counters["processed"] + self.counters["failures"]
+        return {
+            "enabled": self.enabled,
+            "pillow_available": self.available,
+            "default_policy": self.default_policy.snapshot(),
+            "model_policies": {
+                model: policy.snapshot() if policy else None
+                for model, policy in self.model_policies.items()
+            },
+            **self.counters,
+            "original_bytes": self.original_bytes,
+            "sent_bytes": self.sent_bytes,
+            "saved_ratio": round(1 - self.sent_bytes / self.original_bytes, 4)
+            if self.original_bytes
+            else 0.0,
+            "avg_ms": round(self.seconds / processed * 1000, 2) if processed else 0.0,
+        }
@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from backend.image_store import ImageStore
+
+# (文件名, 字节数, mtime)
+FileEntry = Tuple[str, int, float]
+
+
+# 超过该时长仍未完成的 .tmp 文件视为中断的上传/写入留下的残留
+_STALE_TEMP_SECONDS = 3600.0
+
+
+def _scan(image_dir: str) -> Tuple[List[FileEntry], List[str]]:
+    """列出 image_dir 下的图片文件，并单独返回过期的临时文件。"""
+    files: List[FileEntry] = []
+    stale: List[str] = []
+    now = time.time()
+    with os.scandir(image_dir) as entries:
+        for entry in entries:
+            if entry.name.startswith(".") or not entry.is_file(follow_symlinks=False):
+                continue
+            stat = entry.stat(follow_symlinks=False)
+            if entry.name.endswith(".tmp"):
+                if now - stat.st_mtime > _STALE_TEMP_SECONDS:
+                    stale.append(entry.name)
+                continue
+            files.append((entry.name, stat.st_size, stat.st_mtime))
+    return files, stale
+
+
+def _remove_files(image_dir: str, names: List[str]) -> List[str]:
+    removed: List[str] = []
+    for name in names:
+        try:
+            os.remove(os.path.join(image_dir, name))
+        except FileNotFoundError:
+            pass
+        except OSError as exc:
+            print(f"[WARN] failed to remove image {name}: {exc}")
+            continue
+        removed.append(name)
+    return removed
+
+
+class ImageRetention:
+    """
+    IMAGE_DIR 的后台清理：超过 max_age 未被访问的图片删除；总大小超过 max_bytes 时
+    按最近访问时间从旧到新淘汰。存活会话和在途请求引用的图片（protected() 返回的文件名）
+    以及 grace 秒内访问过的图片永远不会被删除。
+    """
+
+    def __init__(
+        self,
+        image_store: ImageStore,
+        protected: Callable[[], Set[str]],
+        max_age: float,
+        max_bytes: int,
+        interval: float = 600.0,
+        grace: float = 900.0,
+        on_remove: Optional[Callable[[str], Awaitable[None]]] = None,
+    ) -> None:
+        self.image_store = image_store
+        self.protected = protected
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.grace = grace
+        self.on_remove = on_remove
+        self._task: Optional[asyncio.Task] = None
+        self.counters: Dict[str, int] = {
+            "sweeps": 0,
+            "expired": 0,
+            "evicted": 0,
+            "removed_bytes": 0,
+            "temp_removed": 0,
+        }
+        self.files = 0
+        self.total_bytes = 0
+        self.last_sweep: Optional[float] = None
+
+    def _select(self, files: List[FileEntry]) -> Tuple[List[str], List[str]]:
+        """在事件循环线程中按最新的访问时间和引用挑选要删除的文件，返回 (过期, 超额淘汰)。"""
+        now = time.time()
+        protected = self.protected() | self.image_store.pinned()
+        candidates: List[Tuple[float, str, int]] = []
+        total = 0
+        for name, size, mtime in files:
+            total += size
+            last_access = self.image_store.last_access(name) or mtime
+            if name in protected or now - last_access < self.grace:
+                continue
+            candidates.append((last_access, name, size))
+        candidates.sort()
+
+        expired: List[str] = []
+        evicted: List[str] = []
+        remaining: List[Tuple[float, str, int]] = []
+        for last_access, name, size in candidates:
+            if self.max_age > 0 and now - last_access > self.max_age:
+                expired.append(name)
+                total -= size
+            else:
+                remaining.append((last_access, name, size))
+        if self.max_bytes > 0:
+            for _, name, size in remaining:
+                if total <= self.max_bytes:
+                    break
+                evicted.append(name)
+                total -= size
+        return expired, evicted
+
+    async def sweep(self) -> Dict[str, Any]:
+        image_dir = self.image_store.image_dir
+        files, stale = await self.image_store.run_in_worker(_scan, image_dir)
+        sizes = {name: size for name, size, _ in files}
+        expired, evicted = self._select(files)
+        removed = await self.image_store.run_in_worker(
+            _remove_files, image_dir, expired + evicted
+        )
+        removed_set = set(removed)
+        for name in removed:
+            self.image_store.forget(name)
+            self.counters["removed_bytes"] += sizes[name]
+            if self.on_remove is not None:
+                await self.on_remove(name)
+        self.counters["expired"] += sum(1 for name in expired if name in removed_set)
+        self.counters["evicted"] += sum(1 for name in evicted if name in removed_set)
+        if stale:
+            self.counters["temp_removed"] += len(
+                await self.image_store.run_in_worker(_remove_files, image_dir, stale)
+            )
+        self.counters["sweeps"] += 1
+        self.files = len(files) - len(removed)
+        self.total_bytes = sum(sizes.values()) - sum(sizes[name] for name in removed)
+        self.last_sweep = time.time()
+        if removed:
+            print(
+                f"[INFO] image retention removed {len(removed)} files, "
+                f"{self.files} files / {self.total_bytes} bytes remain"
+            )
+        return {"removed": removed, "files": self.files, "bytes": self.total_bytes}
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.sweep()
+            except OSError as exc:
+                print(f"[WARN] image retention sweep failed: {exc}")
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task is None and self.interval > 0 and (self.max_age > 0 or self.max_bytes > 0):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": self._task is not None,
+            "max_age_s": self.max_age,
+            "max_bytes": self.max_bytes,
+            "grace_s": self.grace,
+            "interval_s": self.interval,
+            "files": self.files,
+            "bytes": self.total_bytes,
+            "last_sweep": self.last_sweep,
+            **self.counters,
+        }
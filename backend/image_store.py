@@ -0,0 +1,271 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import hashlib
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Executor
+from typing import IO, Any, AsyncIterator, Callable, Dict, Iterable, Optional, Set, Tuple, TypeVar
+
+T = TypeVar("T")
+
+_CONTENT_ADDRESSED_NAME = re.compile(r"^img-([0-9a-f]{64})\.[A-Za-z0-9]+$")
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+class UnsupportedImage(ValueError):
+    pass
+
+
+def sniff_extension(head: bytes) -> Optional[str]:
+    """按文件头识别图片格式，不信任客户端声明的 Content-Type。"""
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return ".png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return ".jpg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    return None
+
+
+class _StreamingWrite:
+    """上传写入状态：临时文件与增量哈希，只在工作线程中操作。"""
+
+    def __init__(self, tmp_path: str) -> None:
+        self.tmp_path = tmp_path
+        self.file: IO[bytes] = open(tmp_path, "wb")
+        self.hasher = hashlib.sha256()
+
+    def write(self, chunk: bytes) -> None:
+        self.file.write(chunk)
+        self.hasher.update(chunk)
+
+    def abort(self) -> None:
+        self.file.close()
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class ImageStore:
+    """
+    以内容哈希命名的图片存储：相同图片只写一次、URL 稳定；
+    并用按字节数限额的 LRU 缓存 base64 编码结果，避免每轮对话重复读盘和编码。
+
+    解码、哈希、编码与文件读写都在 executor 中执行，不阻塞事件循环；
+    LRU 与计数器只在事件循环线程中修改。
+    """
+
+    def __init__(
+        self,
+        image_dir: str,
+        base_url: str,
+        cache_max_bytes: int,
+        executor: Optional[Executor] = None,
+    ) -> None:
+        self.image_dir = image_dir
+        self.executor = executor
+        self.base_url = base_url.rstrip("/")
+        self.cache_max_bytes = cache_max_bytes
+        self._b64_cache: "OrderedDict[str, str]" = OrderedDict()
+        self._cache_bytes = 0
+        # 最近访问时间（读/写/对外提供下载），清理时按此做 LRU；重启后缺失的文件按 mtime 处理
+        self._last_access: Dict[str, float] = {}
+        # 正在被请求使用的图片引用计数，清理时跳过
+        self._pins: Dict[str, int] = {}
+        self.counters: Dict[str, int] = {
+            "writes": 0,
+            "dedup_hits": 0,
+            "b64_hits": 0,
+            "b64_misses": 0,
+            "b64_evictions": 0,
+            "uploads": 0,
+            "upload_bytes": 0,
+        }
+
+    @staticmethod
+    def digest(image_bytes: bytes) -> str:
+        return hashlib.sha256(image_bytes).hexdigest()
+
+    @staticmethod
+    def filename_for(digest: str, extension: str) -> str:
+        return f"img-{digest}{extension}"
+
+    @staticmethod
+    def digest_from_filename(filename: str) -> Optional[str]:
+        match = _CONTENT_ADDRESSED_NAME.match(filename)
+        return match.group(1) if match else None
+
+    def path_for(self, filename: str) -> str:
+        return os.path.join(self.image_dir, os.path.basename(filename))
+
+    def url_for(self, filename: str) -> str:
+        return f"{self.base_url}/{filename}"
+
+    def cache_key(self, filename: str) -> str:
+        # 内容寻址的文件按哈希缓存；历史遗留的时间戳文件名按文件名缓存
+        return self.digest_from_filename(filename) or filename
+
+    def touch(self, filename: str) -> None:
+        self._last_access[os.path.basename(filename)] = time.time()
+
+    def last_access(self, filename: str) -> Optional[float]:
+        return self._last_access.get(filename)
+
+    def pin(self, filenames: Iterable[str]) -> None:
+        for filename in filenames:
+            self._pins[filename] = self._pins.get(filename, 0) + 1
+
+    def unpin(self, filenames: Iterable[str]) -> None:
+        for filename in filenames:
+            count = self._pins.get(filename, 0) - 1
+            if count > 0:
+                self._pins[filename] = count
+            else:
+                self._pins.pop(filename, None)
+
+    def pinned(self) -> Set[str]:
+        return set(self._pins)
+
+    def forget(self, filename: str) -> None:
+        """图片文件被删除后清掉访问记录和它的 base64 缓存（含各预处理策略的变体）。"""
+        self._last_access.pop(filename, None)
+        key = self.cache_key(filename)
+        for cached_key in [k for k in self._b64_cache if k == key or k.startswith(f"{key}@")]:
+            self._cache_bytes -= len(self._b64_cache.pop(cached_key))
+
+    async def run_in_worker(self, fn: Callable[..., T], *args: Any) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    def _write_if_missing(self, image_bytes: bytes, extension: str) -> Tuple[str, str, bool]:
+        digest = self.digest(image_bytes)
+        filename = self.filename_for(digest, extension)
+        path = self.path_for(filename)
+        if os.path.exists(path):
+            return filename, digest, False
+
+        # 先写临时文件再原子替换，避免并发读到半个文件
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(image_bytes)
+        os.replace(tmp_path, path)
+        return filename, digest, True
+
+    async def save(self, image_bytes: bytes, extension: str) -> Tuple[str, str]:
+        """写入图片（已存在则跳过），返回 (filename, digest)。"""
+        filename, digest, created = await self.run_in_worker(
+            self._write_if_missing, image_bytes, extension
+        )
+        self.counters["writes" if created else "dedup_hits"] += 1
+        self.touch(filename)
+        return filename, digest
+
+    def _finish_stream(self, writer: _StreamingWrite, extension: str) -> Tuple[str, str, bool]:
+        writer.file.close()
+        digest = writer.hasher.hexdigest()
+        filename = self.filename_for(digest, extension)
+        path = self.path_for(filename)
+        if os.path.exists(path):
+            os.remove(writer.tmp_path)
+            return filename, digest, False
+        os.replace(writer.tmp_path, path)
+        return filename, digest, True
+
+    async def save_stream(
+        self, chunks: AsyncIterator[bytes], max_bytes: int
+    ) -> Tuple[str, str, int, bool]:
+        """
+        分块写入上传的图片，边写边计算哈希，完成后按内容哈希重命名（已存在则丢弃临时文件）。
+        返回 (filename, digest, size, created)；超过 max_bytes 抛出 ImageTooLarge，
+        文件头不是 PNG/JPEG/WebP 时抛出 UnsupportedImage，两种情况都会删除临时文件。
+        """
+        tmp_path = self.path_for(f"upload-{uuid.uuid4().hex}.tmp")
+        writer = await self.run_in_worker(_StreamingWrite, tmp_path)
+        head = b""
+        extension: Optional[str] = None
+        size = 0
+        try:
+            async for chunk in chunks:
+                if not chunk:
+                    continue
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ImageTooLarge(f"image exceeds {max_bytes} bytes")
+                if extension is None and len(head) < 16:
+                    head += chunk[: 16 - len(head)]
+                    if len(head) >= 12:
+                        extension = sniff_extension(head)
+                        if extension is None:
+                            raise UnsupportedImage("only PNG, JPEG and WebP images are accepted")
+                await self.run_in_worker(writer.write, chunk)
+            if extension is None:
+                extension = sniff_extension(head)
+            if extension is None:
+                raise UnsupportedImage("only PNG, JPEG and WebP images are accepted")
+            filename, digest, created = await self.run_in_worker(
+                self._finish_stream, writer, extension
+            )
+        except BaseException:
+            await self.run_in_worker(writer.abort)
+            raise
+        self.counters["uploads"] += 1
+        self.counters["upload_bytes"] += size
+        self.counters["writes" if created else "dedup_hits"] += 1
+        self.touch(filename)
+        return filename, digest, size, created
+
+    def get_cached_base64(self, key: str) -> Optional[str]:
+        encoded = self._b64_cache.get(key)
+        if encoded is None:
+            self.counters["b64_misses"] += 1
+            return None
+        self._b64_cache.move_to_end(key)
+        self.counters["b64_hits"] += 1
+        return encoded
+
+    def remember_base64(self, key: str, encoded: str) -> None:
+        size = len(encoded)
+        if size > self.cache_max_bytes:
+            return
+        previous = self._b64_cache.pop(key, None)
+        if previous is not None:
+            self._cache_bytes -= len(previous)
+        self._b64_cache[key] = encoded
+        self._cache_bytes += size
+        while self._cache_bytes > self.cache_max_bytes and self._b64_cache:
+            _, evicted = self._b64_cache.popitem(last=False)
+            self._cache_bytes -= len(evicted)
+            self.counters["b64_evictions"] += 1
+
+    def _read_and_encode(self, filename: str) -> str:
+        with open(self.path_for(filename), "rb") as f:
+            image_bytes = f.read()
+        return base64.b64encode(image_bytes).decode("ascii")
+
+    async def load_base64(self, filename: str) -> str:
+        """读取并编码本地图片，结果进入 LRU；文件不存在或读取失败时抛出 OSError。"""
+        key = self.cache_key(filename)
+        cached = self.get_cached_base64(key)
+        if cached is not None:
+            return cached
+        encoded = await self.run_in_worker(self._read_and_encode, filename)
+        self.remember_base64(key, encoded)
+        return encoded
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "b64_entries": len(self._b64_cache),
+            "b64_bytes": self._cache_bytes,
+            "b64_max_bytes": self.cache_max_bytes,
+            "pinned": len(self._pins),
+        }
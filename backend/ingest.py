@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import json
+import resource
+import sys
+import time
+from typing import Any, Dict, List
+
+from starlette.requests import Request
+
+try:  # orjson 为可选依赖：解析/序列化更快，且直接产出 bytes，少一次编码拷贝
+    import orjson
+except ImportError:  # pragma: no cover - 取决于部署环境
+    orjson = None  # type: ignore[assignment]
+
+JSON_BACKEND = "orjson" if orjson is not None else "json"
+
+
+def loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class IngestError(ValueError):
+    def __init__(self, status_code: int, detail: Any) -> None:
+        super().__init__(str(detail))
+        self.status_code = status_code
+        self.detail = detail
+
+
+def _peak_rss_bytes() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 返回 KB，macOS 返回字节
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class IngestStats:
+    """请求体读取与解析的耗时、体积，以及进程峰值 RSS。"""
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.body_bytes = 0
+        self.max_body_bytes = 0
+        self.parse_seconds = 0.0
+        self.max_parse_seconds = 0.0
+
+    def record(self, body_bytes: int, parse_seconds: float) -> None:
+        self.requests += 1
+        self.body_bytes += body_bytes
+        self.max_body_bytes = max(self.max_body_bytes, body_bytes)
+        self.parse_seconds += parse_seconds
+        self.max_parse_seconds = max(self.max_parse_seconds, parse_seconds)
+
+    def snapshot(self) -> Dict[str, Any]:
+        avg = self.parse_seconds / self.requests if self.requests else 0.0
+        return {
+            "json_backend": JSON_BACKEND,
+            "requests": self.requests,
+            "body_bytes_total": self.body_bytes,
+            "max_body_bytes": self.max_body_bytes,
+            "parse_avg_ms": round(avg * 1000, 3),
+            "parse_max_ms": round(self.max_parse_seconds * 1000, 3),
+            "peak_rss_bytes": _peak_rss_bytes(),
+        }
+
+
+async def read_json_body(request: Request, max_bytes: int, stats: IngestStats) -> Any:
+    """
+    读取并只解析一次请求体。按块读取后拼接，不经过 Request.body() 的缓存，
+    解析完成后原始字节即可释放，请求期间只保留解析出的对象。
+    """
+    started = time.perf_counter()
+    chunks: List[bytes] = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_bytes:
+            raise IngestError(413, f"request body exceeds {max_bytes} bytes")
+        chunks.append(chunk)
+    body = chunks[0] if len(chunks) == 1 else b"".join(chunks)
+    del chunks
+    try:
+        data = loads(body)
+    except ValueError as exc:
+        raise IngestError(400, f"invalid JSON body: {exc}") from exc
+    stats.record(size, time.perf_counter() - started)
+    return data
+
+
+def check_messages(raw_messages: Any) -> List[Dict[str, Any]]:
+    """
+    只校验网关实际使用的消息字段（role/content/name 及 content 分片的 type/text/image_url），
+    不复制分片中的字符串，base64 数据保持为解析结果中的同一个对象。
+    """
+    if not isinstance(raw_messages, list):
+        raise IngestError(422, [{"loc": ["messages"], "msg": "messages must be a list"}])
+    for index, message in enumerate(raw_messages):
+        loc = ["messages", index]
+        if not isinstance(message, dict):
+            raise IngestError(422, [{"loc": loc, "msg": "message must be an object"}])
+        if not isinstance(message.get("role"), str):
+            raise IngestError(422, [{"loc": loc + ["role"], "msg": "role must be a string"}])
+        name = message.get("name")
+        if name is not None and not isinstance(name, str):
+            raise IngestError(422, [{"loc": loc + ["name"], "msg": "name must be a string"}])
+        content = message.get("content")
+        if content is None or isinstance(content, str):
+            continue
+        if not isinstance(content, list):
+            raise IngestError(
+                422, [{"loc": loc + ["content"], "msg": "content must be a string or a list"}]
+            )
+        for part_index, part in enumerate(content):
+            part_loc = loc + ["content", part_index]
+            if not isinstance(part, dict) or part.get("type") not in ("text", "image_url"):
+                raise IngestError(
+                    422, [{"loc": part_loc, "msg": "part type must be 'text' or 'image_url'"}]
+                )
+            text = part.get("text")
+            if text is not None and not isinstance(text, str):
+                raise IngestError(422, [{"loc": part_loc + ["text"], "msg": "text must be a string"}])
+            image_url = part.get("image_url")
+            if image_url is not None and not isinstance(image_url, dict):
+                raise IngestError(
+                    422, [{"loc": part_loc + ["image_url"], "msg": "image_url must be an object"}]
+                )
+    return raw_messages
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Any, Dict, Optional
+
+
+class LoopLagMonitor:
+    """
+    周期性 sleep(interval) 并测量实际唤醒时间与预期的差值，
+    差值即事件循环被同步代码阻塞的时长。
+    """
+
+    _BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+    def __init__(self, interval: float = 0.1) -> None:
+        self.interval = interval
+        self.samples = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+        self.buckets = [0] * (len(self._BUCKETS_MS) + 1)
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, lag: float) -> None:
+        self.samples += 1
+        self.total += lag
+        self.last = lag
+        if lag > self.max:
+            self.max = lag
+        lag_ms = lag * 1000
+        for index, bound in enumerate(self._BUCKETS_MS):
+            if lag_ms <= bound:
+                self.buckets[index] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    async def _run(self) -> None:
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            self.record(max(0.0, time.perf_counter() - expected))
+
+    def start(self) -> None:
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        avg = self.total / self.samples if self.samples else 0.0
+        labels = [f"le_{bound}ms" for bound in self._BUCKETS_MS] + ["gt_1000ms"]
+        return {
+            "interval_ms": self.interval * 1000,
+            "samples": self.samples,
+            "avg_ms": round(avg * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+            "last_ms": round(self.last * 1000, 3),
+            "histogram": dict(zip(labels, self.buckets)),
+        }
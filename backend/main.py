@@ -1,26 +1,183 @@
 from __future__ import annotations
 
+import asyncio
 import base64
 import json
 import os
+import struct
 import time
-import uuid
-from datetime import datetime
-from typing import Any, Dict, List, Optional, Tuple, Union, Literal
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union, Literal
 
 import httpx
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response, StreamingResponse
-from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, ValidationError
+
+from backend.batches import BatchLineError, BatchManager, BatchNotFound, BatchTooLarge
+from backend.cancellation import CancellationTracker, ClientDisconnected, run_until_disconnect
+from backend.capture import CaptureBuffer, payload_summary
+from backend.context_window import ContextModel, ContextWindowManager, parse_context_models
+from backend.embeddings import EmbeddingBatcher, EmbeddingCache
+from backend.ingest import IngestError, IngestStats, check_messages, dumps, loads, read_json_body
+from backend.image_preprocess import (
+    ImagePolicy,
+    ImagePreprocessor,
+    ThumbnailCache,
+    parse_image_policies,
+)
+from backend.image_retention import ImageRetention
+from backend.image_store import ImageStore, ImageTooLarge, UnsupportedImage
+from backend.loop_lag import LoopLagMonitor
+from backend.metrics import GatewayMetrics
+from backend.relay import OpenAIStreamTranslator, STREAM_FORMATS, coalesce, relay_bytes
+from backend.response_cache import (
+    ResponseCache,
+    StreamAccumulator,
+    is_deterministic,
+    payload_cache_key,
+    replay_as_stream,
+)
+from backend.scheduler import AdmissionController, QueueFull, Ticket
+from backend.sessions import Session, SessionNotFound, SessionStore, SessionTurn
+from backend.singleflight import SingleFlight, coalesce_key
+from backend.stream_stats import StreamObserver
+from backend.residency import ModelPolicy, ResidencyManager, parse_policies
+from backend.resumable import OffsetOutOfRange, ResumableStreamStore, StreamNotFound
+from backend.replicas import (
+    NoReplicaAvailable,
+    OllamaReplica,
+    ReplicaPool,
+    is_connection_failure,
+    parse_replicas,
+)
+from backend.upstream import PoolRegistry
+from backend.uploads import MultipartError, MultipartTooLarge, boundary_from, iter_file_part
 
 # Ollama 服务地址，支持通过 OLLAMA_URL 环境变量进行 dev/prod 多环境切换
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://10.10.10.28:11434/api/chat")
 # 支持多模态图片输入的模型白名单
 VL_MODELS = {"qwen3-vl:32b", 'qwen2.5vl:32b', "gemma3:27b"}
-IMAGE_DIR = "/home/chenshi/vllm-images"
-IMAGE_BASE_URL = "http://192.168.1.61:8000/images"
+# 图片落盘目录与对外访问地址（压测等场景可通过环境变量指向临时目录）
+IMAGE_DIR = os.getenv("IMAGE_DIR", "/home/chenshi/vllm-images")
+IMAGE_BASE_URL = os.getenv("IMAGE_BASE_URL", "http://192.168.1.61:8000/images")
+# 已编码图片 base64 的 LRU 缓存上限（字节）
+IMAGE_B64_CACHE_BYTES = int(os.getenv("IMAGE_B64_CACHE_BYTES", str(256 * 1024 * 1024)))
+# 单张上传图片的大小上限（字节），/v1/images/upload 按块写盘时检查
+IMAGE_UPLOAD_MAX_BYTES = int(os.getenv("IMAGE_UPLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+# /images 缓存：内容寻址的图片内容不变，可长期缓存；历史遗留文件名使用较短的 max-age
+IMAGE_LEGACY_MAX_AGE = int(os.getenv("IMAGE_LEGACY_MAX_AGE", "3600"))
+# 聊天记录预览缩略图：允许的边长（逗号分隔）与磁盘缓存目录
+IMAGE_THUMB_SIZES = [
+    int(item) for item in os.getenv("IMAGE_THUMB_SIZES", "128,256,512").split(",") if item.strip()
+]
+IMAGE_THUMB_DIR = os.getenv("IMAGE_THUMB_DIR", "") or os.path.join(IMAGE_DIR, ".thumbs")
+# 图片保留策略：超过 MAX_AGE 秒未访问即删除，总大小超过 MAX_BYTES 时按最近访问淘汰（0 表示不限），
+# GRACE 秒内访问过的图片不会被清理；INTERVAL 为清理周期，0 表示关闭
+IMAGE_RETENTION_MAX_AGE = float(os.getenv("IMAGE_RETENTION_MAX_AGE", str(30 * 24 * 3600)))
+IMAGE_RETENTION_MAX_BYTES = int(os.getenv("IMAGE_RETENTION_MAX_BYTES", str(10 * 1024**3)))
+IMAGE_RETENTION_GRACE = float(os.getenv("IMAGE_RETENTION_GRACE", "900"))
+IMAGE_RETENTION_INTERVAL = float(os.getenv("IMAGE_RETENTION_INTERVAL", "600"))
+# 图片解码/编码/读写使用的工作线程数，避免阻塞事件循环
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "4"))
+# 发送给 VL 模型前的图片预处理（需要 Pillow）：像素上限、输出格式与质量，
+# IMAGE_MODEL_POLICIES 为按模型覆盖的 JSON，例如 {"gemma3:27b": {"max_pixels": 802816}}
+IMAGE_PREPROCESS = os.getenv("IMAGE_PREPROCESS", "1").lower() in {"1", "true", "yes"}
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(1280 * 28 * 28)))
+IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "jpeg")
+IMAGE_OUTPUT_QUALITY = int(os.getenv("IMAGE_OUTPUT_QUALITY", "85"))
+IMAGE_MODEL_POLICIES = os.getenv("IMAGE_MODEL_POLICIES", "")
+# 准入控制：每个模型的最大在途请求数、等待队列长度与排队超时（秒），
+# ADMISSION_MODEL_LIMITS 为 JSON，例如 {"qwen3-vl:32b": {"max_in_flight": 2, "max_queue": 16}}
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "4"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "32"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "60"))
+ADMISSION_MODEL_LIMITS = json.loads(os.getenv("ADMISSION_MODEL_LIMITS", "") or "{}")
+# 流式输出格式：ndjson（Ollama 原始字节透传）或 openai（chat.completion.chunk SSE）
+STREAM_DEFAULT_FORMAT = os.getenv("STREAM_DEFAULT_FORMAT", "ndjson")
+# openai 格式下合并 token 的时间窗口（秒），0 表示逐个分片下发
+STREAM_FLUSH_INTERVAL = float(os.getenv("STREAM_FLUSH_INTERVAL", "0.03"))
+# 可续传流式输出（请求携带 resumable: true 或 X-Resumable-Stream: 1 时启用）：
+# 无读者多久后丢弃（秒），以及所有缓冲流的总字节数与流数量上限
+STREAM_RESUME_TTL = float(os.getenv("STREAM_RESUME_TTL", "120"))
+STREAM_RESUME_MAX_BYTES = int(os.getenv("STREAM_RESUME_MAX_BYTES", str(64 * 1024 * 1024)))
+STREAM_RESUME_MAX_STREAMS = int(os.getenv("STREAM_RESUME_MAX_STREAMS", "1000"))
+# 请求抓取：抽样率、环形缓冲区容量、base64 处理方式（none/truncate/redact）、可选落盘目录
+CAPTURE_SAMPLE_RATE = float(os.getenv("CAPTURE_SAMPLE_RATE", "0.1"))
+CAPTURE_CAPACITY = int(os.getenv("CAPTURE_CAPACITY", "100"))
+CAPTURE_REDACT = os.getenv("CAPTURE_REDACT", "redact")
+CAPTURE_DIR = os.getenv("CAPTURE_DIR", "")
+# 事件循环延迟采样间隔（秒），0 表示关闭
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+# 上游连接池配置：长连接复用，避免每个请求重新握手
+OLLAMA_POOL_MAX_CONNECTIONS = int(os.getenv("OLLAMA_POOL_MAX_CONNECTIONS", "100"))
+OLLAMA_POOL_MAX_KEEPALIVE = int(os.getenv("OLLAMA_POOL_MAX_KEEPALIVE", "20"))
+OLLAMA_POOL_KEEPALIVE_EXPIRY = float(os.getenv("OLLAMA_POOL_KEEPALIVE_EXPIRY", "30"))
+OLLAMA_HTTP2 = os.getenv("OLLAMA_HTTP2", "0").lower() in {"1", "true", "yes"}
+# 多实例配置（JSON 数组），未配置时只使用 OLLAMA_URL 指向的单实例
+OLLAMA_REPLICAS = os.getenv("OLLAMA_REPLICAS", "")
+OLLAMA_HEALTH_INTERVAL = float(os.getenv("OLLAMA_HEALTH_INTERVAL", "10"))
+OLLAMA_EJECT_SECONDS = float(os.getenv("OLLAMA_EJECT_SECONDS", "30"))
+OLLAMA_FAILURE_THRESHOLD = int(os.getenv("OLLAMA_FAILURE_THRESHOLD", "2"))
+OLLAMA_MAX_ATTEMPTS = int(os.getenv("OLLAMA_MAX_ATTEMPTS", "2"))
+# 模型驻留策略（JSON）：pinned 常驻 / idle 空闲超时卸载 / on_demand 使用 Ollama 默认值，
+# 例如 {"qwen3-vl:32b": "pinned", "gemma3:27b": {"policy": "idle", "idle_seconds": 600}}
+MODEL_RESIDENCY = os.getenv("MODEL_RESIDENCY", "")
+MODEL_RESIDENCY_DEFAULT = os.getenv("MODEL_RESIDENCY_DEFAULT", "idle")
+MODEL_IDLE_SECONDS = float(os.getenv("MODEL_IDLE_SECONDS", "1800"))
+# 启动时额外预加载的模型（逗号分隔），pinned 模型总会预加载
+MODEL_PRELOAD = [item.strip() for item in os.getenv("MODEL_PRELOAD", "").split(",") if item.strip()]
+# 检查 pinned 模型是否仍驻留的间隔（秒）与单次加载超时
+MODEL_RESIDENCY_INTERVAL = float(os.getenv("MODEL_RESIDENCY_INTERVAL", "30"))
+MODEL_LOAD_TIMEOUT = float(os.getenv("MODEL_LOAD_TIMEOUT", "300"))
+# 服务端会话：空闲过期时间（秒）、会话数上限、总字节数上限与单会话字节数上限
+SESSION_TTL = float(os.getenv("SESSION_TTL", "3600"))
+SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "1000"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(64 * 1024 * 1024)))
+SESSION_MAX_SESSION_BYTES = int(os.getenv("SESSION_MAX_SESSION_BYTES", str(1024 * 1024)))
+# 上下文窗口：只管理 CONTEXT_MODELS（按模型配置的 JSON）中列出的模型，按提示词长度从
+# CONTEXT_BUCKETS 中选择最小的 num_ctx，超出模型上限时按 CONTEXT_TRIM（none/oldest/images_first）
+# 裁剪历史；未列出的模型原样转发。下面的 CONTEXT_* 只是列出模型未填写字段的默认值。
+# min_ctx 为 num_ctx 下限，常驻模型按它预加载，调高可避免档位增长时重新加载，例如
+# {"qwen3-vl:32b": {"max_ctx": 32768, "min_ctx": 8192, "tokenizer": "/models/qwen3/tokenizer.json"}}
+CONTEXT_ENABLED = os.getenv("CONTEXT_ENABLED", "1").lower() in {"1", "true", "yes"}
+CONTEXT_BUCKETS = [
+    int(item)
+    for item in os.getenv("CONTEXT_BUCKETS", "2048,4096,8192,16384,32768,65536,131072").split(",")
+    if item.strip()
+]
+CONTEXT_MAX_CTX = int(os.getenv("CONTEXT_MAX_CTX", "32768"))
+CONTEXT_IMAGE_TOKENS = int(os.getenv("CONTEXT_IMAGE_TOKENS", "1280"))
+CONTEXT_TOKENIZER = os.getenv("CONTEXT_TOKENIZER", "")
+CONTEXT_TRIM = os.getenv("CONTEXT_TRIM", "images_first")
+CONTEXT_MODELS = os.getenv("CONTEXT_MODELS", "")
+# 未指定 max_tokens 时为生成预留的 token 数；num_ctx 档位在模型空闲多久后才允许缩小（秒）
+CONTEXT_DEFAULT_COMPLETION = int(os.getenv("CONTEXT_DEFAULT_COMPLETION", "1024"))
+CONTEXT_SHRINK_AFTER = float(os.getenv("CONTEXT_SHRINK_AFTER", "300"))
+# 单个 chat 请求体大小上限（字节），多图请求的 base64 可能较大
+CHAT_MAX_BODY_BYTES = int(os.getenv("CHAT_MAX_BODY_BYTES", str(64 * 1024 * 1024)))
+# /v1/embeddings 微批：单批最大文本数、最长等待（秒）、LRU 缓存条目数（0 关闭缓存）
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "64"))
+EMBED_MAX_WAIT = float(os.getenv("EMBED_MAX_WAIT", "0.01"))
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "0"))
+# 离线批处理：输入/输出 JSONL 存放目录、默认与最大行并发、上传大小上限
+BATCH_DIR = os.getenv("BATCH_DIR", "/home/chenshi/vllm-batches")
+BATCH_DEFAULT_CONCURRENCY = int(os.getenv("BATCH_DEFAULT_CONCURRENCY", "2"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "16"))
+BATCH_MAX_UPLOAD_BYTES = int(os.getenv("BATCH_MAX_UPLOAD_BYTES", str(512 * 1024 * 1024)))
+# 精确匹配响应缓存（默认关闭），默认只缓存 temperature=0 的确定性请求
+CHAT_CACHE_ENABLED = os.getenv("CHAT_CACHE_ENABLED", "0").lower() in {"1", "true", "yes"}
+CHAT_CACHE_DETERMINISTIC_ONLY = os.getenv("CHAT_CACHE_DETERMINISTIC_ONLY", "1").lower() in {"1", "true", "yes"}
+CHAT_CACHE_MAX_BYTES = int(os.getenv("CHAT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CHAT_CACHE_TTL = float(os.getenv("CHAT_CACHE_TTL", "3600"))
+CHAT_CACHE_DIR = os.getenv("CHAT_CACHE_DIR", "")
+# 合并同时在途的相同非流式请求，逗号分隔的模型列表，"*" 表示全部模型
+CHAT_COALESCE_MODELS = [
+    item.strip() for item in os.getenv("CHAT_COALESCE_MODELS", "").split(",") if item.strip()
+]
 
 def model_supports_image_input(model_name: str) -> bool:
     """Return True if the model is allowed to handle image inputs."""
@@ -33,8 +190,157 @@ try:
 except OSError as exc:
     print(f"[ERROR] failed to ensure image directory {IMAGE_DIR}: {exc}")
 
-app = FastAPI(title="Ollama Chat Proxy", version="1.0.0")
-app.mount("/images", StaticFiles(directory=IMAGE_DIR), name="images")
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+image_store = ImageStore(IMAGE_DIR, IMAGE_BASE_URL, IMAGE_B64_CACHE_BYTES, image_executor)
+_default_image_policy = ImagePolicy(IMAGE_MAX_PIXELS, IMAGE_OUTPUT_FORMAT, IMAGE_OUTPUT_QUALITY)
+image_preprocessor = ImagePreprocessor(
+    image_store,
+    _default_image_policy,
+    parse_image_policies(IMAGE_MODEL_POLICIES, _default_image_policy),
+    enabled=IMAGE_PREPROCESS,
+)
+thumbnails = ThumbnailCache(image_store, IMAGE_THUMB_DIR, IMAGE_THUMB_SIZES)
+_default_context = ContextModel(
+    CONTEXT_MAX_CTX, CONTEXT_IMAGE_TOKENS, CONTEXT_TOKENIZER or None, CONTEXT_TRIM
+)
+context_windows = ContextWindowManager(
+    CONTEXT_BUCKETS,
+    _default_context,
+    parse_context_models(CONTEXT_MODELS, _default_context),
+    default_completion_tokens=CONTEXT_DEFAULT_COMPLETION,
+    shrink_after=CONTEXT_SHRINK_AFTER,
+)
+loop_lag = LoopLagMonitor(LOOP_LAG_INTERVAL)
+captures = CaptureBuffer(
+    sample_rate=CAPTURE_SAMPLE_RATE,
+    capacity=CAPTURE_CAPACITY,
+    redact_mode=CAPTURE_REDACT,
+    capture_dir=CAPTURE_DIR or None,
+)
+
+upstream_pools = PoolRegistry(
+    max_connections=OLLAMA_POOL_MAX_CONNECTIONS,
+    max_keepalive_connections=OLLAMA_POOL_MAX_KEEPALIVE,
+    keepalive_expiry=OLLAMA_POOL_KEEPALIVE_EXPIRY,
+    http2=OLLAMA_HTTP2,
+    timeout=httpx.Timeout(60.0, connect=10.0),
+)
+replica_pool = ReplicaPool(
+    parse_replicas(OLLAMA_REPLICAS, OLLAMA_URL),
+    upstream_pools,
+    health_interval=OLLAMA_HEALTH_INTERVAL,
+    failure_threshold=OLLAMA_FAILURE_THRESHOLD,
+    eject_seconds=OLLAMA_EJECT_SECONDS,
+)
+
+
+def _residency_load_options(model: str) -> Optional[Dict[str, Any]]:
+    # 预加载使用与请求相同的 num_ctx，否则首个请求会触发 Ollama 重新加载模型
+    if not CONTEXT_ENABLED:
+        return None
+    num_ctx = context_windows.num_ctx_for(model)
+    return {"num_ctx": num_ctx} if num_ctx else None
+
+
+residency = ResidencyManager(
+    replica_pool,
+    parse_policies(MODEL_RESIDENCY, MODEL_IDLE_SECONDS),
+    ModelPolicy(MODEL_RESIDENCY_DEFAULT, MODEL_IDLE_SECONDS),
+    preload=MODEL_PRELOAD,
+    interval=MODEL_RESIDENCY_INTERVAL,
+    load_timeout=MODEL_LOAD_TIMEOUT,
+    load_options=_residency_load_options,
+)
+
+response_cache = ResponseCache(
+    max_bytes=CHAT_CACHE_MAX_BYTES,
+    ttl=CHAT_CACHE_TTL,
+    disk_dir=CHAT_CACHE_DIR or None,
+)
+single_flight = SingleFlight(CHAT_COALESCE_MODELS)
+sessions = SessionStore(
+    ttl=SESSION_TTL,
+    max_sessions=SESSION_MAX_SESSIONS,
+    max_bytes=SESSION_MAX_BYTES,
+    max_session_bytes=SESSION_MAX_SESSION_BYTES,
+)
+image_retention = ImageRetention(
+    image_store,
+    sessions.image_refs,
+    max_age=IMAGE_RETENTION_MAX_AGE,
+    max_bytes=IMAGE_RETENTION_MAX_BYTES,
+    interval=IMAGE_RETENTION_INTERVAL,
+    grace=IMAGE_RETENTION_GRACE,
+    on_remove=thumbnails.remove,
+)
+resumable_streams = ResumableStreamStore(
+    ttl=STREAM_RESUME_TTL,
+    max_bytes=STREAM_RESUME_MAX_BYTES,
+    max_streams=STREAM_RESUME_MAX_STREAMS,
+)
+cancellations = CancellationTracker()
+ingest_stats = IngestStats()
+metrics = GatewayMetrics()
+admission = AdmissionController(
+    ADMISSION_MAX_IN_FLIGHT,
+    ADMISSION_MAX_QUEUE,
+    ADMISSION_QUEUE_TIMEOUT,
+    ADMISSION_MODEL_LIMITS,
+)
+metrics.registry.gauge(
+    "gateway_in_flight_requests",
+    "Requests currently admitted to Ollama.",
+    ("model",),
+    lambda: [((m,), s.in_flight) for m, s in admission._schedulers.items()],
+)
+metrics.registry.gauge(
+    "gateway_queued_requests",
+    "Requests waiting in the admission queue.",
+    ("model",),
+    lambda: [((m,), s.queued) for m, s in admission._schedulers.items()],
+)
+metrics.registry.gauge(
+    "gateway_replica_outstanding_requests",
+    "Outstanding requests per Ollama replica.",
+    ("replica",),
+    lambda: [((r.name,), r.outstanding) for r in replica_pool.replicas],
+)
+metrics.registry.gauge(
+    "gateway_replica_available",
+    "Whether an Ollama replica is currently eligible for routing.",
+    ("replica",),
+    lambda: [
+        ((r.name,), 1 if r.is_available(time.time()) else 0) for r in replica_pool.replicas
+    ],
+)
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    # 连接池随应用启动创建、随应用关闭释放
+    await upstream_pools.start()
+    replica_pool.start()
+    residency.start()
+    loop_lag.start()
+    captures.start()
+    image_retention.start()
+    resumable_streams.start()
+    await batches.start()
+    try:
+        yield
+    finally:
+        await batches.stop()
+        await resumable_streams.stop()
+        await image_retention.stop()
+        await captures.stop()
+        await loop_lag.stop()
+        await residency.stop()
+        await replica_pool.stop()
+        await upstream_pools.close()
+        image_executor.shutdown(wait=False)
+
+
+app = FastAPI(title="Ollama Chat Proxy", version="1.0.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -82,11 +388,74 @@ class ChatCompletionRequest(BaseModel):
     presence_penalty: Optional[float] = None
     frequency_penalty: Optional[float] = None
     stop: Optional[Union[str, List[str]]] = None
+    # 网关扩展字段：流式输出格式，未指定时按 Accept 头与 STREAM_DEFAULT_FORMAT 决定
+    stream_format: Optional[Literal["ndjson", "openai"]] = None
+    # 网关扩展字段：服务端会话 id，携带时 messages 只需包含本轮新增的消息
+    session_id: Optional[str] = None
+    # 网关扩展字段：可续传流，断线后可凭 X-Stream-Id 与已收到的字节数继续读取
+    resumable: bool = False
 
     class Config:
         extra = "allow"
 
 
+class EmbeddingRequest(BaseModel):
+    model: str
+    input: Union[str, List[str]]
+    # OpenAI SDK 默认请求 base64（小端 float32），可显著减小响应体
+    encoding_format: Literal["float", "base64"] = "float"
+    user: Optional[str] = None
+
+
+class SessionCreateRequest(BaseModel):
+    model: Optional[str] = None
+    # 初始消息，通常是 system 提示词
+    messages: List[Message] = []
+
+
+def _construct(model_cls: Any, values: Dict[str, Any]) -> Any:
+    # 跳过校验直接构造模型对象（兼容 pydantic v1/v2），字段值保持原对象不复制
+    construct = getattr(model_cls, "model_construct", None) or model_cls.construct
+    return construct(**values)
+
+
+def _validation_errors(exc: ValidationError) -> List[Dict[str, Any]]:
+    # 不回显 input，避免把 base64 原样写进错误响应
+    return [{"loc": list(error["loc"]), "msg": error["msg"]} for error in exc.errors()]
+
+
+def _parse_chat_request(data: Any) -> ChatCompletionRequest:
+    """
+    低开销构造 ChatCompletionRequest：标量字段仍由 pydantic 校验（体积很小），
+    messages 只检查网关用到的字段后直接构造，图片 base64 不经过 pydantic 复制。
+    """
+    if not isinstance(data, dict):
+        raise IngestError(422, [{"loc": [], "msg": "request body must be a JSON object"}])
+    raw_messages = check_messages(data.get("messages"))
+    scalars = {key: value for key, value in data.items() if key != "messages"}
+    try:
+        request = ChatCompletionRequest(messages=[], **scalars)
+    except ValidationError as exc:
+        raise IngestError(422, _validation_errors(exc)) from exc
+    messages = []
+    for message in raw_messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            content = [_construct(ContentPart, part) for part in content]
+        messages.append(_construct(Message, {**message, "content": content}))
+    request.messages = messages
+    return request
+
+
+async def _read_chat_request(raw_request: Request) -> ChatCompletionRequest:
+    try:
+        return _parse_chat_request(
+            await read_json_body(raw_request, CHAT_MAX_BODY_BYTES, ingest_stats)
+        )
+    except IngestError as exc:
+        raise HTTPException(status_code=exc.status_code, detail=exc.detail) from exc
+
+
 _MIME_EXTENSIONS = {
     "image/png": ".png",
     "image/jpeg": ".jpg",
@@ -102,11 +471,12 @@ def _extension_from_mime(mime_type: str) -> str:
 def _parse_data_url(data_url: str) -> Optional[Tuple[str, str]]:
     if not data_url.startswith("data:image"):
         return None
-    try:
-        header, b64_data = data_url.split(",", 1)
-    except ValueError:
+    # 只切出一次 base64 部分，避免 split 额外复制整段数据
+    comma = data_url.find(",")
+    if comma < 0:
         print(f"[WARN] invalid data URL, missing comma separator: {data_url[:40]}")
         return None
+    header, b64_data = data_url[:comma], data_url[comma + 1 :]
     if not header.startswith("data:"):
         print(f"[WARN] invalid data URL header: {header}")
         return None
@@ -115,70 +485,60 @@ def _parse_data_url(data_url: str) -> Optional[Tuple[str, str]]:
     return mime_type, b64_data
 
 
-def _extract_base64_from_data_url(data_url: str) -> Optional[str]:
-    parsed = _parse_data_url(data_url)
-    if not parsed:
-        return None
-    _, b64_data = parsed
-    print(f"[DEBUG] extracted data URL base64 length: {len(b64_data)}")
-    return b64_data
+def _decode_base64(b64_data: str) -> bytes:
+    return base64.b64decode(b64_data, validate=True)
 
 
-def _save_data_url_image(data_url: str) -> Optional[str]:
-    parsed = _parse_data_url(data_url)
+async def _save_data_url_image(
+    data_url: str, parsed: Optional[Tuple[str, str]] = None
+) -> Optional[str]:
+    parsed = parsed or _parse_data_url(data_url)
     if not parsed:
         return None
     mime_type, b64_data = parsed
     extension = _extension_from_mime(mime_type)
 
     try:
-        image_bytes = base64.b64decode(b64_data, validate=True)
+        image_bytes = await image_store.run_in_worker(_decode_base64, b64_data)
     except Exception as exc:
         print(f"[ERROR] failed to decode base64 image: {exc}")
         return None
 
-    timestamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
-    random_token = uuid.uuid4().hex[:8]
-    filename = f"img-{timestamp}-{random_token}{extension}"
-    file_path = os.path.join(IMAGE_DIR, filename)
+    # 以内容哈希命名，同一张图片在多轮对话中重复发送时只落盘一次
     try:
-        with open(file_path, "wb") as f:
-            f.write(image_bytes)
+        filename, digest = await image_store.save(image_bytes, extension)
     except OSError as exc:
-        print(f"[ERROR] failed to write image file {file_path}: {exc}")
+        print(f"[ERROR] failed to write image file for {extension}: {exc}")
         return None
+    # 顺便缓存已有的 base64，后续轮次引用该 URL 时无需重新读盘编码
+    image_store.remember_base64(digest, b64_data)
 
-    file_url = f"{IMAGE_BASE_URL}/{filename}"
-    print(f"[DEBUG] saved image: {file_path}")
+    file_url = image_store.url_for(filename)
     print(f"[DEBUG] saved image url={file_url}")
     return file_url
 
 
-def _local_url_to_base64(url: str) -> Optional[str]:
+async def _local_url_to_base64(url: str, model: Optional[str] = None) -> Optional[str]:
     if not url.startswith(IMAGE_BASE_URL):
         print(f"[WARN] skip external image url: {url}")
         return None
 
     filename = os.path.basename(url)
-    local_path = os.path.join(IMAGE_DIR, filename)
-    if not os.path.exists(local_path):
-        print(f"[ERROR] local image path not found: {local_path}")
-        return None
-
+    image_store.touch(filename)
     try:
-        with open(local_path, "rb") as f:
-            image_bytes = f.read()
-    except OSError as exc:
-        print(f"[ERROR] cannot read image file {local_path}: {exc}")
+        # 指定模型时按该模型的像素预算预处理，结果按内容哈希缓存
+        if model:
+            encoded = await image_preprocessor.load_base64(filename, model)
+        else:
+            encoded = await image_store.load_base64(filename)
+    except FileNotFoundError:
+        print(f"[ERROR] local image path not found: {image_store.path_for(filename)}")
         return None
-
-    try:
-        encoded = base64.b64encode(image_bytes).decode("utf-8")
-    except Exception as exc:
-        print(f"[ERROR] failed to base64 encode {local_path}: {exc}")
+    except OSError as exc:
+        print(f"[ERROR] cannot read image file {image_store.path_for(filename)}: {exc}")
         return None
 
-    print(f"[DEBUG] encoded base64 length: {len(encoded)} for {local_path}")
+    print(f"[DEBUG] encoded base64 length: {len(encoded)} for {filename}")
     return encoded
 
 
@@ -189,9 +549,13 @@ def _build_ollama_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
         "model": payload["model"],
         "messages": payload["messages"],
         "stream": payload.get("stream", False),
-        # keep the model warm for reuse
-        "keep_alive": "24h",
     }
+    # keep_alive 由模型驻留策略决定，on_demand 模型沿用 Ollama 默认值
+    model = payload["model"]
+    residency.touch(model)
+    keep_alive = residency.keep_alive_for(model)
+    if keep_alive is not None:
+        ollama_payload["keep_alive"] = keep_alive
 
     # options 中汇总温度、top_p 等推理参数，优先保留用户自定义 options
     options = {**payload.get("options", {})}
@@ -220,25 +584,97 @@ def _build_ollama_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
     return ollama_payload
 
 
-def _log_payload_debug(payload: Dict[str, Any]) -> None:
-    try:
-        serialized = json.dumps(payload, ensure_ascii=False)
-        print(f"[DEBUG] final payload sent to Ollama: {serialized[:500]}")
-    except Exception as exc:
-        print(f"[DEBUG] payload summary error: {exc}")
-
-
-def build_ollama_messages(messages: List[Message], model_name: str) -> List[Dict[str, Any]]:
+def _log_payload_debug(payload: Dict[str, Any], replica: str) -> None:
+    # 只打印摘要，完整 payload 通过抽样抓取查看（/admin/captures）
+    print(f"[DEBUG] payload sent to Ollama replica={replica}: {payload_summary(payload)}")
+    capture_id = captures.maybe_capture(payload, replica=replica)
+    if capture_id:
+        print(f"[DEBUG] captured payload id={capture_id}")
+
+
+async def _prepare_image(image_field: Any, url: str, model: str) -> Optional[str]:
+    """把单个 image_url 分片转换为 base64；data URL 会顺带落盘并改写为本地 URL。"""
+    if url.startswith("data:image"):
+        # data URL 只解析一次，落盘与发送共用同一个 base64 切片
+        parsed = _parse_data_url(url)
+        if not parsed:
+            return None
+        b64_data = parsed[1]
+        print(f"[DEBUG] extracted data URL base64 length: {len(b64_data)}")
+        saved_url = await _save_data_url_image(url, parsed)
+        if saved_url and isinstance(image_field, dict):
+            image_field["url"] = saved_url
+            image_field.pop("data", None)
+        if saved_url and image_preprocessor.policy_for(model) is not None:
+            return await _local_url_to_base64(saved_url, model) or b64_data
+        return b64_data
+    return await _local_url_to_base64(url, model)
+
+
+async def _prepare_image_ref(image_field: Any, url: str, model: str) -> Optional[str]:
+    """会话模式：图片落盘后只保留文件名，发送前再由 _materialize_images 换成 base64。"""
+    if url.startswith("data:image"):
+        saved_url = await _save_data_url_image(url)
+        if not saved_url:
+            return None
+        if isinstance(image_field, dict):
+            image_field["url"] = saved_url
+            image_field.pop("data", None)
+        url = saved_url
+    if not url.startswith(IMAGE_BASE_URL):
+        print(f"[WARN] skip external image url: {url}")
+        return None
+    return os.path.basename(url)
+
+
+async def _materialize_images(
+    messages: List[Dict[str, Any]], model: str
+) -> List[Dict[str, Any]]:
+    """把会话消息中的图片文件名替换为 base64（走 ImageStore 的 LRU），不修改会话本身。"""
+    jobs = [
+        (index, message["images"]) for index, message in enumerate(messages) if message.get("images")
+    ]
+    if not jobs:
+        return list(messages)
+    encoded = await asyncio.gather(
+        *(
+            _local_url_to_base64(image_store.url_for(name), model)
+            for _, names in jobs
+            for name in names
+        )
+    )
+    materialized = list(messages)
+    offset = 0
+    for index, names in jobs:
+        images = [b64 for b64 in encoded[offset : offset + len(names)] if b64]
+        offset += len(names)
+        materialized[index] = {**messages[index], "images": images}
+    return materialized
+
+
+async def build_ollama_messages(
+    messages: List[Message],
+    model_name: str,
+    resolve_image: Optional[Callable[[Any, str, str], Awaitable[Optional[str]]]] = None,
+) -> List[Dict[str, Any]]:
     """
     将 OpenAI 风格 messages/content 数组转换为 Ollama 所需的纯文本 content，
     并在每条消息上附加 images(base64) 以匹配 Ollama 的多模态输入格式。
+
+    同一请求中的所有图片并发处理，解码/编码/读写在工作线程池中完成。
+    resolve_image 可替换单张图片的处理方式，会话模式用它只保存图片文件名。
     """
+    resolve_image = resolve_image or _prepare_image
     prepared: List[Dict[str, Any]] = []
     is_vl_model = model_supports_image_input(model_name)
 
     if not is_vl_model:
         print(f"[DEBUG] model {model_name} not in VL_MODELS, image parts will be ignored")
 
+    # 先收集每条消息的图片任务，最后统一并发执行，再按原顺序回填
+    image_jobs: List[Tuple[Dict[str, Any], List[Any]]] = []
+    # 处理期间引用的本地图片不允许被保留策略清理
+    local_refs: List[str] = []
     for message in messages:
         content = message.content
         if isinstance(content, str) or content is None:
@@ -256,7 +692,7 @@ def build_ollama_messages(messages: List[Message], model_name: str) -> List[Dict
             continue
 
         text_segments: List[str] = []
-        images_b64: List[str] = []
+        image_coros: List[Any] = []
         had_image_part = False
         for part in content:
             if part.type == "text" and part.text:
@@ -279,20 +715,9 @@ def build_ollama_messages(messages: List[Message], model_name: str) -> List[Dict
                     print("[WARN] image_url part missing url field, skip")
                     continue
 
-                b64_data: Optional[str] = None
-                if url.startswith("data:image"):
-                    b64_data = _extract_base64_from_data_url(url)
-                    saved_url = _save_data_url_image(url)
-                    if saved_url and isinstance(image_field, dict):
-                        image_field["url"] = saved_url
-                        image_field.pop("data", None)
-                else:
-                    b64_data = _local_url_to_base64(url)
-
-                if not b64_data:
-                    continue
-
-                images_b64.append(b64_data)
+                if url.startswith(IMAGE_BASE_URL):
+                    local_refs.append(os.path.basename(url))
+                image_coros.append(resolve_image(image_field, url, model_name))
 
         message_payload: Dict[str, Any] = {
             "role": message.role,
@@ -300,8 +725,8 @@ def build_ollama_messages(messages: List[Message], model_name: str) -> List[Dict
         }
         if message.name:
             message_payload["name"] = message.name
-        if images_b64:
-            message_payload["images"] = images_b64
+        if image_coros:
+            image_jobs.append((message_payload, image_coros))
         elif is_vl_model and had_image_part:
             print(
                 f"[WARN] model {model_name} received image content but no data was encoded; "
@@ -310,98 +735,1043 @@ def build_ollama_messages(messages: List[Message], model_name: str) -> List[Dict
 
         prepared.append(message_payload)
 
+    if image_jobs:
+        image_store.pin(local_refs)
+        try:
+            results = await asyncio.gather(*(coro for _, coros in image_jobs for coro in coros))
+        finally:
+            image_store.unpin(local_refs)
+        offset = 0
+        for message_payload, coros in image_jobs:
+            images_b64 = [b64 for b64 in results[offset : offset + len(coros)] if b64]
+            offset += len(coros)
+            if images_b64:
+                message_payload["images"] = images_b64
+            else:
+                print(
+                    f"[WARN] model {model_name} received image content but no data was encoded; "
+                    "check image preprocessing pipeline."
+                )
+
     print(f"[DEBUG] prepared textual messages for model={model_name}, count={len(prepared)}")
     return prepared
 
 
+def _pick_replica(model: str, exclude: Optional[set] = None) -> OllamaReplica:
+    try:
+        replica = replica_pool.pick(model, exclude)
+    except NoReplicaAvailable as exc:
+        raise HTTPException(status_code=503, detail=str(exc)) from exc
+    print(f"[DEBUG] routing model={model} to replica={replica.name} outstanding={replica.outstanding}")
+    return replica
+
+
+def _has_other_replica(model: str, tried: set) -> bool:
+    return any(
+        replica.serves(model) and replica.name not in tried for replica in replica_pool.replicas
+    )
+
+
+def _num_predict(payload: Dict[str, Any]) -> Optional[int]:
+    return (payload.get("options") or {}).get("num_predict")
+
+
+_JSON_HEADERS = {"content-type": "application/json"}
+
+
+def _upstream_error_kind(exc: httpx.HTTPError) -> str:
+    if isinstance(exc, httpx.HTTPStatusError):
+        return f"http_{exc.response.status_code}"
+    if isinstance(exc, httpx.TimeoutException):
+        return "timeout"
+    if isinstance(exc, httpx.ConnectError):
+        return "connect"
+    return "transport"
+
+
 # 非流式调用：直接把请求转发到 Ollama 并返回完整响应
 async def _forward_non_streaming(
-    payload: Dict[str, Any], timeout: httpx.Timeout
+    payload: Dict[str, Any],
+    timeout: httpx.Timeout,
+    started: Optional[float] = None,
+    queue_wait: float = 0.0,
 ) -> Response:
-    async with httpx.AsyncClient(timeout=timeout) as client:
-        _log_payload_debug(payload)
-        debug_path = f"/tmp/ollama_payload_{int(time.time())}.json"
-        try:
-            with open(debug_path, "w", encoding="utf-8") as f:
-                json.dump(payload, f, ensure_ascii=False)
-            print(f"[DEBUG] saved payload to {debug_path}")
-        except Exception as e:
-            print(f"[DEBUG] failed to save payload: {e}")
-
-        # 使用 httpx POST 请求调用 Ollama，timeout 控制整体和连接超时
-        response = await client.post(OLLAMA_URL, json=payload)
+    # 连接失败时换一个实例重试；请求已送达上游后的错误不重试，避免重复生成
+    model = payload["model"]
+    upstream_started = time.perf_counter()
+    started = started if started is not None else upstream_started
+    tried: set = set()
+    # 只序列化一次，重试时复用同一份字节
+    body = dumps(payload)
+    while True:
+        replica = _pick_replica(model, tried)
+        tried.add(replica.name)
+        pool = await replica_pool.pool_for(replica)
+        _log_payload_debug(payload, replica.name)
         try:
-            response.raise_for_status()
-        except httpx.HTTPStatusError as exc:
-            raise HTTPException(
-                status_code=exc.response.status_code,
-                detail=exc.response.text,
-            ) from exc
-        return Response(
-            content=response.content,
-            status_code=response.status_code,
-            media_type=response.headers.get("content-type", "application/json"),
-        )
+            async with replica_pool.acquire(replica):
+                # 使用共享连接池 POST 调用 Ollama，timeout 控制整体和连接超时
+                response = await pool.client.post(
+                    replica.chat_url, content=body, headers=_JSON_HEADERS, timeout=timeout
+                )
+        except asyncio.CancelledError:
+            # 客户端断开导致取消：关闭上游连接后 Ollama 会停止生成
+            cancellations.record_cancel(
+                model, None, time.perf_counter() - upstream_started, _num_predict(payload)
+            )
+            metrics.observe_failure(model, False, "cancelled", upstream=False)
+            raise
+        except (httpx.ConnectError, httpx.ConnectTimeout) as exc:
+            replica_pool.mark_failure(replica, str(exc))
+            metrics.upstream_errors.inc(model, _upstream_error_kind(exc))
+            if len(tried) >= OLLAMA_MAX_ATTEMPTS or not _has_other_replica(model, tried):
+                metrics.requests.inc(model, "false", "error")
+                raise
+            print(f"[WARN] replica {replica.name} unreachable, retrying on another replica: {exc}")
+            continue
+        except httpx.HTTPError as exc:
+            if is_connection_failure(exc):
+                replica_pool.mark_failure(replica, str(exc))
+            metrics.observe_failure(model, False, _upstream_error_kind(exc))
+            raise
+        break
+
+    try:
+        response.raise_for_status()
+    except httpx.HTTPStatusError as exc:
+        metrics.observe_failure(model, False, _upstream_error_kind(exc))
+        raise HTTPException(
+            status_code=exc.response.status_code,
+            detail=exc.response.text,
+        ) from exc
+    replica_pool.mark_success(replica, model)
+    try:
+        final = loads(response.content)
+    except ValueError:
+        final = None
+    cancellations.observe_completion(model, final)
+    metrics.observe_completion(
+        model, False, started, time.perf_counter(), final, queue_wait=queue_wait
+    )
+    return Response(
+        content=response.content,
+        status_code=response.status_code,
+        media_type=response.headers.get("content-type", "application/json"),
+    )
+
+
+def _client_identity(raw_request: Request) -> str:
+    # 公平轮转的粒度：优先按 API key，其次按客户端 IP
+    api_key = raw_request.headers.get("authorization") or raw_request.headers.get("x-api-key")
+    if api_key:
+        return f"key:{api_key}"
+    forwarded = raw_request.headers.get("x-forwarded-for")
+    if forwarded:
+        return f"ip:{forwarded.split(',')[0].strip()}"
+    return f"ip:{raw_request.client.host if raw_request.client else 'unknown'}"
+
+
+def _request_priority(raw_request: Request) -> str:
+    return raw_request.headers.get("x-priority", "interactive").strip().lower()
+
+
+def _queue_full_exception(exc: QueueFull) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail=f"Model {exc.model} is busy ({exc.reason}), retry later",
+        headers={"Retry-After": str(exc.retry_after)},
+    )
 
 
-# 流式调用：保持流式连接，将 Ollama 的字节块原样转发给客户端
-async def proxy_stream_chat_completions(request: ChatCompletionRequest):
-    """通过 Ollama 的 stream 接口逐行产出 JSON，供 StreamingResponse 包装使用。"""
-    prepared_messages = build_ollama_messages(request.messages, request.model)
-    request_dict = request.dict(exclude_none=True)
+async def _forward_admitted(
+    payload: Dict[str, Any],
+    timeout: httpx.Timeout,
+    client_id: str,
+    priority: str,
+    started: float,
+) -> Response:
+    ticket = await admission.acquire(payload["model"], client_id, priority)
+    try:
+        return await _forward_non_streaming(payload, timeout, started, ticket.waited)
+    finally:
+        ticket.release()
+
+
+async def _prepare_ollama_payload(
+    request: ChatCompletionRequest,
+    prepared_messages: Optional[List[Dict[str, Any]]] = None,
+    fit_context: bool = True,
+) -> Dict[str, Any]:
+    # request.dict(exclude_none=True) 避免发送 None 字段给上游
+    if prepared_messages is None:
+        prepared_messages = await build_ollama_messages(request.messages, request.model)
+    request_dict = request.dict(exclude_none=True, exclude={"messages"})
     request_dict["messages"] = prepared_messages
-    request_dict["stream"] = True
+    # 将 OpenAI 风格请求转换成 Ollama 兼容格式
     ollama_payload = _build_ollama_payload(request_dict)
+    if fit_context:
+        await _fit_context(ollama_payload)
+    return ollama_payload
+
+
+async def _fit_context(ollama_payload: Dict[str, Any]) -> None:
+    if CONTEXT_ENABLED:
+        # 按提示词长度设置 num_ctx，超出模型上下文时裁剪较早的历史
+        await context_windows.apply(ollama_payload)
+
+
+def _session_not_found(session_id: str) -> HTTPException:
+    # 会话过期或被淘汰时客户端应新建会话并重发完整历史
+    return HTTPException(status_code=404, detail=f"Session {session_id} not found")
+
+
+def _get_session(session_id: str) -> Session:
+    try:
+        return sessions.get(session_id)
+    except SessionNotFound as exc:
+        raise _session_not_found(session_id) from exc
+
+
+async def _begin_session_turn(session_id: str) -> SessionTurn:
+    try:
+        return await sessions.begin_turn(session_id)
+    except SessionNotFound as exc:
+        raise _session_not_found(session_id) from exc
+
+
+async def _prepare_session_turn(
+    request: ChatCompletionRequest, session: Session
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """返回 (本轮新增消息（图片为文件名）, 发给 Ollama 的完整消息（图片为 base64）)。"""
+    new_messages = await build_ollama_messages(
+        request.messages, request.model, _prepare_image_ref
+    )
+    prepared = await _materialize_images(session.messages + new_messages, request.model)
+    return new_messages, prepared
+
+
+def _commit_session_turn(
+    session_id: str, new_messages: List[Dict[str, Any]], result: Optional[Dict[str, Any]]
+) -> None:
+    """生成成功后把本轮用户消息和助手回复一起写入会话；失败或取消的轮次不写入。"""
+    if not result:
+        return
+    message = result.get("message") or {}
+    reply: Dict[str, Any] = {
+        "role": message.get("role") or "assistant",
+        "content": message.get("content") or "",
+    }
+    if message.get("tool_calls"):
+        reply["tool_calls"] = message["tool_calls"]
+    try:
+        sessions.append(session_id, [*new_messages, reply], turn=True)
+    except SessionNotFound:
+        print(f"[WARN] session {session_id} expired before the turn completed, reply dropped")
+
+
+def _cache_policy(raw_request: Request, ollama_payload: Dict[str, Any]) -> Tuple[bool, bool]:
+    """返回 (是否查缓存, 是否写缓存)；Cache-Control: no-cache 跳过查找，no-store 不写入。"""
+    if not CHAT_CACHE_ENABLED:
+        return False, False
+    if CHAT_CACHE_DETERMINISTIC_ONLY and not is_deterministic(ollama_payload):
+        return False, False
+    directives = {
+        item.strip().lower()
+        for item in raw_request.headers.get("cache-control", "").split(",")
+        if item.strip()
+    }
+    lookup = "no-cache" not in directives and "no-store" not in directives
+    store = "no-store" not in directives
+    return lookup, store
+
+
+def _resolve_stream_format(request: ChatCompletionRequest, raw_request: Request) -> str:
+    if request.stream_format:
+        return request.stream_format
+    if "text/event-stream" in raw_request.headers.get("accept", ""):
+        return "openai"
+    return STREAM_DEFAULT_FORMAT if STREAM_DEFAULT_FORMAT in STREAM_FORMATS else "ndjson"
+
+
+_STREAM_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "openai": "text/event-stream"}
+
+
+def _stream_error_chunk(stream_format: str, message: str) -> bytes:
+    # 与 Ollama 流中的错误行保持一致，SSE 模式包装为 data 事件
+    if stream_format == "openai":
+        return b"data: " + dumps({"error": {"message": message}}) + b"\n\n"
+    return dumps({"error": message}) + b"\n"
+
+
+def _is_resumable(request: ChatCompletionRequest, raw_request: Request) -> bool:
+    header = raw_request.headers.get("x-resumable-stream", "").strip().lower()
+    return request.resumable or header in {"1", "true", "yes"}
+
+
+async def _replay_cached_stream(cached: Dict[str, Any], stream_format: str):
+    lines = replay_as_stream(cached)
+    if stream_format == "openai":
+        translator = OpenAIStreamTranslator(cached.get("model", ""))
+        for line in lines:
+            yield translator.translate([loads(line)])
+        return
+    for line in lines:
+        yield line.encode("utf-8")
+
+
+async def _relay_openai(resp: httpx.Response, model: str, on_line=None):
+    translator = OpenAIStreamTranslator(model)
+    async for batch in coalesce(resp.aiter_lines(), STREAM_FLUSH_INTERVAL):
+        chunks = []
+        for line in batch:
+            if on_line is not None:
+                on_line(line)
+            try:
+                chunks.append(loads(line))
+            except ValueError:
+                print(f"[WARN] skip unparsable Ollama stream line: {line[:80]}")
+        data = translator.translate(chunks)
+        if data:
+            yield data
+
+
+# 流式调用：保持流式连接，ndjson 模式原样转发字节块，openai 模式翻译为 SSE
+async def proxy_stream_chat_completions(
+    ollama_payload: Dict[str, Any],
+    cache_key: Optional[str] = None,
+    stream_format: str = "ndjson",
+    ticket: Optional[Ticket] = None,
+    started: Optional[float] = None,
+    on_result: Optional[Callable[[Dict[str, Any]], None]] = None,
+):
+    """通过 Ollama 的 stream 接口产出响应分片，供 StreamingResponse 包装使用。"""
+    model = ollama_payload["model"]
     timeout = httpx.Timeout(60.0, connect=10.0)
+    accumulator = StreamAccumulator() if cache_key or on_result else None
+    observer = StreamObserver(started)
 
-    async with httpx.AsyncClient(timeout=timeout) as client:
-        _log_payload_debug(ollama_payload)
-        debug_path = f"/tmp/ollama_payload_{int(time.time())}.json"
-        try:
-            with open(debug_path, "w", encoding="utf-8") as f:
-                json.dump(ollama_payload, f, ensure_ascii=False)
-            print(f"[DEBUG] saved payload to {debug_path}")
-        except Exception as e:
-            print(f"[DEBUG] failed to save payload: {e}")
+    def on_line(line: Union[bytes, str]) -> None:
+        observer.feed(line)
+        if accumulator is not None:
+            accumulator.feed(line)
 
-        try:
-            async with client.stream("POST", OLLAMA_URL, json=ollama_payload) as resp:
+    replica = _pick_replica(model)
+    pool = await replica_pool.pool_for(replica)
+    _log_payload_debug(ollama_payload, replica.name)
+    # 收到响应头之后的错误不计入摘除（实例可达，只是生成中出错或读超时）
+    responded = False
+
+    try:
+        async with replica_pool.acquire(replica):
+            async with pool.client.stream(
+                "POST",
+                replica.chat_url,
+                content=dumps(ollama_payload),
+                headers=_JSON_HEADERS,
+                timeout=timeout,
+            ) as resp:
+                responded = True
                 resp.raise_for_status()
-                async for chunk in resp.aiter_lines():
-                    if not chunk.strip():
-                        continue
-                    yield f"{chunk}\n"
-        except httpx.HTTPStatusError as exc:
-            raise HTTPException(
-                status_code=exc.response.status_code,
-                detail=exc.response.text,
-            ) from exc
-        except httpx.HTTPError as exc:
-            raise HTTPException(
-                status_code=502,
-                detail=f"Failed to reach Ollama: {exc}",
-            ) from exc
+                if stream_format == "openai":
+                    relay = _relay_openai(resp, model, on_line)
+                else:
+                    relay = relay_bytes(resp.aiter_bytes(), on_line)
+                async for data in relay:
+                    yield data
+        replica_pool.mark_success(replica, model)
+        cancellations.observe_completion(model, observer.final)
+        metrics.observe_completion(
+            model,
+            True,
+            observer.started,
+            time.perf_counter(),
+            observer.final,
+            queue_wait=ticket.waited if ticket is not None else 0.0,
+            first_chunk_at=observer.first_chunk_at,
+            last_chunk_at=observer.last_chunk_at,
+            chunks=observer.chunks,
+        )
+        if accumulator is not None:
+            result = accumulator.result()
+            if result is not None:
+                if cache_key:
+                    await response_cache.put(cache_key, result)
+                if on_result is not None:
+                    on_result(result)
+    except (asyncio.CancelledError, GeneratorExit):
+        # 客户端停止/断开：退出 stream 上下文即关闭上游连接，Ollama 随之停止生成
+        if observer.final is None:
+            cancellations.record_cancel(
+                model, observer.completion_tokens, observer.elapsed, _num_predict(ollama_payload)
+            )
+            print(f"[INFO] client disconnected, cancelled upstream generation for model={model}")
+            metrics.observe_failure(model, True, "cancelled", upstream=False)
+        raise
+    except httpx.HTTPStatusError as exc:
+        metrics.observe_failure(model, True, _upstream_error_kind(exc))
+        raise HTTPException(
+            status_code=exc.response.status_code,
+            detail=exc.response.text,
+        ) from exc
+    except httpx.HTTPError as exc:
+        if is_connection_failure(exc, responded):
+            replica_pool.mark_failure(replica, str(exc))
+        metrics.observe_failure(model, True, _upstream_error_kind(exc))
+        raise HTTPException(
+            status_code=502,
+            detail=f"Failed to reach Ollama: {exc}",
+        ) from exc
+    finally:
+        if ticket is not None:
+            ticket.release()
 
 
 # 兼容 OpenAI 的 /v1/chat/completions 路由，内部只负责代理转发
 @app.post("/v1/chat/completions")
-async def chat_completions(request: ChatCompletionRequest):
+async def chat_completions(raw_request: Request):
+    started = time.perf_counter()
+    # 直接读取原始请求体并只解析一次，不让 FastAPI 先把整个请求校验复制成嵌套模型
+    request = await _read_chat_request(raw_request)
+    if not request.session_id:
+        return await _chat_completion(request, raw_request, started)
+    # 同一会话的并发轮次排队执行，避免交错追加与裁剪历史
+    turn = await _begin_session_turn(request.session_id)
+    try:
+        return await _chat_completion(request, raw_request, started, turn)
+    except BaseException:
+        turn.release()
+        raise
+
+
+async def _chat_completion(
+    request: ChatCompletionRequest,
+    raw_request: Request,
+    started: float,
+    turn: Optional[SessionTurn] = None,
+):
+    """
+    处理一次聊天请求。会话轮次持有 turn：写回会话后立即释放；
+    流式响应在生成结束后释放，异常由调用方释放。
+    """
+    session_commit: Optional[Callable[[Optional[Dict[str, Any]]], None]] = None
+    if turn is not None:
+        session = turn.session
+        new_messages, prepared = await _prepare_session_turn(request, session)
+        ollama_payload = await _prepare_ollama_payload(request, prepared, fit_context=False)
+
+        def _session_commit(result: Optional[Dict[str, Any]]) -> None:
+            _commit_session_turn(session.id, new_messages, result)
+            turn.release()
+
+        session_commit = _session_commit
+    else:
+        ollama_payload = await _prepare_ollama_payload(request, fit_context=False)
+    stream_format = _resolve_stream_format(request, raw_request)
+    stream_media_type = _STREAM_MEDIA_TYPES[stream_format]
+
+    lookup, store = _cache_policy(raw_request, ollama_payload)
+    cache_key = payload_cache_key(ollama_payload) if (lookup or store) else None
+    cache_status = "BYPASS" if store and not lookup else "MISS"
+    if cache_key and not lookup:
+        response_cache.record_bypass()
+    if cache_key and lookup:
+        cached = await response_cache.get(cache_key)
+        if cached is not None:
+            headers = {"X-Cache": "HIT"}
+            if session_commit is not None:
+                session_commit(cached)
+                headers["X-Session-Id"] = request.session_id
+            if request.stream:
+                return StreamingResponse(
+                    _replay_cached_stream(cached, stream_format),
+                    media_type=stream_media_type,
+                    headers=headers,
+                )
+            return Response(
+                content=json.dumps(cached, ensure_ascii=False),
+                media_type="application/json",
+                headers=headers,
+            )
+    headers = {"X-Cache": cache_status} if cache_key else {}
+    if request.session_id:
+        headers["X-Session-Id"] = request.session_id
+    client_id = _client_identity(raw_request)
+    priority = _request_priority(raw_request)
+    # 缓存与合并的键在设置 num_ctx 之前计算：num_ctx 档位随负载变化，不应影响结果的复用
+    flight_key = None
+    if not request.stream and single_flight.enabled_for(request.model):
+        flight_key = coalesce_key(ollama_payload)
+    await _fit_context(ollama_payload)
+
     if request.stream:
+        # 流式请求在开始响应前完成排队，排队期间客户端断开则直接放弃
+        try:
+            ticket = await run_until_disconnect(
+                raw_request, admission.acquire(request.model, client_id, priority)
+            )
+        except QueueFull as exc:
+            metrics.observe_failure(request.model, True, "rejected", upstream=False)
+            raise _queue_full_exception(exc) from exc
+        except ClientDisconnected as exc:
+            metrics.observe_failure(request.model, True, "cancelled", upstream=False)
+            raise HTTPException(status_code=499, detail="Client disconnected") from exc
+
+        def release() -> None:
+            ticket.release()
+            if turn is not None:
+                turn.release()
+
+        generator = proxy_stream_chat_completions(
+            ollama_payload,
+            cache_key if store else None,
+            stream_format,
+            ticket,
+            started,
+            session_commit,
+        )
+        if _is_resumable(request, raw_request):
+            # 生成在后台任务中进行，客户端断开不会取消上游；名额在生成结束时归还
+            stream = resumable_streams.create(request.model, stream_media_type)
+            resumable_streams.run(
+                stream,
+                generator,
+                lambda message: _stream_error_chunk(stream_format, message),
+                on_done=release,
+            )
+            headers["X-Stream-Id"] = stream.id
+            return StreamingResponse(
+                stream.follow(0), media_type=stream_media_type, headers=headers
+            )
         # StreamingResponse 让客户端可以边接收边渲染，体验与 OpenAI 的流式协议一致
+        # 生成器未被启动（客户端提前断开）时由 background 兜底归还名额
         return StreamingResponse(
-            proxy_stream_chat_completions(request), media_type="application/json"
+            generator,
+            media_type=stream_media_type,
+            headers=headers,
+            background=BackgroundTask(release),
         )
 
-    # request.dict(exclude_none=True) 避免发送 None 字段给上游
-    prepared_messages = build_ollama_messages(request.messages, request.model)
-    request_dict = request.dict(exclude_none=True)
-    request_dict["messages"] = prepared_messages
-    # 将 OpenAI 风格请求转换成 Ollama 兼容格式
-    ollama_payload = _build_ollama_payload(request_dict)
     # 定义客户端与 Ollama 交互的超时设置（60 秒响应、10 秒连接）
     timeout = httpx.Timeout(60.0, connect=10.0)
 
     try:
-        return await _forward_non_streaming(ollama_payload, timeout)
+        if flight_key is not None:
+            shared = await run_until_disconnect(
+                raw_request,
+                single_flight.do(
+                    flight_key,
+                    request.model,
+                    lambda: _forward_admitted(
+                        ollama_payload, timeout, client_id, priority, started
+                    ),
+                ),
+            )
+            # 共享的 Response 不能被多个请求同时修改，各自复制一份
+            response = Response(
+                content=shared.body,
+                status_code=shared.status_code,
+                media_type=shared.media_type,
+            )
+        else:
+            response = await run_until_disconnect(
+                raw_request,
+                _forward_admitted(ollama_payload, timeout, client_id, priority, started),
+            )
+    except QueueFull as exc:
+        metrics.observe_failure(request.model, False, "rejected", upstream=False)
+        raise _queue_full_exception(exc) from exc
+    except ClientDisconnected as exc:
+        # 客户端已经离开，状态码只用于日志
+        raise HTTPException(status_code=499, detail="Client disconnected") from exc
     except httpx.HTTPError as exc:
         raise HTTPException(status_code=502, detail=str(exc)) from exc
+
+    if (cache_key and store) or session_commit is not None:
+        try:
+            result = loads(response.body)
+        except ValueError:
+            print("[WARN] upstream response is not JSON, skip caching and session update")
+            result = None
+        if result is not None and cache_key and store:
+            await response_cache.put(cache_key, result)
+        if session_commit is not None:
+            session_commit(result)
+    if headers:
+        response.headers.update(headers)
+    return response
+
+
+# 续传可续传流：offset 为客户端已收到的字节数，从该位置继续输出直到生成结束
+@app.get("/v1/chat/completions/streams/{stream_id}")
+async def resume_stream(stream_id: str, offset: int = 0) -> StreamingResponse:
+    try:
+        stream = resumable_streams.get(stream_id)
+        chunks = resumable_streams.resume(stream_id, offset)
+    except StreamNotFound as exc:
+        # 已过期或被淘汰，客户端需要重新发起请求
+        raise HTTPException(status_code=404, detail=f"Stream {stream_id} not found") from exc
+    except OffsetOutOfRange as exc:
+        raise HTTPException(status_code=416, detail=str(exc)) from exc
+    return StreamingResponse(
+        chunks,
+        media_type=stream.media_type,
+        headers={"X-Stream-Id": stream_id, "X-Stream-Offset": str(offset)},
+    )
+
+
+# 放弃可续传流：仍在生成时取消上游生成
+@app.delete("/v1/chat/completions/streams/{stream_id}")
+async def delete_stream(stream_id: str) -> Dict[str, Any]:
+    if not resumable_streams.delete(stream_id):
+        raise HTTPException(status_code=404, detail=f"Stream {stream_id} not found")
+    return {"stream_id": stream_id, "deleted": True}
+
+
+async def _process_batch_line(batch_id: str, body: Dict[str, Any]) -> Dict[str, Any]:
+    """批处理单行：与在线请求走同一条 payload 构造路径，以 batch 优先级排队，让位于交互流量。"""
+    body = {**body, "stream": False}
+    body.pop("session_id", None)
+    try:
+        request = _parse_chat_request(body)
+    except IngestError as exc:
+        raise BatchLineError(exc.status_code, exc.detail) from exc
+    payload = await _prepare_ollama_payload(request)
+    timeout = httpx.Timeout(300.0, connect=10.0)
+    while True:
+        try:
+            response = await _forward_admitted(
+                payload, timeout, f"batch:{batch_id}", "batch", time.perf_counter()
+            )
+            break
+        except QueueFull as exc:
+            # 批处理不因排队超时失败，按 Retry-After 等待后重新排队
+            await asyncio.sleep(exc.retry_after)
+        except HTTPException as exc:
+            raise BatchLineError(exc.status_code, exc.detail) from exc
+        except httpx.HTTPError as exc:
+            raise BatchLineError(502, str(exc)) from exc
+    try:
+        return loads(response.body)
+    except ValueError as exc:
+        raise BatchLineError(502, "upstream response is not JSON") from exc
+
+
+batches = BatchManager(
+    BATCH_DIR,
+    _process_batch_line,
+    default_concurrency=BATCH_DEFAULT_CONCURRENCY,
+    max_concurrency=BATCH_MAX_CONCURRENCY,
+    max_upload_bytes=BATCH_MAX_UPLOAD_BYTES,
+)
+
+
+def _get_batch(batch_id: str) -> Dict[str, Any]:
+    try:
+        return batches.get(batch_id)
+    except BatchNotFound as exc:
+        raise HTTPException(status_code=404, detail=f"Batch {batch_id} not found") from exc
+
+
+# 提交批处理：请求体为 JSONL，每行是一个 chat completions 请求体，
+# 或 {"custom_id": ..., "body": {...}}；上传内容流式写盘
+@app.post("/v1/batches")
+async def create_batch(raw_request: Request, concurrency: Optional[int] = None) -> Dict[str, Any]:
+    try:
+        return await batches.create(raw_request.stream(), concurrency)
+    except BatchTooLarge as exc:
+        raise HTTPException(status_code=413, detail=str(exc)) from exc
+
+
+@app.get("/v1/batches")
+async def list_batches() -> List[Dict[str, Any]]:
+    return batches.list()
+
+
+# 批处理进度：已完成/失败行数、处理速度与预计剩余时间
+@app.get("/v1/batches/{batch_id}")
+async def get_batch(batch_id: str) -> Dict[str, Any]:
+    return _get_batch(batch_id)
+
+
+# 结果 JSONL：处理过程中即可下载已完成的部分，每行以 line 对应输入行号
+@app.get("/v1/batches/{batch_id}/output")
+async def get_batch_output(batch_id: str) -> Response:
+    _get_batch(batch_id)
+    path = batches.output_path(batch_id)
+    if not os.path.exists(path):
+        return Response(content=b"", media_type="application/x-ndjson")
+    return FileResponse(path, media_type="application/x-ndjson")
+
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str) -> Dict[str, Any]:
+    _get_batch(batch_id)
+    return await batches.cancel(batch_id)
+
+
+async def _send_embed_batch(model: str, texts: List[str]) -> Tuple[List[List[float]], int]:
+    """一次 Ollama /api/embed 调用，连接失败时与聊天请求一样换实例重试。"""
+    body: Dict[str, Any] = {"model": model, "input": texts}
+    keep_alive = residency.keep_alive_for(model)
+    if keep_alive is not None:
+        body["keep_alive"] = keep_alive
+    tried: set = set()
+    while True:
+        replica = _pick_replica(model, tried)
+        tried.add(replica.name)
+        pool = await replica_pool.pool_for(replica)
+        try:
+            async with replica_pool.acquire(replica):
+                response = await pool.client.post(
+                    f"{replica.base_url}/api/embed",
+                    json=body,
+                    timeout=httpx.Timeout(60.0, connect=10.0),
+                )
+        except (httpx.ConnectError, httpx.ConnectTimeout) as exc:
+            replica_pool.mark_failure(replica, str(exc))
+            if len(tried) >= OLLAMA_MAX_ATTEMPTS or not _has_other_replica(model, tried):
+                raise
+            print(f"[WARN] replica {replica.name} unreachable, retrying embed elsewhere: {exc}")
+            continue
+        except httpx.HTTPError as exc:
+            if is_connection_failure(exc):
+                replica_pool.mark_failure(replica, str(exc))
+            raise
+        break
+    response.raise_for_status()
+    replica_pool.mark_success(replica, model)
+    data = response.json()
+    return data.get("embeddings") or [], int(data.get("prompt_eval_count") or 0)
+
+
+embedding_batcher = EmbeddingBatcher(
+    _send_embed_batch,
+    max_batch=EMBED_MAX_BATCH,
+    max_wait=EMBED_MAX_WAIT,
+    cache=EmbeddingCache(EMBED_CACHE_SIZE) if EMBED_CACHE_SIZE > 0 else None,
+)
+
+
+def _encode_embedding(vector: List[float], encoding_format: str) -> Union[List[float], str]:
+    if encoding_format == "base64":
+        return base64.b64encode(struct.pack(f"<{len(vector)}f", *vector)).decode("ascii")
+    return vector
+
+
+# 兼容 OpenAI 的 /v1/embeddings：并发请求按模型微批合并为一次 Ollama /api/embed 调用
+@app.post("/v1/embeddings")
+async def create_embeddings(request: EmbeddingRequest) -> Dict[str, Any]:
+    texts = [request.input] if isinstance(request.input, str) else request.input
+    if not texts:
+        raise HTTPException(status_code=400, detail="input must not be empty")
+    try:
+        results = await embedding_batcher.embed(request.model, texts)
+    except httpx.HTTPStatusError as exc:
+        raise HTTPException(
+            status_code=exc.response.status_code, detail=exc.response.text
+        ) from exc
+    except httpx.HTTPError as exc:
+        raise HTTPException(status_code=502, detail=f"Failed to reach Ollama: {exc}") from exc
+    except RuntimeError as exc:
+        raise HTTPException(status_code=502, detail=str(exc)) from exc
+    prompt_tokens = sum(tokens for _, tokens in results)
+    return {
+        "object": "list",
+        "model": request.model,
+        "data": [
+            {
+                "object": "embedding",
+                "index": index,
+                "embedding": _encode_embedding(vector, request.encoding_format),
+            }
+            for index, (vector, _) in enumerate(results)
+        ],
+        "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+    }
+
+
+# 请求体解析耗时、体积与进程峰值 RSS
+@app.get("/admin/ingest")
+async def ingest_info() -> Dict[str, Any]:
+    return ingest_stats.snapshot()
+
+
+# 微批效果：上游调用次数、平均批大小与缓存命中
+@app.get("/admin/embeddings")
+async def embedding_stats() -> Dict[str, Any]:
+    return embedding_batcher.snapshot()
+
+
+# 新建服务端会话，可带初始消息（例如 system 提示词）
+@app.post("/v1/sessions")
+async def create_session(request: SessionCreateRequest) -> Dict[str, Any]:
+    initial = await build_ollama_messages(
+        request.messages, request.model or "", _prepare_image_ref
+    )
+    return sessions.create(request.model, initial).snapshot()
+
+
+# 查看会话及其中保存的消息（图片为 IMAGE_DIR 中的文件名）
+@app.get("/v1/sessions/{session_id}")
+async def get_session(session_id: str) -> Dict[str, Any]:
+    session = _get_session(session_id)
+    return {**session.snapshot(), "history": session.messages}
+
+
+@app.delete("/v1/sessions/{session_id}")
+async def delete_session(session_id: str) -> Dict[str, Any]:
+    if not sessions.delete(session_id):
+        raise HTTPException(status_code=404, detail=f"Session {session_id} not found")
+    return {"session_id": session_id, "deleted": True}
+
+
+# 上下文窗口：每个模型的 num_ctx 档位分布、平均提示词 token 数与裁剪次数
+@app.get("/admin/context")
+async def context_stats() -> Dict[str, Any]:
+    return context_windows.snapshot()
+
+
+# 可续传流：缓冲的流数量与字节数、续传次数、因无人读取而取消的生成
+@app.get("/admin/streams")
+async def stream_stats() -> Dict[str, Any]:
+    return resumable_streams.snapshot()
+
+
+# 会话数、总内存占用与每个会话的消息数和字节数
+@app.get("/admin/sessions")
+async def session_stats() -> Dict[str, Any]:
+    return sessions.snapshot()
+
+
+# 模型驻留状态：策略、所在副本、显存占用与最近使用时间
+@app.get("/admin/models")
+async def residency_stats() -> Dict[str, Any]:
+    return residency.snapshot()
+
+
+# 手动预热模型，同时恢复被手动卸载的 pinned 模型的自动重载
+@app.post("/admin/models/{model:path}/warm")
+async def warm_model(model: str) -> Dict[str, Any]:
+    try:
+        return await residency.warm(model)
+    except NoReplicaAvailable as exc:
+        raise HTTPException(status_code=503, detail=str(exc)) from exc
+
+
+# 立即从显存卸载模型，pinned 模型在再次 warm 之前不会被自动重载
+@app.post("/admin/models/{model:path}/evict")
+async def evict_model(model: str) -> Dict[str, Any]:
+    try:
+        return await residency.evict(model)
+    except NoReplicaAvailable as exc:
+        raise HTTPException(status_code=503, detail=str(exc)) from exc
+
+
+# Prometheus 文本格式指标：按模型的延迟直方图、吞吐与上游错误计数
+@app.get("/metrics")
+async def prometheus_metrics() -> Response:
+    return Response(
+        content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+# 上游连接池统计：空闲/活跃连接数与获取连接的等待时间，用于调整池大小
+@app.get("/admin/pools")
+async def pool_stats() -> Dict[str, Any]:
+    return upstream_pools.snapshot()
+
+
+# 响应缓存命中/未命中/淘汰计数
+@app.get("/admin/cache")
+async def cache_stats() -> Dict[str, Any]:
+    return response_cache.snapshot()
+
+
+# 请求合并统计：每个模型实际上游调用数与被合并（节省）的调用数
+@app.get("/admin/coalescing")
+async def coalescing_stats() -> Dict[str, Any]:
+    return single_flight.snapshot()
+
+
+_IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def _etag_matches(raw_request: Request, etag: str) -> bool:
+    header = raw_request.headers.get("if-none-match")
+    if not header:
+        return False
+    # If-None-Match 使用弱比较，忽略 W/ 前缀
+    candidates = {item.strip().removeprefix("W/") for item in header.split(",")}
+    return "*" in candidates or etag in candidates
+
+
+async def _stat_image(path: str) -> os.stat_result:
+    try:
+        return await image_store.run_in_worker(os.stat, path)
+    except OSError as exc:
+        raise HTTPException(status_code=404, detail="Image not found") from exc
+
+
+def _file_response(
+    raw_request: Request,
+    path: str,
+    stat: os.stat_result,
+    etag: Optional[str],
+    cache_control: str,
+    media_type: Optional[str] = None,
+) -> Response:
+    # 历史遗留文件名可能被覆盖，ETag 取 mtime 与大小
+    etag = etag or f'"{int(stat.st_mtime):x}-{stat.st_size:x}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if _etag_matches(raw_request, etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers, stat_result=stat)
+
+
+def _check_image_name(filename: str) -> None:
+    # 隐藏目录（缩略图缓存）与写入中的临时文件不对外提供
+    if filename.startswith(".") or filename.endswith(".tmp"):
+        raise HTTPException(status_code=404, detail="Image not found")
+
+
+# 图片下载：内容寻址的文件名随内容变化，带 immutable 缓存头与基于哈希的 ETag，支持 304
+@app.api_route("/images/{filename}", methods=["GET", "HEAD"])
+async def serve_image(filename: str, raw_request: Request) -> Response:
+    _check_image_name(filename)
+    path = image_store.path_for(filename)
+    stat = await _stat_image(path)
+    image_store.touch(filename)
+    digest = image_store.digest_from_filename(filename)
+    if digest:
+        return _file_response(raw_request, path, stat, f'"{digest}"', _IMMUTABLE_CACHE_CONTROL)
+    return _file_response(
+        raw_request, path, stat, None, f"public, max-age={IMAGE_LEGACY_MAX_AGE}"
+    )
+
+
+# 聊天记录预览用的缩略图（JPEG，边长不超过 size），首次请求时生成并缓存到磁盘
+@app.api_route("/images/{filename}/thumb", methods=["GET", "HEAD"])
+async def serve_thumbnail(filename: str, raw_request: Request, size: int = 256) -> Response:
+    _check_image_name(filename)
+    if size not in thumbnails.sizes:
+        raise HTTPException(
+            status_code=400, detail=f"size must be one of {thumbnails.sizes}"
+        )
+    if not thumbnails.available:
+        # 未安装 Pillow 时退化为原图
+        return await serve_image(filename, raw_request)
+    digest = image_store.digest_from_filename(filename)
+    etag = f'"{digest}-{size}"' if digest else None
+    cache_control = (
+        _IMMUTABLE_CACHE_CONTROL if digest else f"public, max-age={IMAGE_LEGACY_MAX_AGE}"
+    )
+    if etag and _etag_matches(raw_request, etag):
+        image_store.touch(filename)
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+    try:
+        path = await thumbnails.get(filename, size)
+    except FileNotFoundError as exc:
+        raise HTTPException(status_code=404, detail="Image not found") from exc
+    except ValueError as exc:
+        raise HTTPException(status_code=415, detail=str(exc)) from exc
+    except OSError as exc:
+        print(f"[ERROR] failed to create thumbnail for {filename}: {exc}")
+        raise HTTPException(status_code=500, detail="failed to create thumbnail") from exc
+    image_store.touch(filename)
+    stat = await _stat_image(path)
+    return _file_response(raw_request, path, stat, etag, cache_control, "image/jpeg")
+
+
+# 上传图片：请求体为 multipart/form-data（字段 file 或 image），或直接以 image/* 作为请求体；
+# 分块写入 IMAGE_DIR 并按内容哈希命名，返回的 url 可直接用于 chat 请求的 image_url
+@app.post("/v1/images/upload")
+async def upload_image(raw_request: Request) -> Dict[str, Any]:
+    content_type = raw_request.headers.get("content-type", "")
+    chunks = raw_request.stream()
+    if content_type.lower().startswith("multipart/"):
+        boundary = boundary_from(content_type)
+        if boundary is None:
+            raise HTTPException(status_code=400, detail="multipart boundary missing")
+        # 非文件字段也计入请求体大小，预留少量字节给分片头部
+        chunks = iter_file_part(chunks, boundary, max_bytes=IMAGE_UPLOAD_MAX_BYTES + 64 * 1024)
+    elif not content_type.lower().startswith(("image/", "application/octet-stream")):
+        raise HTTPException(
+            status_code=415, detail="expected multipart/form-data or an image/* request body"
+        )
+    try:
+        filename, digest, size, created = await image_store.save_stream(
+            chunks, IMAGE_UPLOAD_MAX_BYTES
+        )
+    except (ImageTooLarge, MultipartTooLarge) as exc:
+        raise HTTPException(status_code=413, detail=str(exc)) from exc
+    except UnsupportedImage as exc:
+        raise HTTPException(status_code=415, detail=str(exc)) from exc
+    except MultipartError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    except OSError as exc:
+        print(f"[ERROR] failed to store uploaded image: {exc}")
+        raise HTTPException(status_code=500, detail="failed to store image") from exc
+    url = image_store.url_for(filename)
+    print(f"[DEBUG] uploaded image url={url} bytes={size} deduplicated={not created}")
+    return {
+        "url": url,
+        "filename": filename,
+        "sha256": digest,
+        "bytes": size,
+        "deduplicated": not created,
+    }
+
+
+# 图片存储统计：去重命中、base64 缓存命中/淘汰、预处理前后的字节数、缩略图与清理情况
+@app.get("/admin/images")
+async def image_stats() -> Dict[str, Any]:
+    return {
+        **image_store.snapshot(),
+        "preprocess": image_preprocessor.snapshot(),
+        "thumbnails": thumbnails.snapshot(),
+        "retention": image_retention.snapshot(),
+    }
+
+
+# 立即执行一次图片清理（与后台任务使用相同的保留策略）
+@app.post("/admin/images/sweep")
+async def sweep_images() -> Dict[str, Any]:
+    return await image_retention.sweep()
+
+
+# 最近抓取的请求列表（摘要）与单条详情
+@app.get("/admin/captures")
+async def list_captures() -> Dict[str, Any]:
+    return {"stats": captures.snapshot(), "captures": captures.recent()}
+
+
+@app.get("/admin/captures/{capture_id}")
+async def get_capture(capture_id: str) -> Dict[str, Any]:
+    record = captures.get(capture_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Capture not found")
+    return record
+
+
+# 准入控制：每个模型的在途数、排队深度（按优先级）、拒绝数与排队等待时间
+@app.get("/admin/queues")
+async def queue_stats() -> Dict[str, Any]:
+    return admission.snapshot()
+
+
+# 客户端断开后取消上游生成的次数，以及估算节省的 token 数与 GPU 时间
+@app.get("/admin/cancellations")
+async def cancellation_stats() -> Dict[str, Any]:
+    return cancellations.snapshot()
+
+
+# 事件循环延迟：确认同步的图片处理等不再阻塞其他请求
+@app.get("/admin/loop")
+async def loop_stats() -> Dict[str, Any]:
+    return loop_lag.snapshot()
+
+
+# Ollama 实例状态：健康情况、在途请求数、已加载模型
+@app.get("/admin/replicas")
+async def replica_stats() -> List[Dict[str, Any]]:
+    return replica_pool.snapshot()
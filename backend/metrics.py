@@ -0,0 +1,269 @@
+from __future__ import annotations
+
+import math
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+LabelValues = Tuple[str, ...]
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+OVERHEAD_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+INTER_TOKEN_BUCKETS = (0.005, 0.01, 0.02, 0.035, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1.0)
+RATE_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 200, 500, 1000, 2000, 5000)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str]) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+
+
+class _HistogramState:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self, size: int) -> None:
+        self.counts = [0] * size
+        self.total = 0.0
+        self.count = 0
+
+
+class Histogram:
+    """
+    累积直方图：observe 只做一次二分查找和几次整数加法，适合放在流式热路径上；
+    渲染时再把分桶计数累加为 Prometheus 要求的 le 语义。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        label_names: Sequence[str],
+        buckets: Sequence[float],
+    ) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._states: Dict[LabelValues, _HistogramState] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        state = self._states.get(labels)
+        if state is None:
+            state = _HistogramState(len(self.buckets) + 1)
+            self._states[labels] = state
+        state.counts[bisect_left(self.buckets, value)] += 1
+        state.total += value
+        state.count += 1
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, state in self._states.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), state.counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield (
+                    f"{self.name}_bucket{_format_labels(self.label_names, labels, le)} "
+                    f"{cumulative}"
+                )
+            label_str = _format_labels(self.label_names, labels)
+            yield f"{self.name}_sum{label_str} {_format_value(state.total)}"
+            yield f"{self.name}_count{label_str} {state.count}"
+
+
+class Gauge:
+    """取值时才计算的 gauge，数据来源于其他组件已有的统计。"""
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        label_names: Sequence[str],
+        collect: Callable[[], Iterable[Tuple[LabelValues, float]]],
+    ) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.collect = collect
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} gauge"
+        for labels, value in self.collect():
+            yield f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: List[object] = []
+
+    def counter(self, name: str, help_text: str, label_names: Sequence[str]) -> Counter:
+        metric = Counter(name, help_text, label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        label_names: Sequence[str],
+        buckets: Sequence[float],
+    ) -> Histogram:
+        metric = Histogram(name, help_text, label_names, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(
+        self,
+        name: str,
+        help_text: str,
+        label_names: Sequence[str],
+        collect: Callable[[], Iterable[Tuple[LabelValues, float]]],
+    ) -> Gauge:
+        metric = Gauge(name, help_text, label_names, collect)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())  # type: ignore[attr-defined]
+        lines.append("")
+        return "\n".join(lines)
+
+
+class GatewayMetrics:
+    """LLM 网关的按模型延迟、吞吐与错误指标。"""
+
+    def __init__(self, registry: Optional[MetricsRegistry] = None) -> None:
+        self.registry = registry or MetricsRegistry()
+        r = self.registry
+        self.requests = r.counter(
+            "gateway_requests_total", "Chat completion requests handled.", ("model", "stream", "outcome")
+        )
+        self.upstream_errors = r.counter(
+            "gateway_upstream_errors_total", "Errors talking to Ollama.", ("model", "kind")
+        )
+        self.overhead = r.histogram(
+            "gateway_overhead_seconds",
+            "Gateway latency excluding Ollama processing time and admission queue wait.",
+            ("model",),
+            OVERHEAD_BUCKETS,
+        )
+        self.ttft = r.histogram(
+            "gateway_time_to_first_token_seconds",
+            "Time from request arrival to the first streamed chunk.",
+            ("model",),
+            LATENCY_BUCKETS,
+        )
+        self.inter_token = r.histogram(
+            "gateway_inter_token_latency_seconds",
+            "Mean gap between streamed chunks, observed once per request.",
+            ("model",),
+            INTER_TOKEN_BUCKETS,
+        )
+        self.total = r.histogram(
+            "gateway_request_duration_seconds",
+            "End-to-end request latency at the gateway.",
+            ("model", "stream"),
+            LATENCY_BUCKETS,
+        )
+        self.prompt_rate = r.histogram(
+            "gateway_prompt_tokens_per_second",
+            "Prompt evaluation throughput reported by Ollama.",
+            ("model",),
+            RATE_BUCKETS,
+        )
+        self.completion_rate = r.histogram(
+            "gateway_completion_tokens_per_second",
+            "Generation throughput reported by Ollama.",
+            ("model",),
+            RATE_BUCKETS,
+        )
+        self.load_time = r.histogram(
+            "gateway_model_load_seconds",
+            "Model load time reported by Ollama.",
+            ("model",),
+            LATENCY_BUCKETS,
+        )
+
+    def observe_completion(
+        self,
+        model: str,
+        stream: bool,
+        started: float,
+        finished: float,
+        final: Optional[Dict[str, object]],
+        queue_wait: float = 0.0,
+        first_chunk_at: Optional[float] = None,
+        last_chunk_at: Optional[float] = None,
+        chunks: int = 0,
+    ) -> None:
+        stream_label = "true" if stream else "false"
+        total = finished - started
+        self.requests.inc(model, stream_label, "ok")
+        self.total.observe(total, model, stream_label)
+        if first_chunk_at is not None:
+            self.ttft.observe(first_chunk_at - started, model)
+            if last_chunk_at is not None and chunks > 1:
+                self.inter_token.observe((last_chunk_at - first_chunk_at) / (chunks - 1), model)
+        if not final:
+            return
+
+        def seconds(field: str) -> Optional[float]:
+            value = final.get(field)
+            return value / 1e9 if isinstance(value, (int, float)) and value > 0 else None
+
+        upstream_total = seconds("total_duration")
+        if upstream_total is not None:
+            self.overhead.observe(max(0.0, total - upstream_total - queue_wait), model)
+        load = seconds("load_duration")
+        if load is not None:
+            self.load_time.observe(load, model)
+        prompt_eval = seconds("prompt_eval_duration")
+        prompt_count = final.get("prompt_eval_count")
+        if prompt_eval and isinstance(prompt_count, (int, float)) and prompt_count > 0:
+            self.prompt_rate.observe(prompt_count / prompt_eval, model)
+        eval_duration = seconds("eval_duration")
+        eval_count = final.get("eval_count")
+        if eval_duration and isinstance(eval_count, (int, float)) and eval_count > 0:
+            self.completion_rate.observe(eval_count / eval_duration, model)
+
+    def observe_failure(self, model: str, stream: bool, kind: str, upstream: bool = True) -> None:
+        self.requests.inc(model, "true" if stream else "false", kind)
+        if upstream:
+            self.upstream_errors.inc(model, kind)
+
+    def render(self) -> str:
+        return self.registry.render()
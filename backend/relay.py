@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+import uuid
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+STREAM_FORMATS = {"ndjson", "openai"}
+
+_FINISH_REASONS = {"stop": "stop", "length": "length", "load": "stop"}
+
+
+async def relay_bytes(
+    chunks: AsyncIterator[bytes],
+    on_line: Callable[[bytes], None],
+) -> AsyncIterator[bytes]:
+    """
+    原样透传上游字节块，不做解码与重新编码；同时按行旁路给 on_line（缓存、统计）。
+    块内的完整行直接切片，只有跨块的半行会暂存，不会把整个响应重新拼接一遍。
+    """
+    pending = bytearray()
+    async for chunk in chunks:
+        yield chunk
+        start = 0
+        index = chunk.find(b"\n")
+        while index >= 0:
+            line = chunk[start:index]
+            if pending:
+                pending += line
+                line = bytes(pending)
+                pending.clear()
+            if line.strip():
+                on_line(line)
+            start = index + 1
+            index = chunk.find(b"\n", start)
+        if start < len(chunk):
+            pending += chunk[start:]
+    if pending.strip():
+        on_line(bytes(pending))
+
+
+async def coalesce(lines: AsyncIterator[str], window: float) -> AsyncIterator[List[str]]:
+    """
+    把上游逐行输出按时间窗口合并为批次：第一批立即下发（不增加首 token 延迟），
+    之后每个窗口最多下发一次，从而减少大量慢速客户端上的分帧与系统调用开销。
+    """
+    if window <= 0:
+        async for line in lines:
+            if line.strip():
+                yield [line]
+        return
+
+    queue: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+    failure: List[BaseException] = []
+
+    async def _pump() -> None:
+        try:
+            async for line in lines:
+                if line.strip():
+                    queue.put_nowait(line)
+        except Exception as exc:  # 交给消费方在自己的上下文中重新抛出
+            failure.append(exc)
+        finally:
+            queue.put_nowait(None)
+
+    pump = asyncio.create_task(_pump())
+    loop = asyncio.get_running_loop()
+    try:
+        first = await queue.get()
+        if first is None:
+            if failure:
+                raise failure[0]
+            return
+        yield [first]
+
+        finished = False
+        while not finished:
+            item = await queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + window
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    finished = True
+                    break
+                batch.append(item)
+            yield batch
+        if failure:
+            raise failure[0]
+    finally:
+        if not pump.done():
+            pump.cancel()
+            try:
+                await pump
+            except asyncio.CancelledError:
+                pass
+
+
+def sse_event(data: Any) -> bytes:
+    payload = data if isinstance(data, str) else json.dumps(data, ensure_ascii=False)
+    return f"data: {payload}\n\n".encode("utf-8")
+
+
+class OpenAIStreamTranslator:
+    """把 Ollama /api/chat 的 NDJSON 分片翻译为 OpenAI chat.completion.chunk 的 SSE 事件。"""
+
+    def __init__(self, model: str) -> None:
+        self.model = model
+        self.completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        self.created = int(time.time())
+        self._sent_role = False
+        # tool_calls 的 index 在整个响应内递增，不随合并批次重新计数
+        self._tool_index = 0
+
+    def _chunk(self, delta: Dict[str, Any], finish_reason: Optional[str] = None) -> Dict[str, Any]:
+        return {
+            "id": self.completion_id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": self.model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    def translate(self, chunks: List[Dict[str, Any]]) -> bytes:
+        """把一批 Ollama 分片合并为尽量少的 SSE 事件。"""
+        content: List[str] = []
+        reasoning: List[str] = []
+        tool_calls: List[Any] = []
+        events: List[bytes] = []
+        final: Optional[Dict[str, Any]] = None
+
+        for chunk in chunks:
+            if chunk.get("error"):
+                events.append(sse_event({"error": {"message": str(chunk["error"])}}))
+                continue
+            message = chunk.get("message") or {}
+            if message.get("content"):
+                content.append(message["content"])
+            if message.get("thinking"):
+                reasoning.append(message["thinking"])
+            if message.get("tool_calls"):
+                tool_calls.extend(message["tool_calls"])
+            if chunk.get("done"):
+                final = chunk
+
+        delta: Dict[str, Any] = {}
+        if not self._sent_role:
+            delta["role"] = "assistant"
+            self._sent_role = True
+        if reasoning:
+            delta["reasoning_content"] = "".join(reasoning)
+        if content:
+            delta["content"] = "".join(content)
+        if tool_calls:
+            start = self._tool_index
+            self._tool_index += len(tool_calls)
+            delta["tool_calls"] = [
+                {
+                    "index": index,
+                    "id": f"call_{uuid.uuid4().hex[:24]}",
+                    "type": "function",
+                    "function": {
+                        "name": (call.get("function") or {}).get("name"),
+                        "arguments": json.dumps(
+                            (call.get("function") or {}).get("arguments") or {},
+                            ensure_ascii=False,
+                        ),
+                    },
+                }
+                for index, call in enumerate(tool_calls, start)
+            ]
+        if delta:
+            events.insert(0, sse_event(self._chunk(delta)))
+
+        if final is not None:
+            reason = "tool_calls" if self._tool_index else _FINISH_REASONS.get(
+                final.get("done_reason") or "stop", "stop"
+            )
+            last = self._chunk({}, reason)
+            prompt_tokens = final.get("prompt_eval_count") or 0
+            completion_tokens = final.get("eval_count") or 0
+            last["usage"] = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            }
+            events.append(sse_event(last))
+            events.append(sse_event("[DONE]"))
+
+        return b"".join(events)
@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Set
+
+import httpx
+
+from backend.upstream import PoolRegistry, UpstreamPool
+
+
+class NoReplicaAvailable(RuntimeError):
+    pass
+
+
+def is_connection_failure(exc: httpx.HTTPError, responded: bool = False) -> bool:
+    """
+    是否计入摘除：只有连不上、或尚未收到任何响应就断开的错误说明实例故障；
+    读超时多半是实例正忙（长时间生成），不应把它摘除。
+    """
+    if isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout)):
+        return True
+    return isinstance(exc, httpx.RemoteProtocolError) and not responded
+
+
+class OllamaReplica:
+    """一个 Ollama 实例：声明可服务的模型，并记录健康状态与在途请求数。"""
+
+    def __init__(self, name: str, base_url: str, models: Optional[Iterable[str]] = None) -> None:
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        # models 为 None 表示该实例可以服务任意模型
+        self.models: Optional[Set[str]] = set(models) if models else None
+        self.healthy = True
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.loaded_models: Set[str] = set()
+        # /api/ps 返回的驻留详情：model -> {"size_vram": ..., "expires_at": ...}
+        self.resident: Dict[str, Dict[str, Any]] = {}
+        self.last_checked = 0.0
+        self.last_error = ""
+
+    @property
+    def chat_url(self) -> str:
+        return f"{self.base_url}/api/chat"
+
+    def serves(self, model: str) -> bool:
+        return self.models is None or model in self.models
+
+    def is_available(self, now: float) -> bool:
+        return self.healthy and now >= self.ejected_until
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "base_url": self.base_url,
+            "models": sorted(self.models) if self.models is not None else "*",
+            "healthy": self.healthy,
+            "ejected_for_s": round(max(0.0, self.ejected_until - time.time()), 1),
+            "outstanding": self.outstanding,
+            "consecutive_failures": self.consecutive_failures,
+            "loaded_models": sorted(self.loaded_models),
+            "last_error": self.last_error,
+        }
+
+
+def parse_replicas(raw: str, default_chat_url: str) -> List[OllamaReplica]:
+    """
+    解析 OLLAMA_REPLICAS（JSON 数组），例如：
+    [{"name": "gpu1", "url": "http://10.10.10.28:11434", "models": ["qwen3-vl:32b"]}]
+    未配置时退化为 OLLAMA_URL 指向的单实例。
+    """
+    if raw.strip():
+        entries = json.loads(raw)
+        replicas = []
+        for index, entry in enumerate(entries):
+            url = entry["url"]
+            name = entry.get("name") or f"replica-{index}"
+            replicas.append(OllamaReplica(name, url, entry.get("models")))
+        if replicas:
+            return replicas
+
+    base_url = default_chat_url
+    if base_url.endswith("/api/chat"):
+        base_url = base_url[: -len("/api/chat")]
+    return [OllamaReplica("ollama", base_url)]
+
+
+class ReplicaPool:
+    """
+    多实例路由：按“在途请求最少 + 模型亲和”选择实例，
+    主动健康检查并在连续失败后暂时摘除实例，检查通过后自动恢复。
+    """
+
+    def __init__(
+        self,
+        replicas: List[OllamaReplica],
+        pools: PoolRegistry,
+        *,
+        health_interval: float = 10.0,
+        health_timeout: float = 3.0,
+        failure_threshold: int = 2,
+        eject_seconds: float = 30.0,
+        affinity_weight: int = 2,
+    ) -> None:
+        self.replicas = replicas
+        self.pools = pools
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.failure_threshold = failure_threshold
+        self.eject_seconds = eject_seconds
+        self.affinity_weight = affinity_weight
+        self._health_task: Optional[asyncio.Task] = None
+        for replica in replicas:
+            pools.register(replica.name)
+
+    async def pool_for(self, replica: OllamaReplica) -> UpstreamPool:
+        return await self.pools.get(replica.name)
+
+    def pick(self, model: str, exclude: Optional[Set[str]] = None) -> OllamaReplica:
+        exclude = exclude or set()
+        candidates = [
+            replica
+            for replica in self.replicas
+            if replica.serves(model) and replica.name not in exclude
+        ]
+        if not candidates:
+            raise NoReplicaAvailable(f"No Ollama replica serves model {model}")
+
+        now = time.time()
+        available = [replica for replica in candidates if replica.is_available(now)]
+        # 全部被摘除时宁可尝试一个，也不直接拒绝请求
+        if not available:
+            available = candidates
+
+        def score(replica: OllamaReplica) -> int:
+            penalty = 0 if model in replica.loaded_models else self.affinity_weight
+            return replica.outstanding + penalty
+
+        return min(available, key=score)
+
+    @asynccontextmanager
+    async def acquire(self, replica: OllamaReplica) -> AsyncIterator[OllamaReplica]:
+        replica.outstanding += 1
+        try:
+            yield replica
+        finally:
+            replica.outstanding -= 1
+
+    def mark_success(self, replica: OllamaReplica, model: Optional[str] = None) -> None:
+        replica.consecutive_failures = 0
+        replica.healthy = True
+        replica.ejected_until = 0.0
+        if model:
+            replica.loaded_models.add(model)
+
+    def mark_failure(self, replica: OllamaReplica, error: str) -> None:
+        replica.consecutive_failures += 1
+        replica.last_error = error
+        if replica.consecutive_failures >= self.failure_threshold:
+            replica.healthy = False
+            replica.ejected_until = time.time() + self.eject_seconds
+            print(
+                f"[WARN] ejected Ollama replica {replica.name} for {self.eject_seconds}s: {error}"
+            )
+
+    async def check(self, replica: OllamaReplica) -> None:
+        pool = await self.pool_for(replica)
+        replica.last_checked = time.time()
+        try:
+            response = await pool.client.get(
+                f"{replica.base_url}/api/ps", timeout=self.health_timeout
+            )
+            response.raise_for_status()
+            data = response.json()
+        except (httpx.HTTPError, ValueError) as exc:
+            self.mark_failure(replica, f"health check failed: {exc}")
+            return
+
+        resident: Dict[str, Dict[str, Any]] = {}
+        for item in data.get("models", []) or []:
+            if isinstance(item, dict):
+                name = item.get("name") or item.get("model")
+                if name:
+                    resident[name] = {
+                        "size_vram": item.get("size_vram"),
+                        "expires_at": item.get("expires_at"),
+                    }
+        replica.resident = resident
+        replica.loaded_models = set(resident)
+        if time.time() < replica.ejected_until:
+            # 摘除期内探活成功也不提前恢复，摘除时长以 OLLAMA_EJECT_SECONDS 为准
+            return
+        if not replica.healthy:
+            print(f"[INFO] re-admitted Ollama replica {replica.name}")
+        self.mark_success(replica)
+
+    async def _health_loop(self) -> None:
+        while True:
+            await asyncio.gather(
+                *(self.check(replica) for replica in self.replicas),
+                return_exceptions=True,
+            )
+            await asyncio.sleep(self.health_interval)
+
+    def start(self) -> None:
+        if self._health_task is None and self.health_interval > 0:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def stop(self) -> None:
+        if self._health_task is None:
+            return
+        self._health_task.cancel()
+        try:
+            await self._health_task
+        except asyncio.CancelledError:
+            pass
+        self._health_task = None
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        return [replica.snapshot() for replica in self.replicas]
@@ -0,0 +1,282 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+import httpx
+
+from backend.replicas import NoReplicaAvailable, OllamaReplica, ReplicaPool
+
+# pinned：常驻显存，启动时预加载，被意外卸载后自动重新加载
+# idle：空闲 idle_seconds 后由 Ollama 自行卸载
+# on_demand：不下发 keep_alive，沿用 Ollama 服务端默认值（OLLAMA_KEEP_ALIVE）
+POLICY_MODES = {"pinned", "idle", "on_demand"}
+
+KeepAlive = Union[int, str]
+
+
+class ModelPolicy:
+    __slots__ = ("mode", "idle_seconds")
+
+    def __init__(self, mode: str, idle_seconds: float) -> None:
+        if mode not in POLICY_MODES:
+            raise ValueError(
+                f"unknown residency policy {mode!r}, expected one of {sorted(POLICY_MODES)}"
+            )
+        self.mode = mode
+        self.idle_seconds = idle_seconds
+
+    @property
+    def keep_alive(self) -> Optional[KeepAlive]:
+        if self.mode == "pinned":
+            return -1
+        if self.mode == "idle":
+            return f"{int(self.idle_seconds)}s"
+        return None
+
+    def snapshot(self) -> Dict[str, Any]:
+        data: Dict[str, Any] = {"policy": self.mode, "keep_alive": self.keep_alive}
+        if self.mode == "idle":
+            data["idle_seconds"] = self.idle_seconds
+        return data
+
+
+def parse_policies(raw: str, default_idle_seconds: float) -> Dict[str, ModelPolicy]:
+    """
+    解析 MODEL_RESIDENCY（JSON 对象），值可以是策略名或带参数的对象，例如：
+    {"qwen3-vl:32b": "pinned", "gemma3:27b": {"policy": "idle", "idle_seconds": 600}}
+    """
+    if not raw.strip():
+        return {}
+    policies: Dict[str, ModelPolicy] = {}
+    for model, entry in json.loads(raw).items():
+        if isinstance(entry, str):
+            policies[model] = ModelPolicy(entry, default_idle_seconds)
+        else:
+            policies[model] = ModelPolicy(
+                entry.get("policy", "idle"),
+                float(entry.get("idle_seconds", default_idle_seconds)),
+            )
+    return policies
+
+
+class _ModelState:
+    __slots__ = ("last_used", "warms", "evictions", "last_load_seconds", "last_error")
+
+    def __init__(self) -> None:
+        self.last_used = 0.0
+        self.warms = 0
+        self.evictions = 0
+        self.last_load_seconds: Optional[float] = None
+        self.last_error = ""
+
+
+class ResidencyManager:
+    """
+    模型驻留管理：按模型策略决定请求携带的 keep_alive，启动时预加载配置的模型，
+    并周期性地读取各副本的 /api/ps，把被卸载的 pinned 模型重新加载。
+    """
+
+    def __init__(
+        self,
+        replica_pool: ReplicaPool,
+        policies: Dict[str, ModelPolicy],
+        default_policy: ModelPolicy,
+        *,
+        preload: Iterable[str] = (),
+        interval: float = 30.0,
+        load_timeout: float = 300.0,
+        load_options: Optional[Callable[[str], Optional[Dict[str, Any]]]] = None,
+    ) -> None:
+        self.replica_pool = replica_pool
+        self.policies = policies
+        self.default_policy = default_policy
+        self.preload = [model for model in preload if model]
+        self.interval = interval
+        self.load_timeout = load_timeout
+        # 加载时携带的 options（如 num_ctx）；与请求不一致时 Ollama 会在首个请求时重新加载
+        self.load_options = load_options
+        self._states: Dict[str, _ModelState] = {}
+        # 管理员手动卸载的 pinned 模型暂停自动重载，直到再次 warm
+        self._suspended: Set[str] = set()
+        self._loading: Dict[Tuple[str, str], "asyncio.Task[Dict[str, Any]]"] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def policy_for(self, model: str) -> ModelPolicy:
+        return self.policies.get(model, self.default_policy)
+
+    def keep_alive_for(self, model: str) -> Optional[KeepAlive]:
+        return self.policy_for(model).keep_alive
+
+    def _state(self, model: str) -> _ModelState:
+        state = self._states.get(model)
+        if state is None:
+            state = self._states[model] = _ModelState()
+        return state
+
+    def touch(self, model: str) -> None:
+        self._state(model).last_used = time.time()
+
+    def _replicas_for(self, model: str) -> List[OllamaReplica]:
+        now = time.time()
+        replicas = [
+            replica
+            for replica in self.replica_pool.replicas
+            if replica.serves(model) and replica.is_available(now)
+        ]
+        if not replicas:
+            raise NoReplicaAvailable(f"No available Ollama replica serves model {model}")
+        return replicas
+
+    async def _load(
+        self, replica: OllamaReplica, model: str, keep_alive: Optional[KeepAlive]
+    ) -> Dict[str, Any]:
+        # 不带 prompt 的 /api/generate 只加载（keep_alive=0 时卸载）模型，不做推理
+        body: Dict[str, Any] = {"model": model}
+        if keep_alive is not None:
+            body["keep_alive"] = keep_alive
+        if keep_alive != 0 and self.load_options is not None:
+            options = self.load_options(model)
+            if options:
+                body["options"] = options
+        state = self._state(model)
+        pool = await self.replica_pool.pool_for(replica)
+        started = time.perf_counter()
+        try:
+            response = await pool.client.post(
+                f"{replica.base_url}/api/generate", json=body, timeout=self.load_timeout
+            )
+            response.raise_for_status()
+        except httpx.HTTPError as exc:
+            state.last_error = f"{replica.name}: {exc}"
+            action = "evict" if keep_alive == 0 else "load"
+            print(f"[WARN] failed to {action} {model} on {replica.name}: {exc}")
+            return {"ok": False, "error": str(exc)}
+        elapsed = time.perf_counter() - started
+        if keep_alive == 0:
+            replica.loaded_models.discard(model)
+            replica.resident.pop(model, None)
+        else:
+            replica.loaded_models.add(model)
+            state.last_load_seconds = elapsed
+        return {"ok": True, "seconds": round(elapsed, 3)}
+
+    def _schedule_load(self, replica: OllamaReplica, model: str) -> "asyncio.Task[Dict[str, Any]]":
+        key = (replica.name, model)
+        task = self._loading.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(replica, model, self.keep_alive_for(model)))
+            self._loading[key] = task
+            task.add_done_callback(lambda _t, key=key: self._loading.pop(key, None))
+        return task
+
+    async def warm(self, model: str) -> Dict[str, Any]:
+        """在所有可用且服务该模型的副本上加载模型，并恢复被暂停的自动重载。"""
+        replicas = self._replicas_for(model)
+        self._suspended.discard(model)
+        results = await asyncio.gather(*(self._schedule_load(r, model) for r in replicas))
+        self._state(model).warms += 1
+        print(f"[INFO] warmed model {model} on {[r.name for r in replicas]}")
+        return {replica.name: result for replica, result in zip(replicas, results)}
+
+    async def evict(self, model: str) -> Dict[str, Any]:
+        replicas = self._replicas_for(model)
+        if self.policy_for(model).mode == "pinned":
+            self._suspended.add(model)
+        results = await asyncio.gather(*(self._load(r, model, 0) for r in replicas))
+        self._state(model).evictions += 1
+        print(f"[INFO] evicted model {model} from {[r.name for r in replicas]}")
+        return {replica.name: result for replica, result in zip(replicas, results)}
+
+    def _pinned_models(self) -> List[str]:
+        return [
+            model
+            for model, policy in self.policies.items()
+            if policy.mode == "pinned" and model not in self._suspended
+        ]
+
+    async def _reconcile(self) -> None:
+        """读取各副本的 /api/ps，把不在显存中的 pinned 模型重新加载。"""
+        pinned = self._pinned_models()
+        if not pinned:
+            return
+        # 不依赖副本健康检查循环（可能关闭，且间隔内 Ollama 可能已卸载模型），每轮自己刷新驻留信息
+        replicas = [
+            replica
+            for replica in self.replica_pool.replicas
+            if any(replica.serves(model) for model in pinned)
+        ]
+        await asyncio.gather(*(self.replica_pool.check(replica) for replica in replicas))
+        now = time.time()
+        pending = []
+        for model in pinned:
+            for replica in replicas:
+                if (
+                    replica.serves(model)
+                    and replica.is_available(now)
+                    and model not in replica.loaded_models
+                ):
+                    print(f"[INFO] pinned model {model} not resident on {replica.name}, reloading")
+                    pending.append(self._schedule_load(replica, model))
+        if pending:
+            await asyncio.gather(*pending)
+
+    async def _run(self) -> None:
+        for model in dict.fromkeys(self.preload + self._pinned_models()):
+            try:
+                await self.warm(model)
+            except NoReplicaAvailable as exc:
+                print(f"[WARN] skip preloading {model}: {exc}")
+        while self.interval > 0:
+            await asyncio.sleep(self.interval)
+            try:
+                await self._reconcile()
+            except Exception as exc:  # 后台任务不能因单次失败退出
+                print(f"[ERROR] residency reconcile failed: {exc}")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        tasks = list(self._loading.values())
+        if self._task is not None:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.time()
+        models = set(self.policies) | set(self._states) | set(self.preload)
+        for replica in self.replica_pool.replicas:
+            models |= replica.loaded_models
+        result: Dict[str, Any] = {}
+        for model in sorted(models):
+            state = self._states.get(model)
+            entry = self.policy_for(model).snapshot()
+            entry["resident_on"] = {
+                replica.name: replica.resident.get(model, {})
+                for replica in self.replica_pool.replicas
+                if model in replica.loaded_models
+            }
+            entry["suspended"] = model in self._suspended
+            if state is not None:
+                entry.update(
+                    {
+                        "idle_for_s": round(now - state.last_used, 1) if state.last_used else None,
+                        "warms": state.warms,
+                        "evictions": state.evictions,
+                        "last_load_s": (
+                            round(state.last_load_seconds, 3)
+                            if state.last_load_seconds is not None
+                            else None
+                        ),
+                        "last_error": state.last_error,
+                    }
+                )
+            result[model] = entry
+        return result
@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# 这些字段只影响传输方式或驻留策略，不影响生成结果，不参与缓存键
+_NON_SEMANTIC_FIELDS = ("stream", "keep_alive")
+
+
+def canonical_payload_bytes(payload: Dict[str, Any], ignore: Tuple[str, ...] = ()) -> bytes:
+    """将 Ollama payload 序列化为稳定的规范形式（键排序、紧凑分隔符）。"""
+    canonical = {key: value for key, value in payload.items() if key not in ignore}
+    return json.dumps(
+        canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    ).encode("utf-8")
+
+
+def payload_cache_key(payload: Dict[str, Any]) -> str:
+    return hashlib.sha256(canonical_payload_bytes(payload, _NON_SEMANTIC_FIELDS)).hexdigest()
+
+
+def is_deterministic(payload: Dict[str, Any]) -> bool:
+    options = payload.get("options") or {}
+    return options.get("temperature") == 0
+
+
+class StreamAccumulator:
+    """把 Ollama NDJSON 流的分片合并为一条等价的非流式响应，用于写入缓存。"""
+
+    def __init__(self) -> None:
+        self.content: List[str] = []
+        self.thinking: List[str] = []
+        self.tool_calls: List[Any] = []
+        self.role = "assistant"
+        self.final: Optional[Dict[str, Any]] = None
+
+    def feed(self, line: str) -> None:
+        try:
+            chunk = json.loads(line)
+        except ValueError:
+            return
+        if not isinstance(chunk, dict):
+            return
+        message = chunk.get("message") or {}
+        if isinstance(message, dict):
+            self.role = message.get("role") or self.role
+            if message.get("content"):
+                self.content.append(message["content"])
+            if message.get("thinking"):
+                self.thinking.append(message["thinking"])
+            if message.get("tool_calls"):
+                self.tool_calls.extend(message["tool_calls"])
+        if chunk.get("done"):
+            self.final = chunk
+
+    def result(self) -> Optional[Dict[str, Any]]:
+        if self.final is None or self.final.get("error"):
+            return None
+        message: Dict[str, Any] = {"role": self.role, "content": "".join(self.content)}
+        if self.thinking:
+            message["thinking"] = "".join(self.thinking)
+        if self.tool_calls:
+            message["tool_calls"] = self.tool_calls
+        return {**self.final, "message": message}
+
+
+def replay_as_stream(response: Dict[str, Any]) -> Iterator[str]:
+    """把缓存的完整响应重放为 Ollama NDJSON 流：一个内容分片加一个 done 分片。"""
+    message = response.get("message") or {}
+    head = {
+        key: response[key] for key in ("model", "created_at") if key in response
+    }
+    yield json.dumps({**head, "message": message, "done": False}, ensure_ascii=False) + "\n"
+    tail = {**response, "message": {"role": message.get("role", "assistant"), "content": ""}}
+    yield json.dumps(tail, ensure_ascii=False) + "\n"
+
+
+class ResponseCache:
+    """
+    精确匹配的响应缓存：内存 LRU（按字节预算 + TTL），
+    可选磁盘层（disk_dir），内存未命中时回落到磁盘并提升回内存。
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        ttl: float,
+        disk_dir: Optional[str] = None,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._bytes = 0
+        self.counters: Dict[str, int] = {
+            "hits_memory": 0,
+            "hits_disk": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "bypasses": 0,
+        }
+        if disk_dir:
+            try:
+                os.makedirs(disk_dir, exist_ok=True)
+            except OSError as exc:
+                print(f"[ERROR] failed to create cache dir {disk_dir}: {exc}")
+                self.disk_dir = None
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir or "", f"{key}.json")
+
+    def _remember(self, key: str, expires_at: float, blob: bytes) -> None:
+        if len(blob) > self.max_bytes:
+            return
+        self._drop(key)
+        self._entries[key] = (expires_at, blob)
+        self._bytes += len(blob)
+        while self._bytes > self.max_bytes and self._entries:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self.counters["evictions"] += 1
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[1])
+
+    def _read_disk(self, key: str) -> Optional[Tuple[float, bytes]]:
+        path = self._disk_path(key)
+        try:
+            mtime = os.path.getmtime(path)
+            if mtime + self.ttl < time.time():
+                os.remove(path)
+                return None
+            with open(path, "rb") as f:
+                return mtime + self.ttl, f.read()
+        except OSError:
+            return None
+
+    def _write_disk(self, key: str, blob: bytes) -> None:
+        path = self._disk_path(key)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(blob)
+            os.replace(tmp_path, path)
+        except OSError as exc:
+            print(f"[WARN] failed to write cache entry {path}: {exc}")
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, blob = entry
+            if expires_at >= now:
+                self._entries.move_to_end(key)
+                self.counters["hits_memory"] += 1
+                return json.loads(blob)
+            self._drop(key)
+            self.counters["expirations"] += 1
+
+        if self.disk_dir:
+            disk_entry = await asyncio.to_thread(self._read_disk, key)
+            if disk_entry is not None:
+                expires_at, blob = disk_entry
+                self._remember(key, expires_at, blob)
+                self.counters["hits_disk"] += 1
+                return json.loads(blob)
+
+        self.counters["misses"] += 1
+        return None
+
+    async def put(self, key: str, response: Dict[str, Any]) -> None:
+        blob = json.dumps(response, ensure_ascii=False).encode("utf-8")
+        self._remember(key, time.time() + self.ttl, blob)
+        self.counters["stores"] += 1
+        if self.disk_dir:
+            await asyncio.to_thread(self._write_disk, key, blob)
+
+    def record_bypass(self) -> None:
+        self.counters["bypasses"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "disk_dir": self.disk_dir,
+        }
@@ -0,0 +1,247 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+
+class StreamNotFound(KeyError):
+    pass
+
+
+class OffsetOutOfRange(ValueError):
+    pass
+
+
+class ResumableStream:
+    """
+    一次流式生成已下发的字节块。上游生成在独立任务中进行，与客户端连接解耦；
+    客户端断线后可按已收到的字节偏移量重新连接，从断点继续读取。
+    """
+
+    def __init__(self, stream_id: str, model: str, media_type: str) -> None:
+        self.id = stream_id
+        self.model = model
+        self.media_type = media_type
+        self.chunks: List[bytes] = []
+        # ends[i] 为第 i 块结束处的累计字节偏移，便于按偏移二分定位
+        self.ends: List[int] = []
+        self.size = 0
+        self.done = False
+        self.error: Optional[str] = None
+        self.readers = 0
+        self.resumes = 0
+        self.created_at = time.time()
+        self.last_access = self.created_at
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def _notify(self) -> None:
+        # 唤醒所有等待者后换一个新的 Event，避免 clear 与 wait 之间的竞争
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def append(self, data: bytes) -> None:
+        if not data:
+            return
+        self.chunks.append(data)
+        self.size += len(data)
+        self.ends.append(self.size)
+        self._notify()
+
+    def finish(self, error: Optional[str] = None) -> None:
+        self.done = True
+        self.error = error
+        # 断线的客户端从生成结束起仍有 ttl 时间回来读取剩余部分
+        self.last_access = time.time()
+        self._notify()
+
+    async def follow(self, offset: int = 0) -> AsyncIterator[bytes]:
+        """从字节偏移 offset 开始产出数据，直到生成结束；读者断开不影响上游生成。"""
+        self.readers += 1
+        self.last_access = time.time()
+        try:
+            while True:
+                changed = self._changed
+                if offset < self.size:
+                    index = bisect.bisect_right(self.ends, offset)
+                    for chunk_index in range(index, len(self.ends)):
+                        chunk = self.chunks[chunk_index]
+                        start = self.ends[chunk_index] - len(chunk)
+                        yield chunk[offset - start :] if offset > start else chunk
+                        offset = self.ends[chunk_index]
+                    continue
+                if self.done:
+                    return
+                await changed.wait()
+        finally:
+            self.readers -= 1
+            self.last_access = time.time()
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            "stream_id": self.id,
+            "model": self.model,
+            "bytes": self.size,
+            "chunks": len(self.chunks),
+            "done": self.done,
+            "error": self.error,
+            "readers": self.readers,
+            "resumes": self.resumes,
+            "age_s": round(now - self.created_at, 1),
+            "idle_s": round(now - self.last_access, 1),
+        }
+
+
+class ResumableStreamStore:
+    """
+    可续传流的缓冲区：按最近访问顺序 LRU 淘汰，受总字节数与流数量限制。
+    最后一个读者断开（或生成结束）后 ttl 秒内没有客户端续传的流被丢弃，
+    仍在生成的会同时取消上游生成。
+    """
+
+    def __init__(self, ttl: float, max_bytes: int, max_streams: int = 1000) -> None:
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_streams = max_streams
+        self._streams: "OrderedDict[str, ResumableStream]" = OrderedDict()
+        self._bytes = 0
+        self._task: Optional[asyncio.Task] = None
+        self.counters: Dict[str, int] = {
+            "created": 0,
+            "completed": 0,
+            "failed": 0,
+            "resumes": 0,
+            "expired": 0,
+            "evicted": 0,
+            "deleted": 0,
+            "abandoned": 0,
+        }
+
+    def _drop(self, stream_id: str, reason: str) -> None:
+        stream = self._streams.pop(stream_id, None)
+        if stream is None:
+            return
+        self._bytes -= stream.size
+        self.counters[reason] += 1
+        if stream.task is not None and not stream.task.done():
+            # 客户端不会再回来取结果，停止上游生成
+            stream.task.cancel()
+            self.counters["abandoned"] += 1
+
+    def _purge_expired(self) -> None:
+        cutoff = time.time() - self.ttl
+        for stream_id, stream in list(self._streams.items()):
+            if stream.readers == 0 and stream.last_access < cutoff:
+                self._drop(stream_id, "expired")
+
+    def _enforce_limits(self, keep: Optional[str] = None) -> None:
+        for stream_id in list(self._streams):
+            if self._bytes <= self.max_bytes and len(self._streams) <= self.max_streams:
+                break
+            if stream_id != keep:
+                self._drop(stream_id, "evicted")
+
+    def create(self, model: str, media_type: str) -> ResumableStream:
+        self._purge_expired()
+        stream = ResumableStream(f"stream_{uuid.uuid4().hex}", model, media_type)
+        self._streams[stream.id] = stream
+        self.counters["created"] += 1
+        self._enforce_limits(keep=stream.id)
+        return stream
+
+    def get(self, stream_id: str) -> ResumableStream:
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            raise StreamNotFound(stream_id)
+        stream.last_access = time.time()
+        self._streams.move_to_end(stream_id)
+        return stream
+
+    def resume(self, stream_id: str, offset: int) -> AsyncIterator[bytes]:
+        stream = self.get(stream_id)
+        if offset < 0 or (stream.done and offset > stream.size):
+            raise OffsetOutOfRange(f"offset must be between 0 and {stream.size}")
+        stream.resumes += 1
+        self.counters["resumes"] += 1
+        return stream.follow(offset)
+
+    def _append(self, stream: ResumableStream, data: bytes) -> None:
+        stream.append(data)
+        # 已被淘汰的流继续生成（读者仍在读取）时不再计入缓冲区
+        if stream.id in self._streams:
+            self._bytes += len(data)
+            if self._bytes > self.max_bytes:
+                self._enforce_limits(keep=stream.id)
+
+    def run(
+        self,
+        stream: ResumableStream,
+        source: AsyncIterator[bytes],
+        format_error: Callable[[str], bytes],
+        on_done: Optional[Callable[[], None]] = None,
+    ) -> None:
+        """在后台任务中消费 source 并写入 stream；失败时把错误以流格式追加到末尾。"""
+
+        async def pump() -> None:
+            try:
+                async for data in source:
+                    self._append(stream, data)
+            except asyncio.CancelledError:
+                stream.finish("cancelled")
+                raise
+            except Exception as exc:
+                message = str(getattr(exc, "detail", None) or exc)
+                self._append(stream, format_error(message))
+                stream.finish(message)
+                self.counters["failed"] += 1
+                print(f"[WARN] resumable stream {stream.id} failed: {message}")
+            else:
+                stream.finish()
+                self.counters["completed"] += 1
+
+        stream.task = asyncio.create_task(pump())
+        if on_done is not None:
+            stream.task.add_done_callback(lambda _: on_done())
+
+    def delete(self, stream_id: str) -> bool:
+        if stream_id not in self._streams:
+            return False
+        self._drop(stream_id, "deleted")
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(max(1.0, self.ttl / 2))
+            self._purge_expired()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for stream_id in list(self._streams):
+            self._drop(stream_id, "deleted")
+
+    def snapshot(self) -> Dict[str, Any]:
+        self._purge_expired()
+        return {
+            **self.counters,
+            "streams": len(self._streams),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "max_streams": self.max_streams,
+            "ttl_s": self.ttl,
+            "by_stream": [stream.snapshot() for stream in reversed(self._streams.values())],
+        }
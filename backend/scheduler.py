@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+import asyncio
+import math
+import time
+from collections import OrderedDict, defaultdict, deque
+from typing import Any, Deque, Dict, Optional
+
+# 数字越小优先级越高；批处理流量总是让位于交互流量
+PRIORITY_CLASSES = {"interactive": 0, "batch": 1}
+
+
+class QueueFull(Exception):
+    def __init__(self, model: str, retry_after: int, reason: str = "queue full") -> None:
+        super().__init__(f"{reason} for model {model}")
+        self.model = model
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class _Waiter:
+    __slots__ = ("client_id", "priority", "future", "enqueued_at")
+
+    def __init__(self, client_id: str, priority: int, future: "asyncio.Future[None]") -> None:
+        self.client_id = client_id
+        self.priority = priority
+        self.future = future
+        self.enqueued_at = time.perf_counter()
+
+
+class Ticket:
+    """一个已获准的在途名额；release 幂等，可在多个清理路径上重复调用。"""
+
+    __slots__ = ("_scheduler", "released", "admitted_at", "waited")
+
+    def __init__(self, scheduler: "ModelScheduler", waited: float = 0.0) -> None:
+        self._scheduler = scheduler
+        self.released = False
+        self.admitted_at = time.perf_counter()
+        self.waited = waited
+
+    def release(self) -> None:
+        if self.released:
+            return
+        self.released = True
+        self._scheduler._release(time.perf_counter() - self.admitted_at)
+
+
+class ModelScheduler:
+    """
+    单个模型的准入控制：限制在途请求数，超出部分进入有界等待队列。
+    出队顺序先按优先级，同一优先级内按客户端（API key / IP）轮转，避免单个客户端占满队列。
+    """
+
+    def __init__(self, model: str, max_in_flight: int, max_queue: int) -> None:
+        self.model = model
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue = max_queue
+        self.in_flight = 0
+        # priority -> client_id -> waiters，OrderedDict 的顺序即轮转顺序
+        self._queues: Dict[int, "OrderedDict[str, Deque[_Waiter]]"] = defaultdict(OrderedDict)
+        self._queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._service_avg: Optional[float] = None
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def retry_after(self) -> int:
+        service = self._service_avg or 1.0
+        backlog = self._queued + 1
+        return max(1, math.ceil(service * backlog / self.max_in_flight))
+
+    def _record_wait(self, seconds: float) -> None:
+        self.wait_count += 1
+        self.wait_total += seconds
+        if seconds > self.wait_max:
+            self.wait_max = seconds
+
+    async def acquire(self, client_id: str, priority: int, timeout: Optional[float]) -> Ticket:
+        if self.in_flight < self.max_in_flight and self._queued == 0:
+            self.in_flight += 1
+            self.admitted += 1
+            self._record_wait(0.0)
+            return Ticket(self)
+
+        if self._queued >= self.max_queue:
+            self.rejected += 1
+            raise QueueFull(self.model, self.retry_after())
+
+        waiter = _Waiter(client_id, priority, asyncio.get_running_loop().create_future())
+        self._queues[priority].setdefault(client_id, deque()).append(waiter)
+        self._queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except asyncio.TimeoutError:
+            if self._discard(waiter):
+                self.timed_out += 1
+                raise QueueFull(self.model, self.retry_after(), "queue wait timed out")
+        except asyncio.CancelledError:
+            if not self._discard(waiter):
+                # 名额已经分配给该等待者，但调用方已离开，立即归还
+                self._release(None)
+            raise
+        waited = time.perf_counter() - waiter.enqueued_at
+        self._record_wait(waited)
+        return Ticket(self, waited)
+
+    def _discard(self, waiter: _Waiter) -> bool:
+        """从队列中移除尚未被唤醒的等待者；已被分配名额时返回 False。"""
+        if waiter.future.done():
+            return False
+        clients = self._queues.get(waiter.priority)
+        waiters = clients.get(waiter.client_id) if clients else None
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del clients[waiter.client_id]
+            self._queued -= 1
+        waiter.future.cancel()
+        return True
+
+    def _next_waiter(self) -> Optional[_Waiter]:
+        for priority in sorted(self._queues):
+            clients = self._queues[priority]
+            while clients:
+                client_id, waiters = clients.popitem(last=False)
+                waiter = waiters.popleft()
+                if waiters:
+                    # 该客户端还有请求，排到本优先级的队尾，实现轮转
+                    clients[client_id] = waiters
+                return waiter
+        return None
+
+    def _release(self, service_seconds: Optional[float]) -> None:
+        if service_seconds is not None:
+            self._service_avg = (
+                service_seconds
+                if self._service_avg is None
+                else self._service_avg + 0.2 * (service_seconds - self._service_avg)
+            )
+        self.in_flight -= 1
+        while self.in_flight < self.max_in_flight:
+            waiter = self._next_waiter()
+            if waiter is None:
+                break
+            self._queued -= 1
+            if waiter.future.done():
+                continue
+            self.in_flight += 1
+            self.admitted += 1
+            waiter.future.set_result(None)
+
+    def snapshot(self) -> Dict[str, Any]:
+        by_priority = {
+            name: sum(len(waiters) for waiters in self._queues.get(level, {}).values())
+            for name, level in PRIORITY_CLASSES.items()
+        }
+        avg = self.wait_total / self.wait_count if self.wait_count else 0.0
+        return {
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queued": self._queued,
+            "queued_by_priority": by_priority,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_avg_ms": round(avg * 1000, 3),
+            "wait_max_ms": round(self.wait_max * 1000, 3),
+            "service_avg_s": round(self._service_avg or 0.0, 3),
+        }
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        default_max_in_flight: int,
+        default_max_queue: int,
+        queue_timeout: Optional[float],
+        model_limits: Optional[Dict[str, Dict[str, int]]] = None,
+    ) -> None:
+        self.default_max_in_flight = default_max_in_flight
+        self.default_max_queue = default_max_queue
+        self.queue_timeout = queue_timeout
+        self.model_limits = model_limits or {}
+        self._schedulers: Dict[str, ModelScheduler] = {}
+
+    def scheduler_for(self, model: str) -> ModelScheduler:
+        scheduler = self._schedulers.get(model)
+        if scheduler is None:
+            limits = self.model_limits.get(model, {})
+            scheduler = ModelScheduler(
+                model,
+                limits.get("max_in_flight", self.default_max_in_flight),
+                limits.get("max_queue", self.default_max_queue),
+            )
+            self._schedulers[model] = scheduler
+        return scheduler
+
+    async def acquire(self, model: str, client_id: str, priority: str = "interactive") -> Ticket:
+        level = PRIORITY_CLASSES.get(priority, PRIORITY_CLASSES["interactive"])
+        return await self.scheduler_for(model).acquire(client_id, level, self.queue_timeout)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {model: scheduler.snapshot() for model, scheduler in self._schedulers.items()}
@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+
+class SessionNotFound(KeyError):
+    pass
+
+
+def _message_size(message: Dict[str, Any]) -> int:
+    # 会话中的图片只保存文件名，序列化长度足以近似内存占用
+    return len(json.dumps(message, ensure_ascii=False, separators=(",", ":")))
+
+
+class Session:
+    __slots__ = (
+        "id",
+        "model",
+        "messages",
+        "sizes",
+        "size_bytes",
+        "created_at",
+        "last_access",
+        "turns",
+        "trimmed",
+        "turn_lock",
+    )
+
+    def __init__(self, session_id: str, model: Optional[str]) -> None:
+        self.id = session_id
+        self.model = model
+        self.messages: List[Dict[str, Any]] = []
+        self.sizes: List[int] = []
+        self.size_bytes = 0
+        self.created_at = time.time()
+        self.last_access = self.created_at
+        self.turns = 0
+        self.trimmed = 0
+        # 同一会话的轮次串行执行：下一轮要基于上一轮写回的历史构造请求
+        self.turn_lock = asyncio.Lock()
+
+    def image_refs(self) -> Set[str]:
+        return {name for message in self.messages for name in message.get("images") or ()}
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            "session_id": self.id,
+            "model": self.model,
+            "messages": len(self.messages),
+            "turns": self.turns,
+            "trimmed_messages": self.trimmed,
+            "size_bytes": self.size_bytes,
+            "age_s": round(now - self.created_at, 1),
+            "idle_s": round(now - self.last_access, 1),
+        }
+
+
+class SessionTurn:
+    """一轮会话对话持有的会话锁；生成结束（无论成功与否）时释放，release 可重复调用。"""
+
+    __slots__ = ("session", "_released")
+
+    def __init__(self, session: Session) -> None:
+        self.session = session
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self.session.turn_lock.release()
+
+
+class SessionStore:
+    """
+    服务端会话：保存已规范化的 Ollama messages（图片以 IMAGE_DIR 中的文件名引用），
+    客户端每轮只需发送新消息。会话按最近访问顺序 LRU 淘汰，并受 TTL、
+    会话总数、总字节数和单会话字节数限制；单会话超限时丢弃最早的非 system 消息。
+    """
+
+    def __init__(
+        self,
+        ttl: float,
+        max_sessions: int,
+        max_bytes: int,
+        max_session_bytes: int,
+    ) -> None:
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.max_session_bytes = max_session_bytes
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._bytes = 0
+        self.counters: Dict[str, int] = {
+            "created": 0,
+            "expired": 0,
+            "evicted": 0,
+            "deleted": 0,
+            "misses": 0,
+        }
+
+    def _drop(self, session_id: str, reason: str) -> None:
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self._bytes -= session.size_bytes
+            self.counters[reason] += 1
+
+    def _purge_expired(self) -> None:
+        # 访问顺序即过期顺序，只需检查 LRU 头部
+        cutoff = time.time() - self.ttl
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if session.last_access >= cutoff:
+                break
+            self._drop(session_id, "expired")
+
+    def _enforce_limits(self, keep: Optional[str] = None) -> None:
+        while self._sessions and (
+            len(self._sessions) > self.max_sessions or self._bytes > self.max_bytes
+        ):
+            session_id = next(iter(self._sessions))
+            if session_id == keep:
+                if len(self._sessions) == 1:
+                    break
+                self._sessions.move_to_end(session_id)
+                continue
+            self._drop(session_id, "evicted")
+
+    def create(
+        self, model: Optional[str] = None, messages: Iterable[Dict[str, Any]] = ()
+    ) -> Session:
+        self._purge_expired()
+        session = Session(uuid.uuid4().hex, model)
+        self._sessions[session.id] = session
+        self.counters["created"] += 1
+        self.append(session.id, messages)
+        self._enforce_limits(keep=session.id)
+        return session
+
+    def get(self, session_id: str) -> Session:
+        self._purge_expired()
+        session = self._sessions.get(session_id)
+        if session is None:
+            self.counters["misses"] += 1
+            raise SessionNotFound(session_id)
+        session.last_access = time.time()
+        self._sessions.move_to_end(session_id)
+        return session
+
+    async def begin_turn(self, session_id: str) -> SessionTurn:
+        """等待该会话上一轮结束后开始新一轮；等待期间会话过期则抛出 SessionNotFound。"""
+        session = self.get(session_id)
+        await session.turn_lock.acquire()
+        try:
+            self.get(session_id)
+        except SessionNotFound:
+            session.turn_lock.release()
+            raise
+        return SessionTurn(session)
+
+    def append(
+        self, session_id: str, messages: Iterable[Dict[str, Any]], turn: bool = False
+    ) -> Session:
+        session = self.get(session_id)
+        added = 0
+        for message in messages:
+            size = _message_size(message)
+            session.messages.append(message)
+            session.sizes.append(size)
+            added += size
+        session.size_bytes += added
+        self._bytes += added
+        if turn:
+            session.turns += 1
+        self._trim(session)
+        self._enforce_limits(keep=session_id)
+        return session
+
+    def _trim(self, session: Session) -> None:
+        index = 0
+        while session.size_bytes > self.max_session_bytes and index < len(session.messages):
+            # system 消息承载角色设定，保留；最新一条消息也必须保留
+            last = index == len(session.messages) - 1
+            if last or session.messages[index].get("role") == "system":
+                index += 1
+                continue
+            session.messages.pop(index)
+            size = session.sizes.pop(index)
+            session.size_bytes -= size
+            self._bytes -= size
+            session.trimmed += 1
+
+    def delete(self, session_id: str) -> bool:
+        if session_id not in self._sessions:
+            return False
+        self._drop(session_id, "deleted")
+        return True
+
+    def image_refs(self) -> Set[str]:
+        """所有存活会话引用的图片文件名，图片清理时需要跳过。"""
+        self._purge_expired()
+        refs: Set[str] = set()
+        for session in self._sessions.values():
+            refs |= session.image_refs()
+        return refs
+
+    def snapshot(self) -> Dict[str, Any]:
+        self._purge_expired()
+        return {
+            **self.counters,
+            "sessions": len(self._sessions),
+            "bytes": self._bytes,
+            "max_sessions": self.max_sessions,
+            "max_bytes": self.max_bytes,
+            "max_session_bytes": self.max_session_bytes,
+            "ttl_s": self.ttl,
+            # 最近访问的会话排在前面
+            "by_session": [session.snapshot() for session in reversed(self._sessions.values())],
+        }
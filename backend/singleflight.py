@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, TypeVar
+
+from backend.response_cache import canonical_payload_bytes
+
+T = TypeVar("T")
+
+
+def coalesce_key(payload: Dict[str, Any]) -> str:
+    return hashlib.sha256(canonical_payload_bytes(payload)).hexdigest()
+
+
+class SingleFlight:
+    """
+    合并同时在途的相同请求：第一个请求（leader）真正调用上游，
+    其余相同 key 的请求（follower）等待并共享同一个结果。
+
+    上游调用运行在独立的 task 中，leader 的客户端断开不会影响其他等待者；
+    只有所有等待者都离开时才取消上游调用。
+    """
+
+    def __init__(self, models: Optional[Iterable[str]] = None) -> None:
+        # models 为 None 表示关闭；包含 "*" 表示对所有模型生效
+        self.models = set(models) if models is not None else set()
+        self._inflight: Dict[str, "asyncio.Task[Any]"] = {}
+        self._waiters: Dict[str, int] = defaultdict(int)
+        self.leaders: Dict[str, int] = defaultdict(int)
+        self.followers: Dict[str, int] = defaultdict(int)
+
+    def enabled_for(self, model: str) -> bool:
+        return "*" in self.models or model in self.models
+
+    async def do(self, key: str, model: str, fn: Callable[[], Awaitable[T]]) -> T:
+        task = self._inflight.get(key)
+        if task is not None:
+            self.followers[model] += 1
+        else:
+            task = asyncio.create_task(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+            self.leaders[model] += 1
+
+        self._waiters[key] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters[key] == 1 and not task.done():
+                task.cancel()
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if self._waiters[key] <= 0:
+                self._waiters.pop(key, None)
+
+    def _finish(self, key: str, task: "asyncio.Task[Any]") -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # 所有等待者都已离开时也要取走异常，避免 “exception was never retrieved” 警告
+        if not task.cancelled():
+            task.exception()
+
+    def snapshot(self) -> Dict[str, Any]:
+        models = sorted(set(self.leaders) | set(self.followers))
+        return {
+            "enabled_models": sorted(self.models),
+            "in_flight": len(self._inflight),
+            "upstream_calls_saved": sum(self.followers.values()),
+            "per_model": {
+                model: {
+                    "upstream_calls": self.leaders.get(model, 0),
+                    "coalesced": self.followers.get(model, 0),
+                }
+                for model in models
+            },
+        }
@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import json
+import time
+from typing import Any, Dict, Optional, Union
+
+_DONE_MARKERS = (b'"done":true', b'"done": true')
+
+
+class StreamObserver:
+    """
+    低开销地旁路观察一次 Ollama 流式响应：每行只计数并记录时间，
+    只有带 done 标记的最后一行才做 JSON 解析，用于读取 eval_count 等统计字段。
+    """
+
+    __slots__ = ("started", "first_chunk_at", "last_chunk_at", "chunks", "final")
+
+    def __init__(self, started: Optional[float] = None) -> None:
+        self.started = started if started is not None else time.perf_counter()
+        self.first_chunk_at: Optional[float] = None
+        self.last_chunk_at: Optional[float] = None
+        self.chunks = 0
+        self.final: Optional[Dict[str, Any]] = None
+
+    def feed(self, line: Union[bytes, str]) -> None:
+        now = time.perf_counter()
+        if self.first_chunk_at is None:
+            self.first_chunk_at = now
+        self.last_chunk_at = now
+        self.chunks += 1
+        raw = line.encode("utf-8") if isinstance(line, str) else line
+        if any(marker in raw for marker in _DONE_MARKERS):
+            try:
+                parsed = json.loads(raw)
+            except ValueError:
+                return
+            if isinstance(parsed, dict):
+                self.final = parsed
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    @property
+    def completion_tokens(self) -> int:
+        if self.final and self.final.get("eval_count") is not None:
+            return int(self.final["eval_count"])
+        # 流式输出中每行大致对应一个 token（最后的 done 行不含内容）
+        return max(0, self.chunks - (1 if self.final else 0))
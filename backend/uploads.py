@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import re
+from typing import AsyncIterator, Dict, Iterable, Optional
+
+_BOUNDARY = re.compile(r'boundary="?([^";]+)"?', re.IGNORECASE)
+_DISPOSITION_PARAM = re.compile(r'(\w+)="([^"]*)"')
+# 单个分片头部的长度上限，防止恶意请求让缓冲区无限增长
+_MAX_HEADER_BYTES = 16 * 1024
+
+
+class MultipartError(ValueError):
+    pass
+
+
+class MultipartTooLarge(MultipartError):
+    pass
+
+
+def boundary_from(content_type: str) -> Optional[bytes]:
+    if not content_type.lower().startswith("multipart/form-data"):
+        return None
+    match = _BOUNDARY.search(content_type)
+    return match.group(1).encode("latin-1") if match else None
+
+
+def _parse_part_headers(raw: bytes) -> Dict[str, str]:
+    headers: Dict[str, str] = {}
+    for line in raw.split(b"\r\n"):
+        name, sep, value = line.partition(b":")
+        if sep:
+            headers[name.strip().lower().decode("latin-1")] = value.strip().decode("utf-8", "replace")
+    return headers
+
+
+async def iter_file_part(
+    chunks: AsyncIterator[bytes],
+    boundary: bytes,
+    field_names: Iterable[str] = ("file", "image"),
+    max_bytes: Optional[int] = None,
+) -> AsyncIterator[bytes]:
+    """
+    流式解析 multipart/form-data，只产出第一个文件分片的内容（字段名在 field_names 中，
+    或带 filename 参数），其余分片直接丢弃。缓冲区只保留不足一个分隔符长度的尾部，
+    内存占用与上传大小无关；max_bytes 限制整个请求体（含非文件分片）的字节数。
+    """
+    fields = set(field_names)
+    delimiter = b"\r\n--" + boundary
+    keep = len(delimiter) - 1
+    # 请求体以分隔符开头、前面没有 CRLF，补上后所有分隔符可以统一匹配
+    buffer = bytearray(b"\r\n")
+    iterator = chunks.__aiter__()
+    received = 0
+
+    async def fill() -> bool:
+        nonlocal received
+        try:
+            chunk = await iterator.__anext__()
+        except StopAsyncIteration:
+            return False
+        received += len(chunk)
+        if max_bytes is not None and received > max_bytes:
+            raise MultipartTooLarge(f"request body exceeds {max_bytes} bytes")
+        buffer.extend(chunk)
+        return True
+
+    # 跳过第一个分隔符之前的 preamble
+    while True:
+        index = buffer.find(delimiter)
+        if index >= 0:
+            del buffer[: index + len(delimiter)]
+            break
+        del buffer[: max(0, len(buffer) - keep)]
+        if not await fill():
+            raise MultipartError("multipart boundary not found")
+
+    while True:
+        while len(buffer) < 2:
+            if not await fill():
+                raise MultipartError("truncated multipart body")
+        if buffer[:2] == b"--":
+            raise MultipartError("no file part in multipart body")
+        while True:
+            end = buffer.find(b"\r\n\r\n")
+            if end >= 0:
+                break
+            if len(buffer) > _MAX_HEADER_BYTES:
+                raise MultipartError("multipart part headers too large")
+            if not await fill():
+                raise MultipartError("truncated multipart part headers")
+        headers = _parse_part_headers(bytes(buffer[2:end]))
+        del buffer[: end + 4]
+        params = dict(_DISPOSITION_PARAM.findall(headers.get("content-disposition", "")))
+        is_file = params.get("name") in fields or "filename" in params
+
+        while True:
+            index = buffer.find(delimiter)
+            if index >= 0:
+                if is_file:
+                    if index:
+                        yield bytes(buffer[:index])
+                    # 文件之后的分片不再读取，直接返回响应即可
+                    return
+                del buffer[: index + len(delimiter)]
+                break
+            if len(buffer) > keep:
+                if is_file:
+                    yield bytes(buffer[:-keep])
+                del buffer[:-keep]
+            if not await fill():
+                raise MultipartError("truncated multipart body")
@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import importlib.util
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import httpx
+
+# 各服务独立部署、没有共享的 Python 包，UpstreamPool 在以下文件中各有一份副本，修改时需同步：
+# vector_backend/upstream.py、services/comfyui_backend/app/services/http_pool.py
+
+
+def _http2_available() -> bool:
+    return importlib.util.find_spec("h2") is not None
+
+
+class PoolStats:
+    """Counters describing how long requests wait for a pooled connection."""
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_wait(self, seconds: float) -> None:
+        self.wait_count += 1
+        self.wait_total += seconds
+        if seconds > self.wait_max:
+            self.wait_max = seconds
+
+    def snapshot(self) -> Dict[str, Any]:
+        avg = self.wait_total / self.wait_count if self.wait_count else 0.0
+        return {
+            "requests": self.requests,
+            "wait_avg_ms": round(avg * 1000, 3),
+            "wait_max_ms": round(self.wait_max * 1000, 3),
+        }
+
+
+class _InstrumentedTransport(httpx.AsyncBaseTransport):
+    """
+    包装 httpx 的连接池传输层，借助 httpcore 的 trace 扩展测量
+    “请求发出 -> 拿到可用连接”之间的等待时间。
+    """
+
+    def __init__(self, inner: httpx.AsyncHTTPTransport, stats: PoolStats) -> None:
+        self._inner = inner
+        self._stats = stats
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started = time.perf_counter()
+        acquired = False
+        user_trace: Optional[Callable[[str, Dict[str, Any]], Awaitable[None]]] = (
+            request.extensions.get("trace")
+        )
+
+        async def trace(event_name: str, info: Dict[str, Any]) -> None:
+            nonlocal acquired
+            # 连接池分配到连接后，第一个事件要么是新建 TCP 连接，要么直接开始写请求头
+            if not acquired and event_name.startswith(("connection.", "http11.", "http2.")):
+                acquired = True
+                self._stats.record_wait(time.perf_counter() - started)
+            if user_trace is not None:
+                await user_trace(event_name, info)
+
+        request.extensions = {**request.extensions, "trace": trace}
+        self._stats.requests += 1
+        return await self._inner.handle_async_request(request)
+
+    async def aclose(self) -> None:
+        await self._inner.aclose()
+
+    def connection_counts(self) -> Dict[str, int]:
+        pool = getattr(self._inner, "_pool", None)
+        connections = list(getattr(pool, "connections", []) or [])
+        idle = sum(1 for conn in connections if conn.is_idle())
+        closed = sum(1 for conn in connections if conn.is_closed())
+        return {
+            "connections": len(connections),
+            "idle": idle,
+            "active": len(connections) - idle - closed,
+        }
+
+
+class UpstreamPool:
+    """
+    某一个上游（Ollama 实例等）的长连接池，随应用生命周期创建与关闭。
+
+    每个上游独立持有一个 httpx.AsyncClient，因此 max_connections
+    即为该上游的连接上限，不会被其他上游的流量挤占。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        http2: bool = False,
+        timeout: Optional[httpx.Timeout] = None,
+        verify: bool = True,
+    ) -> None:
+        self.name = name
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        if http2 and not _http2_available():
+            print(f"[WARN] HTTP/2 requested for pool {name} but 'h2' is not installed, using HTTP/1.1")
+            http2 = False
+        self.http2 = http2
+        self.timeout = timeout or httpx.Timeout(60.0, connect=10.0)
+        self.verify = verify
+        self.stats = PoolStats()
+        self._transport: Optional[_InstrumentedTransport] = None
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def start(self) -> None:
+        if self._client is not None:
+            return
+        inner = httpx.AsyncHTTPTransport(
+            limits=self.limits, http2=self.http2, verify=self.verify
+        )
+        self._transport = _InstrumentedTransport(inner, self.stats)
+        self._client = httpx.AsyncClient(transport=self._transport, timeout=self.timeout)
+        print(
+            f"[DEBUG] started upstream pool {self.name}: "
+            f"max_connections={self.limits.max_connections} "
+            f"max_keepalive={self.limits.max_keepalive_connections} http2={self.http2}"
+        )
+
+    async def close(self) -> None:
+        if self._client is None:
+            return
+        await self._client.aclose()
+        self._client = None
+        self._transport = None
+        print(f"[DEBUG] closed upstream pool {self.name}")
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            raise RuntimeError(f"Upstream pool {self.name} is not started")
+        return self._client
+
+    def snapshot(self) -> Dict[str, Any]:
+        counts = (
+            self._transport.connection_counts()
+            if self._transport is not None
+            else {"connections": 0, "idle": 0, "active": 0}
+        )
+        return {
+            "name": self.name,
+            "started": self._client is not None,
+            "http2": self.http2,
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "keepalive_expiry": self.limits.keepalive_expiry,
+            **counts,
+            **self.stats.snapshot(),
+        }
+
+
+class PoolRegistry:
+    """按上游名称管理多个 UpstreamPool，统一启动、关闭与统计。"""
+
+    def __init__(self, **pool_options: Any) -> None:
+        self._pool_options = pool_options
+        self._pools: Dict[str, UpstreamPool] = {}
+        self._started = False
+
+    def register(self, name: str, **overrides: Any) -> UpstreamPool:
+        pool = self._pools.get(name)
+        if pool is None:
+            pool = UpstreamPool(name, **{**self._pool_options, **overrides})
+            self._pools[name] = pool
+        return pool
+
+    async def get(self, name: str) -> UpstreamPool:
+        pool = self.register(name)
+        if self._started:
+            await pool.start()
+        return pool
+
+    async def start(self) -> None:
+        self._started = True
+        for pool in self._pools.values():
+            await pool.start()
+
+    async def close(self) -> None:
+        self._started = False
+        for pool in self._pools.values():
+            await pool.close()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {name: pool.snapshot() for name, pool in self._pools.items()}
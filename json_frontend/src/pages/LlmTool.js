@@ -185,7 +185,8 @@ imageInput.addEventListener('change', async () => {
   for (const file of files.slice(0, availableSlots)) {
     try {
       const dataUrl = await readFileAsDataURL(file);
-      selectedImages.push({ file, dataUrl });
+      // 选中即开始上传，用户输入提示词期间图片已写入后端，发送时只需引用 URL
+      selectedImages.push({ file, dataUrl, upload: uploadImage(file) });
     } catch (err) {
       console.error('读取图片失败', err);
       appendSystemMessage(`读取图片失败：${err.message || '未知错误'}`);
@@ -279,7 +280,10 @@ async function handleSend() {
   const text = promptInput.value.trim();
   const modelSupportsImage = supportsImage(modelSelect.value);
   // imageUrls：基于 imageList 数组生成的最终 URL 列表，稍后会注入 messages content 中
-  const imageUrls = modelSupportsImage ? selectedImages.map((item) => item.dataUrl) : [];
+  // 上传成功的图片使用后端返回的 URL，上传失败时回退为 data URL 内联发送
+  const imageUrls = modelSupportsImage
+    ? await Promise.all(selectedImages.map(async (item) => (await item.upload) || item.dataUrl))
+    : [];
   if (!text && imageUrls.length === 0) {
     alert('请输入提示词或选择一张图片。');
     return;
@@ -462,6 +466,26 @@ function readFileAsDataURL(file) {
   });
 }
 
+// 以原始图片字节上传到 /v1/images/upload，成功返回图片 URL，失败返回 null
+async function uploadImage(file) {
+  try {
+    const response = await fetch(api('/v1/images/upload'), {
+      method: 'POST',
+      headers: { 'Content-Type': file.type || 'application/octet-stream' },
+      body: file,
+    });
+    if (!response.ok) {
+      console.warn('图片上传失败，将以 data URL 发送', response.status, await response.text());
+      return null;
+    }
+    const data = await response.json();
+    return data.url || null;
+  } catch (err) {
+    console.warn('图片上传失败，将以 data URL 发送', err);
+    return null;
+  }
+}
+
 // 统一构造 API 地址，避免重复/缺失斜杠
 function api(path) {
   const base = normalizeBaseUrl(getBackendBase());
@@ -520,7 +544,8 @@ function appendUserMessage(text, imageDataUrls, timeText) {
     grid.style.display = 'grid';
     imageDataUrls.forEach((url) => {
       const img = document.createElement('img');
-      img.src = url;
+      // 已上传的图片在聊天记录中使用后端缩略图，点开前不加载原图
+      img.src = url.startsWith('data:') ? url : `${url}/thumb?size=256`;
       img.className = 'chat-img';
       grid.appendChild(img);
     });
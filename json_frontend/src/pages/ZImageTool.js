@@ -194,6 +194,7 @@ function initZImageTool() {
   };
 
   const pollers = new Map();
+  const streams = new Map();
   const state = {
     templateId: 'min',
     history: [],
@@ -553,6 +554,14 @@ function initZImageTool() {
     );
   }
 
+  function formatPendingText(item) {
+    if (item.status === 'failed') return '生成失败';
+    if (item.notice) return '等待 ComfyUI 响应…';
+    if (item.queuePosition) return `排队中（第 ${item.queuePosition} 位）`;
+    if (item.progress) return `生成中 ${Math.round(item.progress * 100)}%`;
+    return '生成中';
+  }
+
   function buildCard(item) {
     const card = document.createElement('div');
     card.className = 'zimage-item';
@@ -567,7 +576,7 @@ function initZImageTool() {
     } else {
       const placeholder = document.createElement('div');
       placeholder.className = 'zimage-placeholder';
-      placeholder.textContent = item.status === 'failed' ? '生成失败' : '生成中';
+      placeholder.textContent = formatPendingText(item);
       preview.appendChild(placeholder);
     }
 
@@ -637,6 +646,9 @@ function initZImageTool() {
         url: record.url,
         seed: record.seed,
         cfg: record.cfg,
+        progress: record.progress,
+        queuePosition: record.queuePosition,
+        notice: record.notice,
       });
     }
     });
@@ -721,17 +733,8 @@ function initZImageTool() {
           return;
         }
         if (data.images && data.images.length) {
-          const doneTs = record.doneTs || Date.now();
-          updateRecord(record.id, {
-            status: 'done',
-            images: data.images,
-            doneTs,
-            elapsedMs: record.startTs ? doneTs - record.startTs : null,
-            displayWidth: record.displayWidth ?? data.images[0]?.width ?? record.width,
-            displayHeight: record.displayHeight ?? data.images[0]?.height ?? record.height,
-          });
           pollers.delete(record.id);
-          fetchImageIndex();
+          completeRecord(record, data.images);
           return;
         }
         scheduleNextPoll(record, POLL_READY_DELAY_MS);
@@ -780,6 +783,88 @@ function initZImageTool() {
     scheduleNextPoll(record, POLL_INITIAL_DELAY_MS);
   }
 
+  function completeRecord(record, images) {
+    const doneTs = record.doneTs || Date.now();
+    updateRecord(record.id, {
+      status: 'done',
+      images,
+      doneTs,
+      elapsedMs: record.startTs ? doneTs - record.startTs : null,
+      displayWidth: record.displayWidth ?? images[0]?.width ?? record.width,
+      displayHeight: record.displayHeight ?? images[0]?.height ?? record.height,
+    });
+    fetchImageIndex();
+  }
+
+  function stopWatching(record) {
+    const source = streams.get(record.id);
+    if (source) {
+      source.close();
+      streams.delete(record.id);
+    }
+  }
+
+  // 优先订阅后端的任务事件流，由 ComfyUI 推送驱动；不支持或连接失败时退回轮询
+  function watchTask(record) {
+    if (streams.has(record.id) || pollers.has(record.id)) return;
+    if (typeof window.EventSource !== 'function') {
+      startPolling(record);
+      return;
+    }
+    const source = new window.EventSource(`${API_BASE}/api/tasks/${record.taskId}/events`);
+    streams.set(record.id, source);
+    let lastProgress = null;
+    let lastQueuePosition = null;
+    let lastNotice = '';
+
+    // 后端暂时连不上 ComfyUI 时仍发送 progress，message 中带原因，任务未失败
+    source.addEventListener('progress', (event) => {
+      const data = JSON.parse(event.data);
+      const progress = Math.round((data.progress || 0) * 100) / 100;
+      const queuePosition = data.queue_position ?? null;
+      const notice = data.message || '';
+      if (
+        progress === lastProgress &&
+        queuePosition === lastQueuePosition &&
+        notice === lastNotice
+      ) {
+        return;
+      }
+      lastProgress = progress;
+      lastQueuePosition = queuePosition;
+      lastNotice = notice;
+      updateRecord(record.id, { progress, queuePosition, notice });
+    });
+
+    source.addEventListener('done', (event) => {
+      stopWatching(record);
+      const data = JSON.parse(event.data);
+      if (data.images && data.images.length) {
+        completeRecord(record, data.images);
+        return;
+      }
+      startPolling(record);
+    });
+
+    source.addEventListener('failed', (event) => {
+      stopWatching(record);
+      const data = JSON.parse(event.data);
+      updateRecord(record.id, {
+        status: 'failed',
+        error: data.message || '生成失败',
+        doneTs: Date.now(),
+        elapsedMs: record.startTs ? Date.now() - record.startTs : null,
+      });
+      setError(data.message || '生成失败');
+      setStatus('生成失败');
+    });
+
+    source.onerror = () => {
+      stopWatching(record);
+      startPolling(record);
+    };
+  }
+
   async function handleGenerate() {
     if (ui.generateBtn.disabled) return;
     const width = readNumber(ui.width, 512);
@@ -876,7 +961,7 @@ function initZImageTool() {
       saveHistory();
       mergeHistory(state.remoteHistory);
       setStatus('任务已提交，等待生成结果');
-      startPolling(record);
+      watchTask(record);
     } catch (err) {
       setError(err?.message || '未知错误');
       setStatus('提交失败');
@@ -975,13 +1060,15 @@ function initZImageTool() {
       if (!record.startTs) {
         record.startTs = record.createdAt || Date.now();
       }
-      startPolling(record);
+      watchTask(record);
     });
   }
 
   function cleanupPollers() {
     pollers.forEach((state) => window.clearTimeout(state.timer));
     pollers.clear();
+    streams.forEach((source) => source.close());
+    streams.clear();
   }
 
   ui.templateInputs.forEach((input) => {
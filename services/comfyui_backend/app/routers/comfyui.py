@@ -1,8 +1,9 @@
 from __future__ import annotations
 
+import json
+import os
 import time
 import uuid
-from dataclasses import dataclass, field
 from typing import Any, Dict, List, Optional, Literal
 from urllib.parse import urlencode
 
@@ -12,25 +13,17 @@ from fastapi.responses import StreamingResponse
 from pydantic import AliasChoices, BaseModel, Field
 
 from app.services.comfyui_client import ComfyUIClient, ComfyUIError
-from app.services.workflow_builder import TemplateError, build_prompt
+from app.services.http_pool import comfyui_pool
+from app.services.progress import extract_images, progress_listener
+from app.services.task_store import TaskRecord, task_store
+from app.services.workflow_builder import TemplateError, build_prompt, template_registry
 
 
 router = APIRouter()
 
-
-@dataclass
-class TaskRecord:
-    task_id: str
-    prompt_id: str
-    status: str
-    progress: float
-    message: str
-    outputs: List[Dict[str, Any]] = field(default_factory=list)
-    params: Dict[str, Any] = field(default_factory=dict)
-    created_at: float = field(default_factory=time.time)
-
-
-_TASKS: Dict[str, TaskRecord] = {}
+# 非推送任务（websocket 未连接或由其他 worker 提交）的事件流轮询间隔
+_EVENTS_POLL_INTERVAL = float(os.getenv("TASK_EVENTS_POLL_INTERVAL", "2.0"))
+_EVENTS_KEEPALIVE = 15.0
 
 
 class GenerateRequest(BaseModel):
@@ -59,6 +52,8 @@ class TaskStatusResponse(BaseModel):
     progress: float
     message: str
     outputs: List[Dict[str, Any]]
+    queue_position: Optional[int] = None
+    node_progress: Dict[str, Any] = Field(default_factory=dict)
 
 
 class ImagesResponse(BaseModel):
@@ -71,27 +66,6 @@ def _normalize_status(status: str) -> str:
     return "running"
 
 
-def _extract_images(outputs: Dict[str, Any]) -> List[Dict[str, Any]]:
-    images: List[Dict[str, Any]] = []
-    for node_output in outputs.values():
-        if not isinstance(node_output, dict):
-            continue
-        for image in node_output.get("images", []) or []:
-            if not isinstance(image, dict):
-                continue
-            record = {
-                "filename": image.get("filename"),
-                "subfolder": image.get("subfolder") or "",
-                "type": image.get("type") or "output",
-            }
-            if image.get("width") is not None:
-                record["width"] = image.get("width")
-            if image.get("height") is not None:
-                record["height"] = image.get("height")
-            images.append(record)
-    return images
-
-
 def _normalize_download_name(filename: str, content_type: str | None) -> str:
     if "." in filename:
         return filename
@@ -100,23 +74,41 @@ def _normalize_download_name(filename: str, content_type: str | None) -> str:
     return f"{filename}.bin"
 
 
+async def _get_task(task_id: str) -> TaskRecord:
+    task = await task_store.get(task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+    # 推送中的任务以内存中的记录为准，库里的进度按节流写入，可能稍旧
+    return progress_listener.record(task.prompt_id) or task
+
+
 async def _refresh_task(task: TaskRecord, client: ComfyUIClient) -> None:
+    # failed 只来自 ComfyUI 的执行错误或中断，是最终状态；查询失败不会改变任务状态
+    if task.status in {"success", "failed"} or progress_listener.is_live(task.prompt_id):
+        return
+    before = (task.status, task.progress, task.message, len(task.outputs))
+    await _poll_history(task, client)
+    if (task.status, task.progress, task.message, len(task.outputs)) != before:
+        await task_store.put(task)
+
+
+async def _poll_history(task: TaskRecord, client: ComfyUIClient) -> None:
     try:
         history = await client.get_history(task.prompt_id)
     except ComfyUIError as exc:
-        task.status = "failed"
+        # 连不上 ComfyUI 只是暂时的：保留原状态，把原因放在 message 里，下次查询重试
         task.message = str(exc)
-        task.progress = 0.0
         return
 
     entry = history.get(task.prompt_id)
     if not isinstance(entry, dict):
         task.status = _normalize_status(task.status)
+        task.message = ""
         return
 
     outputs = entry.get("outputs") or {}
     if isinstance(outputs, dict) and outputs:
-        task.outputs = _extract_images(outputs)
+        task.outputs = extract_images(outputs)
         task.status = "success"
         task.progress = 1.0
         task.message = ""
@@ -132,6 +124,34 @@ async def _refresh_task(task: TaskRecord, client: ComfyUIClient) -> None:
 
     task.status = "running"
     task.progress = max(task.progress, 0.0)
+    task.message = ""
+
+
+def _image_records(task: TaskRecord, base_url: str) -> List[Dict[str, Any]]:
+    images: List[Dict[str, Any]] = []
+    for image in task.outputs:
+        if not image.get("filename"):
+            continue
+        params = {
+            "filename": image.get("filename"),
+            "subfolder": image.get("subfolder", ""),
+            "type": image.get("type", "output"),
+        }
+        url = f"{base_url}/images/view?{urlencode(params)}"
+        images.append({**image, "url": url})
+    return images
+
+
+def _task_event(task: TaskRecord, base_url: str) -> Dict[str, Any]:
+    return {
+        "task_id": task.task_id,
+        "status": task.status,
+        "progress": task.progress,
+        "message": task.message,
+        "queue_position": task.queue_position,
+        "node_progress": task.node_progress,
+        "images": _image_records(task, base_url),
+    }
 
 
 @router.post("/generate", response_model=GenerateResponse)
@@ -163,9 +183,11 @@ async def generate(request: GenerateRequest) -> GenerateResponse:
         raise HTTPException(status_code=400, detail=f"Template error: {exc}") from exc
 
     client = ComfyUIClient()
-    client_id = uuid.uuid4().hex
+    # 使用常驻 websocket 的 clientId 提交，ComfyUI 才会把该 prompt 的进度消息推给本进程
     try:
-        prompt_id = await client.submit_prompt(client_id=client_id, prompt=prompt)
+        prompt_id = await client.submit_prompt(
+            client_id=progress_listener.client_id, prompt=prompt
+        )
     except ComfyUIError as exc:
         detail = {
             "detail": str(exc),
@@ -175,22 +197,22 @@ async def generate(request: GenerateRequest) -> GenerateResponse:
         raise HTTPException(status_code=502, detail=detail) from exc
 
     task_id = uuid.uuid4().hex
-    _TASKS[task_id] = TaskRecord(
+    task = TaskRecord(
         task_id=task_id,
         prompt_id=prompt_id,
-        status="running",
+        status="queued",
         progress=0.0,
         message="",
         params=request.model_dump(),
     )
+    await progress_listener.track(task, prompt)
+    await task_store.put(task)
     return GenerateResponse(task_id=task_id, comfy_prompt_id=prompt_id)
 
 
 @router.get("/tasks/{task_id}", response_model=TaskStatusResponse)
 async def get_task(task_id: str) -> TaskStatusResponse:
-    task = _TASKS.get(task_id)
-    if not task:
-        raise HTTPException(status_code=404, detail="Task not found")
+    task = await _get_task(task_id)
 
     client = ComfyUIClient()
     await _refresh_task(task, client)
@@ -199,14 +221,14 @@ async def get_task(task_id: str) -> TaskStatusResponse:
         progress=task.progress,
         message=task.message,
         outputs=task.outputs,
+        queue_position=task.queue_position,
+        node_progress=task.node_progress,
     )
 
 
 @router.get("/tasks/{task_id}/images", response_model=ImagesResponse)
 async def get_task_images(task_id: str, request: Request) -> ImagesResponse:
-    task = _TASKS.get(task_id)
-    if not task:
-        raise HTTPException(status_code=404, detail="Task not found")
+    task = await _get_task(task_id)
 
     if not task.outputs:
         client = ComfyUIClient()
@@ -215,28 +237,60 @@ async def get_task_images(task_id: str, request: Request) -> ImagesResponse:
     if not task.outputs:
         return ImagesResponse(images=[])
 
+    return ImagesResponse(images=_image_records(task, str(request.base_url).rstrip("/")))
+
+
+@router.get("/tasks/{task_id}/events")
+async def task_events(task_id: str, request: Request) -> StreamingResponse:
+    """
+    任务状态的 server-sent events：状态或进度变化时发送 progress 事件，
+    完成时发送 done（附带图片地址）或 failed 事件后结束。
+
+    failed 只表示 ComfyUI 执行出错或被中断；暂时连不上 ComfyUI 时任务保持原状态，
+    以带 message 的 progress 事件告知，恢复后继续推送。
+    """
+    task = await _get_task(task_id)
     base_url = str(request.base_url).rstrip("/")
-    images: List[Dict[str, Any]] = []
-    for image in task.outputs:
-        if not image.get("filename"):
-            continue
-        params = {
-            "filename": image.get("filename"),
-            "subfolder": image.get("subfolder", ""),
-            "type": image.get("type", "output"),
-        }
-        url = f"{base_url}/images/view?{urlencode(params)}"
-        record = {**image, "url": url}
-        images.append(record)
 
-    return ImagesResponse(images=images)
+    async def _stream() -> Any:
+        current = task
+        last_payload: Optional[Dict[str, Any]] = None
+        last_sent = time.monotonic()
+        last_poll = float("-inf")
+        while True:
+            live = progress_listener.record(current.prompt_id)
+            if live is not None:
+                current = live
+            elif time.monotonic() - last_poll >= _EVENTS_POLL_INTERVAL:
+                last_poll = time.monotonic()
+                current = await task_store.get(task_id) or current
+                await _refresh_task(current, ComfyUIClient())
+
+            payload = _task_event(current, base_url)
+            if payload != last_payload:
+                if current.status == "success":
+                    event = "done"
+                elif current.status == "failed":
+                    event = "failed"
+                else:
+                    event = "progress"
+                yield f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+                last_payload = payload
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent >= _EVENTS_KEEPALIVE:
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+            if current.status in {"success", "failed"}:
+                return
+            await progress_listener.wait(current.prompt_id, _EVENTS_POLL_INTERVAL)
+
+    headers = {"Cache-Control": "no-store", "X-Accel-Buffering": "no"}
+    return StreamingResponse(_stream(), media_type="text/event-stream", headers=headers)
 
 
 @router.get("/tasks/{task_id}/image")
 async def download_first_image(task_id: str) -> StreamingResponse:
-    task = _TASKS.get(task_id)
-    if not task:
-        raise HTTPException(status_code=404, detail="Task not found")
+    task = await _get_task(task_id)
 
     if not task.outputs:
         client = ComfyUIClient()
@@ -259,17 +313,18 @@ async def download_first_image(task_id: str) -> StreamingResponse:
 
     async def _proxy_stream() -> Any:
         timeout = httpx.Timeout(120.0, connect=10.0)
-        async with httpx.AsyncClient(timeout=timeout) as http_client:
-            async with http_client.stream("GET", view_url, params=params) as response:
-                try:
-                    response.raise_for_status()
-                except httpx.HTTPStatusError as exc:
-                    raise HTTPException(
-                        status_code=exc.response.status_code,
-                        detail=exc.response.text,
-                    ) from exc
-                async for chunk in response.aiter_bytes():
-                    yield chunk
+        async with client.http_client.stream(
+            "GET", view_url, params=params, timeout=timeout
+        ) as response:
+            try:
+                response.raise_for_status()
+            except httpx.HTTPStatusError as exc:
+                raise HTTPException(
+                    status_code=exc.response.status_code,
+                    detail=exc.response.text,
+                ) from exc
+            async for chunk in response.aiter_bytes():
+                yield chunk
 
     filename = _normalize_download_name(
         image.get("filename", "image"),
@@ -293,17 +348,18 @@ async def proxy_file(
 
     async def _proxy_stream() -> Any:
         timeout = httpx.Timeout(120.0, connect=10.0)
-        async with httpx.AsyncClient(timeout=timeout) as http_client:
-            async with http_client.stream("GET", view_url, params=params) as response:
-                try:
-                    response.raise_for_status()
-                except httpx.HTTPStatusError as exc:
-                    raise HTTPException(
-                        status_code=exc.response.status_code,
-                        detail=exc.response.text,
-                    ) from exc
-                async for chunk in response.aiter_bytes():
-                    yield chunk
+        async with client.http_client.stream(
+            "GET", view_url, params=params, timeout=timeout
+        ) as response:
+            try:
+                response.raise_for_status()
+            except httpx.HTTPStatusError as exc:
+                raise HTTPException(
+                    status_code=exc.response.status_code,
+                    detail=exc.response.text,
+                ) from exc
+            async for chunk in response.aiter_bytes():
+                yield chunk
 
     return StreamingResponse(_proxy_stream(), media_type="application/octet-stream")
 
@@ -333,3 +389,23 @@ async def proxy_image(
         "Cache-Control": "no-store",
     }
     return StreamingResponse(_proxy_stream(), headers=headers, media_type="image/png")
+
+
+@router.get("/admin/pool")
+async def pool_stats() -> Dict[str, Any]:
+    return comfyui_pool.snapshot()
+
+
+@router.get("/admin/tasks")
+async def task_store_stats() -> Dict[str, Any]:
+    return await task_store.snapshot()
+
+
+@router.get("/admin/progress")
+async def progress_stats() -> Dict[str, Any]:
+    return progress_listener.snapshot()
+
+
+@router.get("/admin/templates")
+async def template_stats() -> Dict[str, Any]:
+    return template_registry.snapshot()
@@ -5,6 +5,8 @@ from typing import Any, Dict
 
 import httpx
 
+from app.services.http_pool import UpstreamPool, comfyui_pool
+
 
 class ComfyUIError(RuntimeError):
     def __init__(
@@ -21,8 +23,13 @@ class ComfyUIError(RuntimeError):
 
 
 class ComfyUIClient:
-    def __init__(self, base_url: str | None = None) -> None:
+    def __init__(self, base_url: str | None = None, pool: UpstreamPool | None = None) -> None:
         self.base_url = base_url or os.getenv("COMFYUI_BASE_URL", "http://192.168.1.28:8188")
+        self.pool = pool or comfyui_pool
+
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        return self.pool.client
 
     async def submit_prompt(self, client_id: str, prompt: Dict[str, Any]) -> str:
         payload = {"client_id": client_id, "prompt": prompt}
@@ -49,6 +56,15 @@ class ComfyUIClient:
         response = await self._request("GET", f"/history/{prompt_id}")
         return response.json()
 
+    async def get_queue(self) -> Dict[str, Any]:
+        response = await self._request("GET", "/queue")
+        return response.json()
+
+    def build_ws_url(self, client_id: str) -> str:
+        scheme, sep, rest = self.base_url.partition("://")
+        ws_scheme = "wss" if scheme == "https" else "ws"
+        return f"{ws_scheme}{sep}{rest}/ws?clientId={client_id}"
+
     def build_view_url(self) -> str:
         return f"{self.base_url}/view"
 
@@ -58,26 +74,25 @@ class ComfyUIClient:
     async def _request(self, method: str, path: str, **kwargs: Any) -> httpx.Response:
         url = f"{self.base_url}{path}"
         timeout = kwargs.pop("timeout", httpx.Timeout(60.0, connect=10.0))
-        async with httpx.AsyncClient(timeout=timeout) as client:
+        try:
+            response = await self.http_client.request(method, url, timeout=timeout, **kwargs)
+            response.raise_for_status()
+            return response
+        except httpx.HTTPStatusError as exc:
+            response_text = exc.response.text
+            response_json = None
             try:
-                response = await client.request(method, url, **kwargs)
-                response.raise_for_status()
-                return response
-            except httpx.HTTPStatusError as exc:
-                response_text = exc.response.text
+                response_json = exc.response.json()
+            except ValueError:
                 response_json = None
-                try:
-                    response_json = exc.response.json()
-                except ValueError:
-                    response_json = None
-                raise ComfyUIError(
-                    "ComfyUI returned non-2xx response",
-                    status_code=exc.response.status_code,
-                    response_text=response_text,
-                    response_json=response_json,
-                ) from exc
-            except httpx.HTTPError as exc:
-                raise ComfyUIError(f"Failed to reach ComfyUI: {exc}") from exc
+            raise ComfyUIError(
+                "ComfyUI returned non-2xx response",
+                status_code=exc.response.status_code,
+                response_text=response_text,
+                response_json=response_json,
+            ) from exc
+        except httpx.HTTPError as exc:
+            raise ComfyUIError(f"Failed to reach ComfyUI: {exc}") from exc
 
     async def stream_image(
         self, filename: str, subfolder: str = "", file_type: str = "output"
@@ -85,18 +100,19 @@ class ComfyUIClient:
         url = self.build_files_url()
         params = {"filename": filename, "subfolder": subfolder, "type": file_type}
         timeout = httpx.Timeout(120.0, connect=10.0)
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            try:
-                async with client.stream("GET", url, params=params) as response:
-                    response.raise_for_status()
-                    async for chunk in response.aiter_bytes():
-                        yield chunk
-            except httpx.HTTPStatusError as exc:
-                response_text = exc.response.text
-                raise ComfyUIError(
-                    "ComfyUI returned non-2xx response",
-                    status_code=exc.response.status_code,
-                    response_text=response_text,
-                ) from exc
-            except httpx.HTTPError as exc:
-                raise ComfyUIError(f"Failed to reach ComfyUI: {exc}") from exc
+        try:
+            async with self.http_client.stream(
+                "GET", url, params=params, timeout=timeout
+            ) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes():
+                    yield chunk
+        except httpx.HTTPStatusError as exc:
+            response_text = exc.response.text
+            raise ComfyUIError(
+                "ComfyUI returned non-2xx response",
+                status_code=exc.response.status_code,
+                response_text=response_text,
+            ) from exc
+        except httpx.HTTPError as exc:
+            raise ComfyUIError(f"Failed to reach ComfyUI: {exc}") from exc
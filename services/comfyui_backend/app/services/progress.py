@@ -0,0 +1,359 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set
+
+from app.services.comfyui_client import ComfyUIClient, ComfyUIError
+from app.services.task_store import TaskRecord, task_store
+
+try:  # websockets 随 uvicorn[standard] 安装；缺失时退回轮询 /history
+    import websockets
+except ImportError:  # pragma: no cover - 取决于部署环境
+    websockets = None  # type: ignore[assignment]
+
+# 进度消息很密集（每个采样步一条），写库最多每隔该秒数一次；状态变化总是立即写入
+_SAVE_INTERVAL = 0.5
+# 提交请求返回前就收到的消息先缓存起来，登记任务时回放
+_MAX_ORPHAN_PROMPTS = 64
+_MAX_ORPHAN_MESSAGES = 256
+
+
+def extract_images(outputs: Dict[str, Any]) -> List[Dict[str, Any]]:
+    images: List[Dict[str, Any]] = []
+    for node_output in outputs.values():
+        if not isinstance(node_output, dict):
+            continue
+        for image in node_output.get("images", []) or []:
+            if not isinstance(image, dict):
+                continue
+            record = {
+                "filename": image.get("filename"),
+                "subfolder": image.get("subfolder") or "",
+                "type": image.get("type") or "output",
+            }
+            if image.get("width") is not None:
+                record["width"] = image.get("width")
+            if image.get("height") is not None:
+                record["height"] = image.get("height")
+            images.append(record)
+    return images
+
+
+class _Tracked:
+    __slots__ = (
+        "record",
+        "class_types",
+        "completed",
+        "current",
+        "outputs",
+        "saved_at",
+        "changed",
+    )
+
+    def __init__(self, record: TaskRecord, prompt: Dict[str, Any]) -> None:
+        self.record = record
+        self.class_types = {
+            node_id: node.get("class_type") for node_id, node in prompt.items()
+        }
+        self.completed: Set[str] = set()
+        self.current: Optional[str] = None
+        self.outputs: Dict[str, Any] = {}
+        self.saved_at = 0.0
+        self.changed = asyncio.Event()
+
+    def notify(self) -> None:
+        # 同 ResumableStream：唤醒全部等待者后换新的 Event
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def update_progress(self, value: float = 0.0, maximum: float = 0.0) -> None:
+        total = max(len(self.class_types), 1)
+        fraction = value / maximum if maximum > 0 else 0.0
+        done = len(self.completed) + (fraction if self.current not in self.completed else 0.0)
+        # 输出图片拿到之前不报告 100%
+        self.record.progress = round(min(done / total, 0.99), 4)
+        self.record.node_progress = {
+            "node": self.current,
+            "class_type": self.class_types.get(self.current) if self.current else None,
+            "value": value,
+            "max": maximum,
+            "completed_nodes": len(self.completed),
+            "total_nodes": len(self.class_types),
+        }
+
+
+class ProgressListener:
+    """
+    与 ComfyUI /ws?clientId=... 保持一条长连接，本进程提交的 prompt 都使用这个 clientId，
+    由 progress / executing / executed 等消息实时更新任务记录，替代逐个任务轮询 /history。
+
+    连接断开时已登记的任务可能漏掉消息，全部交还给 /history 轮询收尾，
+    重连后新提交的任务重新走推送。
+    """
+
+    def __init__(self, client: Optional[ComfyUIClient] = None, enabled: bool = True) -> None:
+        self.client = client or ComfyUIClient()
+        self.client_id = uuid.uuid4().hex
+        self.enabled = enabled and websockets is not None
+        if enabled and websockets is None:
+            print("[WARN] websockets is not installed, task progress falls back to polling")
+        self.connected = False
+        self._tracked: Dict[str, _Tracked] = {}
+        self._orphans: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+        # 刚结束的 prompt，忽略其后续消息（如 executing node=None 之后的 execution_success）
+        self._finished: "OrderedDict[str, None]" = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+        self._queue_task: Optional[asyncio.Task] = None
+        self._queue_dirty = False
+        self.counters: Dict[str, int] = {
+            "connects": 0,
+            "disconnects": 0,
+            "messages": 0,
+            "tracked": 0,
+            "completed": 0,
+            "failed": 0,
+            "history_fallbacks": 0,
+            "queue_refreshes": 0,
+        }
+
+    def is_live(self, prompt_id: str) -> bool:
+        return self.connected and prompt_id in self._tracked
+
+    def record(self, prompt_id: str) -> Optional[TaskRecord]:
+        entry = self._tracked.get(prompt_id)
+        return entry.record if entry is not None else None
+
+    async def wait(self, prompt_id: str, timeout: float) -> bool:
+        """等待任务状态变化；不是实时任务时只是睡眠 timeout 秒。"""
+        entry = self._tracked.get(prompt_id)
+        if entry is None:
+            await asyncio.sleep(timeout)
+            return False
+        try:
+            await asyncio.wait_for(entry.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def track(self, record: TaskRecord, prompt: Dict[str, Any]) -> bool:
+        """登记刚提交的任务（必须使用 self.client_id 提交）；返回是否由推送更新。"""
+        if not self.connected:
+            return False
+        self._tracked[record.prompt_id] = _Tracked(record, prompt)
+        self.counters["tracked"] += 1
+        for message in self._orphans.pop(record.prompt_id, []):
+            await self._handle(message)
+        if record.status == "queued":
+            self._refresh_queue()
+        return True
+
+    async def _save(self, entry: _Tracked, force: bool = False) -> None:
+        entry.notify()
+        now = time.monotonic()
+        if force or now - entry.saved_at >= _SAVE_INTERVAL:
+            entry.saved_at = now
+            await task_store.put(entry.record)
+
+    async def _finish(self, prompt_id: str, status: str, message: str = "") -> None:
+        entry = self._tracked.pop(prompt_id, None)
+        if entry is None:
+            return
+        self._finished[prompt_id] = None
+        while len(self._finished) > _MAX_ORPHAN_PROMPTS:
+            self._finished.popitem(last=False)
+        record = entry.record
+        if status == "success":
+            images = extract_images(entry.outputs)
+            if not images:
+                # 全部命中缓存的节点不会发送 executed，输出只能从 history 取
+                self.counters["history_fallbacks"] += 1
+                try:
+                    history = await self.client.get_history(prompt_id)
+                    history_entry = history.get(prompt_id)
+                    if isinstance(history_entry, dict):
+                        images = extract_images(history_entry.get("outputs") or {})
+                except ComfyUIError as exc:
+                    # 任务已不再登记，之后的查询会照常轮询 /history 取结果
+                    print(f"[WARN] failed to fetch history for {prompt_id}: {exc}")
+                    entry.notify()
+                    return
+            record.outputs = images
+            record.progress = 1.0
+            self.counters["completed"] += 1
+        else:
+            self.counters["failed"] += 1
+        record.status = status
+        record.message = message
+        record.queue_position = None
+        await self._save(entry, force=True)
+
+    def _buffer_orphan(self, prompt_id: str, message: Dict[str, Any]) -> None:
+        messages = self._orphans.setdefault(prompt_id, [])
+        if len(messages) < _MAX_ORPHAN_MESSAGES:
+            messages.append(message)
+        while len(self._orphans) > _MAX_ORPHAN_PROMPTS:
+            self._orphans.popitem(last=False)
+
+    async def _handle(self, message: Dict[str, Any]) -> None:
+        kind = message.get("type")
+        data = message.get("data")
+        if not isinstance(data, dict):
+            return
+        if kind == "status":
+            if any(entry.record.status == "queued" for entry in self._tracked.values()):
+                self._refresh_queue()
+            return
+        prompt_id = data.get("prompt_id")
+        if not prompt_id:
+            return
+        entry = self._tracked.get(prompt_id)
+        if entry is None:
+            if prompt_id not in self._finished:
+                self._buffer_orphan(prompt_id, message)
+            return
+        record = entry.record
+
+        if kind == "execution_start":
+            record.status = "running"
+            record.queue_position = None
+            entry.update_progress()
+            await self._save(entry, force=True)
+        elif kind == "execution_cached":
+            entry.completed.update(str(node) for node in data.get("nodes") or ())
+            entry.update_progress()
+            await self._save(entry)
+        elif kind == "executing":
+            node = data.get("node")
+            if entry.current is not None:
+                entry.completed.add(entry.current)
+            if node is None:
+                # 旧版 ComfyUI 以 node=None 表示整个 prompt 执行完毕
+                await self._finish(prompt_id, "success")
+                return
+            entry.current = str(node)
+            record.status = "running"
+            entry.update_progress()
+            await self._save(entry)
+        elif kind == "progress":
+            if data.get("node") is not None:
+                entry.current = str(data["node"])
+            entry.update_progress(float(data.get("value") or 0), float(data.get("max") or 0))
+            await self._save(entry)
+        elif kind == "executed":
+            node = str(data.get("node"))
+            entry.outputs[node] = data.get("output") or {}
+            entry.completed.add(node)
+            entry.update_progress()
+            await self._save(entry)
+        elif kind == "execution_success":
+            await self._finish(prompt_id, "success")
+        elif kind == "execution_error":
+            detail = data.get("exception_message") or data.get("exception_type") or "execution error"
+            await self._finish(prompt_id, "failed", str(detail).strip())
+        elif kind == "execution_interrupted":
+            await self._finish(prompt_id, "failed", "interrupted")
+
+    def _refresh_queue(self) -> None:
+        # 队列变化时 ComfyUI 广播 status 消息；同一时间只有一个 /queue 请求，期间的变化合并处理
+        if self._queue_task is not None and not self._queue_task.done():
+            self._queue_dirty = True
+            return
+        self._queue_task = asyncio.create_task(self._update_queue_positions())
+
+    async def _update_queue_positions(self) -> None:
+        while True:
+            self._queue_dirty = False
+            try:
+                queue = await self.client.get_queue()
+            except ComfyUIError as exc:
+                print(f"[WARN] failed to fetch ComfyUI queue: {exc}")
+                return
+            self.counters["queue_refreshes"] += 1
+            pending = sorted(
+                (item for item in queue.get("queue_pending") or [] if len(item) > 1),
+                key=lambda item: item[0],
+            )
+            positions = {item[1]: index + 1 for index, item in enumerate(pending)}
+            for prompt_id, entry in list(self._tracked.items()):
+                record = entry.record
+                position = positions.get(prompt_id)
+                if record.status == "queued" and position != record.queue_position:
+                    record.queue_position = position
+                    await self._save(entry, force=True)
+            if not self._queue_dirty:
+                return
+
+    async def _run(self) -> None:
+        url = self.client.build_ws_url(self.client_id)
+        delay = 1.0
+        while True:
+            try:
+                async with websockets.connect(
+                    url, max_size=None, open_timeout=10, ping_interval=20, ping_timeout=20
+                ) as connection:
+                    self.connected = True
+                    self.counters["connects"] += 1
+                    delay = 1.0
+                    print(f"[INFO] connected to ComfyUI websocket {url}")
+                    async for raw in connection:
+                        if isinstance(raw, bytes):
+                            # 二进制帧是采样预览图，不需要
+                            continue
+                        self.counters["messages"] += 1
+                        try:
+                            message = json.loads(raw)
+                        except ValueError:
+                            continue
+                        if isinstance(message, dict):
+                            await self._handle(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                print(f"[WARN] ComfyUI websocket error: {exc}")
+            finally:
+                if self.connected:
+                    self.connected = False
+                    # 已登记的任务可能漏掉消息，改由 /history 轮询收尾
+                    self.counters["disconnects"] += 1
+                    for entry in self._tracked.values():
+                        entry.notify()
+                    self._tracked.clear()
+                    self._orphans.clear()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+    def start(self) -> None:
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        for task in (self._task, self._queue_task):
+            if task is None:
+                continue
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        self._queue_task = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "connected": self.connected,
+            "client_id": self.client_id,
+            "live_tasks": len(self._tracked),
+            "orphan_prompts": len(self._orphans),
+            **self.counters,
+        }
+
+
+progress_listener = ProgressListener(
+    enabled=os.getenv("COMFYUI_WS_ENABLED", "1").lower() in {"1", "true", "yes"}
+)
@@ -0,0 +1,306 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional
+
+
+@dataclass
+class TaskRecord:
+    task_id: str
+    prompt_id: str
+    status: str
+    progress: float
+    message: str
+    outputs: List[Dict[str, Any]] = field(default_factory=list)
+    params: Dict[str, Any] = field(default_factory=dict)
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+    # 排队中时在 ComfyUI 等待队列里的位置（从 1 开始），其余状态为 None
+    queue_position: Optional[int] = None
+    # 当前执行节点及其步数进度，来自 ComfyUI websocket 推送
+    node_progress: Dict[str, Any] = field(default_factory=dict)
+
+
+class TaskStore(ABC):
+    """
+    任务记录存储接口：按 task_id 与 prompt_id 查询，超过 ttl 未更新或超出 max_records
+    的记录（按最近更新时间）被淘汰。所有方法都是协程，后端可以在线程中执行阻塞 I/O。
+    """
+
+    def __init__(self, ttl: float, max_records: int) -> None:
+        self.ttl = ttl
+        self.max_records = max_records
+        self.counters: Dict[str, int] = {"puts": 0, "hits": 0, "misses": 0, "evicted": 0}
+
+    @abstractmethod
+    async def get(self, task_id: str) -> Optional[TaskRecord]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_by_prompt(self, prompt_id: str) -> Optional[TaskRecord]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def put(self, record: TaskRecord) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete(self, task_id: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def prune(self) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def count(self) -> int:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+    def _record_lookup(self, record: Optional[TaskRecord]) -> Optional[TaskRecord]:
+        self.counters["hits" if record is not None else "misses"] += 1
+        return record
+
+    async def snapshot(self) -> Dict[str, Any]:
+        return {
+            "backend": type(self).__name__,
+            "records": await self.count(),
+            "ttl_seconds": self.ttl,
+            "max_records": self.max_records,
+            **self.counters,
+        }
+
+
+class InMemoryTaskStore(TaskStore):
+    """单进程内存存储，按最近更新顺序排列，便于从头部淘汰。"""
+
+    def __init__(self, ttl: float, max_records: int) -> None:
+        super().__init__(ttl, max_records)
+        self._records: "OrderedDict[str, TaskRecord]" = OrderedDict()
+        self._by_prompt: Dict[str, str] = {}
+
+    def _remove(self, task_id: str) -> None:
+        record = self._records.pop(task_id, None)
+        if record is not None and self._by_prompt.get(record.prompt_id) == task_id:
+            del self._by_prompt[record.prompt_id]
+
+    async def get(self, task_id: str) -> Optional[TaskRecord]:
+        record = self._records.get(task_id)
+        if record is not None and time.time() - record.updated_at > self.ttl:
+            self._remove(task_id)
+            self.counters["evicted"] += 1
+            record = None
+        return self._record_lookup(record)
+
+    async def get_by_prompt(self, prompt_id: str) -> Optional[TaskRecord]:
+        task_id = self._by_prompt.get(prompt_id)
+        return await self.get(task_id) if task_id else self._record_lookup(None)
+
+    async def put(self, record: TaskRecord) -> None:
+        record.updated_at = time.time()
+        self._records[record.task_id] = record
+        self._records.move_to_end(record.task_id)
+        self._by_prompt[record.prompt_id] = record.task_id
+        self.counters["puts"] += 1
+        await self.prune()
+
+    async def delete(self, task_id: str) -> bool:
+        if task_id not in self._records:
+            return False
+        self._remove(task_id)
+        return True
+
+    async def prune(self) -> int:
+        removed = 0
+        cutoff = time.time() - self.ttl
+        while self._records:
+            task_id, record = next(iter(self._records.items()))
+            if len(self._records) <= self.max_records and record.updated_at >= cutoff:
+                break
+            self._remove(task_id)
+            removed += 1
+        self.counters["evicted"] += removed
+        return removed
+
+    async def count(self) -> int:
+        return len(self._records)
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    task_id TEXT PRIMARY KEY,
+    prompt_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    progress REAL NOT NULL,
+    message TEXT NOT NULL,
+    outputs TEXT NOT NULL,
+    params TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    queue_position INTEGER,
+    node_progress TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS tasks_prompt_id ON tasks (prompt_id);
+CREATE INDEX IF NOT EXISTS tasks_updated_at ON tasks (updated_at);
+"""
+
+_COLUMNS = (
+    "task_id, prompt_id, status, progress, message, outputs, params, created_at, updated_at, "
+    "queue_position, node_progress"
+)
+
+# 旧版本创建的数据库缺少的列
+_MIGRATIONS = {
+    "queue_position": "ALTER TABLE tasks ADD COLUMN queue_position INTEGER",
+    "node_progress": "ALTER TABLE tasks ADD COLUMN node_progress TEXT NOT NULL DEFAULT '{}'",
+}
+
+
+def _row_to_record(row: Optional[sqlite3.Row]) -> Optional[TaskRecord]:
+    if row is None:
+        return None
+    data = dict(row)
+    data["outputs"] = json.loads(data["outputs"])
+    data["params"] = json.loads(data["params"])
+    data["node_progress"] = json.loads(data["node_progress"])
+    return TaskRecord(**data)
+
+
+class SQLiteTaskStore(TaskStore):
+    """
+    SQLite（WAL 模式）存储：同一主机上的多个 uvicorn worker 共享同一个数据库文件，
+    重启后任务记录仍然可查。查询在线程中执行，不阻塞事件循环；淘汰最多每
+    prune_interval 秒执行一次。
+    """
+
+    def __init__(
+        self, path: str, ttl: float, max_records: int, prune_interval: float = 60.0
+    ) -> None:
+        super().__init__(ttl, max_records)
+        self.path = path
+        self.prune_interval = prune_interval
+        self._last_prune = 0.0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("PRAGMA busy_timeout=30000")
+            self._conn.executescript(_SCHEMA)
+            columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(tasks)")}
+            for column, statement in _MIGRATIONS.items():
+                if column not in columns:
+                    self._conn.execute(statement)
+            self._conn.commit()
+
+    def _execute(self, sql: str, params: Any = ()) -> List[sqlite3.Row]:
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            rows = cursor.fetchall()
+            self._conn.commit()
+            return rows
+
+    def _execute_count(self, sql: str, params: Any = ()) -> int:
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            self._conn.commit()
+            return cursor.rowcount
+
+    async def get(self, task_id: str) -> Optional[TaskRecord]:
+        rows = await asyncio.to_thread(
+            self._execute,
+            f"SELECT {_COLUMNS} FROM tasks WHERE task_id = ? AND updated_at >= ?",
+            (task_id, time.time() - self.ttl),
+        )
+        return self._record_lookup(_row_to_record(rows[0] if rows else None))
+
+    async def get_by_prompt(self, prompt_id: str) -> Optional[TaskRecord]:
+        rows = await asyncio.to_thread(
+            self._execute,
+            f"SELECT {_COLUMNS} FROM tasks WHERE prompt_id = ? AND updated_at >= ? "
+            "ORDER BY updated_at DESC LIMIT 1",
+            (prompt_id, time.time() - self.ttl),
+        )
+        return self._record_lookup(_row_to_record(rows[0] if rows else None))
+
+    async def put(self, record: TaskRecord) -> None:
+        record.updated_at = time.time()
+        data = asdict(record)
+        data["outputs"] = json.dumps(data["outputs"], ensure_ascii=False)
+        data["params"] = json.dumps(data["params"], ensure_ascii=False)
+        data["node_progress"] = json.dumps(data["node_progress"], ensure_ascii=False)
+        await asyncio.to_thread(
+            self._execute,
+            f"INSERT OR REPLACE INTO tasks ({_COLUMNS}) VALUES "
+            "(:task_id, :prompt_id, :status, :progress, :message, :outputs, :params, "
+            ":created_at, :updated_at, :queue_position, :node_progress)",
+            data,
+        )
+        self.counters["puts"] += 1
+        if record.updated_at - self._last_prune >= self.prune_interval:
+            await self.prune()
+
+    async def delete(self, task_id: str) -> bool:
+        removed = await asyncio.to_thread(
+            self._execute_count, "DELETE FROM tasks WHERE task_id = ?", (task_id,)
+        )
+        return removed > 0
+
+    def _prune(self) -> int:
+        with self._lock:
+            expired = self._conn.execute(
+                "DELETE FROM tasks WHERE updated_at < ?", (time.time() - self.ttl,)
+            ).rowcount
+            overflow = self._conn.execute(
+                "DELETE FROM tasks WHERE task_id IN ("
+                "SELECT task_id FROM tasks ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_records,),
+            ).rowcount
+            self._conn.commit()
+        return expired + overflow
+
+    async def prune(self) -> int:
+        self._last_prune = time.time()
+        removed = await asyncio.to_thread(self._prune)
+        self.counters["evicted"] += removed
+        return removed
+
+    async def count(self) -> int:
+        rows = await asyncio.to_thread(self._execute, "SELECT COUNT(*) FROM tasks")
+        return int(rows[0][0])
+
+    async def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    async def snapshot(self) -> Dict[str, Any]:
+        return {**await super().snapshot(), "path": self.path}
+
+
+def create_task_store() -> TaskStore:
+    backend = os.getenv("TASK_STORE", "sqlite").lower()
+    ttl = float(os.getenv("TASK_TTL_SECONDS", str(7 * 24 * 3600)))
+    max_records = int(os.getenv("TASK_MAX_RECORDS", "10000"))
+    if backend == "memory":
+        return InMemoryTaskStore(ttl, max_records)
+    if backend != "sqlite":
+        raise ValueError(f"unknown TASK_STORE {backend!r}, expected 'memory' or 'sqlite'")
+    default_path = os.path.join(os.path.dirname(__file__), "..", "..", "data", "tasks.sqlite3")
+    path = os.getenv("TASK_STORE_PATH", os.path.abspath(default_path))
+    return SQLiteTaskStore(path, ttl, max_records)
+
+
+task_store = create_task_store()
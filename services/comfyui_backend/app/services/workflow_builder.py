@@ -2,8 +2,10 @@ from __future__ import annotations
 
 import json
 import os
-from copy import deepcopy
-from typing import Any, Dict, Optional
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Mapping, Optional, Tuple
 
 
 class TemplateError(ValueError):
@@ -75,6 +77,173 @@ def _ensure_inputs(prompt: Dict[str, Any], node_id: str) -> Dict[str, Any]:
     return inputs
 
 
+@dataclass(frozen=True)
+class _Slots:
+    """模板中需要按请求改写的输入位置，加载模板时确定并校验。"""
+
+    text: Tuple[str, str]
+    seed: Tuple[str, str]
+    size: str
+    batch_size: bool
+    samplers: Tuple[str, ...]
+    lora_upscale: bool
+
+
+@dataclass(frozen=True)
+class CompiledTemplate:
+    template_id: str
+    path: str
+    mtime: float
+    # 基础节点图，编译后不再修改；请求只复制被改写的节点，其余节点共享
+    nodes: Mapping[str, Mapping[str, Any]]
+    slots: _Slots
+    loaded_at: float
+
+
+# lora_upscale 模板中 LoRA 与放大开关需要改写的节点
+_LORA_UPSCALE_NODES = ("9", "39", "43", "45", "46", "47", "48", "49", "50")
+
+
+def _compile(template_id: str) -> CompiledTemplate:
+    path = _template_path(template_id)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError as exc:
+        raise TemplateError(f"Template file not found: {path}") from exc
+    prompt = _extract_prompt(_load_template(template_id))
+
+    if template_id == "qwen_2512":
+        text, seed, size, batch_size = ("91", "value"), ("86:3", "seed"), "86:58", False
+    else:
+        text, seed, size, batch_size = ("45", "text"), ("44", "seed"), "41", True
+    lora_upscale = template_id == "lora_upscale"
+    required = [text[0], seed[0], size]
+    if lora_upscale:
+        required.extend(_LORA_UPSCALE_NODES)
+    for node_id in required:
+        _ensure_inputs(prompt, node_id)
+
+    samplers = tuple(
+        node_id
+        for node_id, node in prompt.items()
+        if isinstance(node.get("class_type"), str)
+        and node["class_type"].startswith("KSampler")
+        and isinstance(node.get("inputs"), dict)
+    )
+    if not samplers:
+        print(f"[WARN] template {template_id} has no KSampler node, cfg will not be applied")
+
+    return CompiledTemplate(
+        template_id=template_id,
+        path=path,
+        mtime=mtime,
+        nodes=prompt,
+        slots=_Slots(text, seed, size, batch_size, samplers, lora_upscale),
+        loaded_at=time.time(),
+    )
+
+
+class TemplateRegistry:
+    """
+    启动时加载并校验全部模板，编译结果常驻内存；请求时最多每 check_interval 秒
+    检查一次文件 mtime，变化后自动重新编译。重新编译失败时继续使用上一个可用版本。
+    """
+
+    def __init__(self, template_ids: List[str], check_interval: float = 1.0) -> None:
+        self.template_ids = template_ids
+        self.check_interval = check_interval
+        self._compiled: Dict[str, CompiledTemplate] = {}
+        self._errors: Dict[str, str] = {}
+        # 加载失败时的文件 mtime，文件未再变化前不重复解析
+        self._failed_mtime: Dict[str, Optional[float]] = {}
+        self._checked_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.reloads = 0
+
+    def _load(self, template_id: str, mtime: Optional[float] = None) -> None:
+        try:
+            compiled = _compile(template_id)
+        except TemplateError as exc:
+            self._errors[template_id] = str(exc)
+            self._failed_mtime[template_id] = mtime
+            print(f"[ERROR] failed to load template {template_id}: {exc}")
+            return
+        if template_id in self._compiled:
+            self.reloads += 1
+            print(f"[INFO] reloaded template {template_id} from {compiled.path}")
+        self._compiled[template_id] = compiled
+        self._errors.pop(template_id, None)
+        self._failed_mtime.pop(template_id, None)
+
+    def load_all(self) -> None:
+        with self._lock:
+            for template_id in self.template_ids:
+                self._load(template_id)
+                self._checked_at[template_id] = time.monotonic()
+
+    def get(self, template_id: str) -> CompiledTemplate:
+        if template_id not in _TEMPLATE_MAP:
+            raise TemplateError(f"Unknown template_id: {template_id}")
+        now = time.monotonic()
+        if now - self._checked_at.get(template_id, float("-inf")) >= self.check_interval:
+            with self._lock:
+                self._checked_at[template_id] = now
+                compiled = self._compiled.get(template_id)
+                try:
+                    mtime = os.stat(_template_path(template_id)).st_mtime
+                except OSError:
+                    mtime = None
+                changed = compiled is None or mtime != compiled.mtime
+                if changed and (
+                    template_id not in self._failed_mtime
+                    or self._failed_mtime[template_id] != mtime
+                ):
+                    self._load(template_id, mtime)
+        compiled = self._compiled.get(template_id)
+        if compiled is None:
+            raise TemplateError(self._errors.get(template_id, f"Template {template_id} not loaded"))
+        return compiled
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "templates": {
+                template_id: {
+                    "path": compiled.path,
+                    "mtime": compiled.mtime,
+                    "loaded_at": compiled.loaded_at,
+                    "nodes": len(compiled.nodes),
+                    "sampler_nodes": list(compiled.slots.samplers),
+                }
+                for template_id, compiled in self._compiled.items()
+            },
+            "errors": dict(self._errors),
+            "reloads": self.reloads,
+        }
+
+
+template_registry = TemplateRegistry(
+    list(_TEMPLATE_MAP), float(os.getenv("TEMPLATE_RELOAD_INTERVAL", "1.0"))
+)
+
+
+class _Patcher:
+    """在基础节点图的浅拷贝上改写输入，只有被改写的节点才复制。"""
+
+    def __init__(self, nodes: Mapping[str, Mapping[str, Any]]) -> None:
+        self.nodes = nodes
+        self.prompt: Dict[str, Any] = dict(nodes)
+        self._copied: Dict[str, Dict[str, Any]] = {}
+
+    def inputs(self, node_id: str) -> Dict[str, Any]:
+        inputs = self._copied.get(node_id)
+        if inputs is None:
+            base = self.nodes[node_id]
+            inputs = dict(base["inputs"])
+            self.prompt[node_id] = {**base, "inputs": inputs}
+            self._copied[node_id] = inputs
+        return inputs
+
+
 def build_prompt(
     template_id: str,
     prompt_text: str,
@@ -88,77 +257,48 @@ def build_prompt(
     enable_upscale: bool = False,
     upscale_model_name: Optional[str] = None,
 ) -> Dict[str, Any]:
-    raw_template = _load_template(template_id)
-    prompt = _extract_prompt(raw_template)
-    prompt = deepcopy(prompt)
+    compiled = template_registry.get(template_id)
+    slots = compiled.slots
 
-    if template_id == "qwen_2512":
-        node_91 = prompt.get("91")
-        if not isinstance(node_91, dict) or "inputs" not in node_91:
-            raise TemplateError("missing node 91")
-        inputs_91 = node_91.get("inputs")
-        if not isinstance(inputs_91, dict):
-            raise TemplateError("missing node 91")
-        inputs_91["value"] = prompt_text
-
-        node_86_3 = prompt.get("86:3")
-        if not isinstance(node_86_3, dict) or "inputs" not in node_86_3:
-            raise TemplateError("missing node 86:3")
-        inputs_86_3 = node_86_3.get("inputs")
-        if not isinstance(inputs_86_3, dict):
-            raise TemplateError("missing node 86:3")
-        inputs_86_3["seed"] = seed
-
-        node_86_58 = prompt.get("86:58")
-        if not isinstance(node_86_58, dict) or "inputs" not in node_86_58:
-            raise TemplateError("missing node 86:58")
-        size_inputs = node_86_58.get("inputs")
-        if not isinstance(size_inputs, dict):
-            raise TemplateError("missing node 86:58")
-        size_inputs["width"] = width
-        size_inputs["height"] = height
-    else:
-        _ensure_inputs(prompt, "45")["text"] = prompt_text
-        _ensure_inputs(prompt, "44")["seed"] = seed
-        size_inputs = _ensure_inputs(prompt, "41")
-        size_inputs["width"] = width
-        size_inputs["height"] = height
-        size_inputs["batch_size"] = batch_size
-
-    if template_id != "lora_upscale" and (enable_lora or enable_upscale or lora_name or upscale_model_name):
+    if not slots.lora_upscale and (enable_lora or enable_upscale or lora_name or upscale_model_name):
         raise TemplateError("LoRA/upscale options are only valid for lora_upscale template")
-
-    if template_id == "lora_upscale":
-        if enable_lora:
-            if not lora_name:
-                raise TemplateError("enable_lora is true but lora_name is empty")
-            _ensure_inputs(prompt, "48")["lora_name"] = lora_name
-        else:
-            _ensure_inputs(prompt, "47")["model"] = ["46", 0]
-            _ensure_inputs(prompt, "45")["clip"] = ["39", 0]
-
+    if slots.lora_upscale:
+        if enable_lora and not lora_name:
+            raise TemplateError("enable_lora is true but lora_name is empty")
         if enable_upscale:
             if not upscale_model_name:
                 raise TemplateError("enable_upscale is true but upscale_model_name is empty")
             if upscale_model_name not in _ALLOWED_UPSCALE_MODELS:
                 raise TemplateError(f"upscale_model_name not allowed: {upscale_model_name}")
-            _ensure_inputs(prompt, "49")["model_name"] = upscale_model_name
-            _ensure_inputs(prompt, "9")["images"] = ["50", 0]
+
+    patcher = _Patcher(compiled.nodes)
+    patcher.inputs(slots.text[0])[slots.text[1]] = prompt_text
+    patcher.inputs(slots.seed[0])[slots.seed[1]] = seed
+    size_inputs = patcher.inputs(slots.size)
+    size_inputs["width"] = width
+    size_inputs["height"] = height
+    if slots.batch_size:
+        size_inputs["batch_size"] = batch_size
+
+    if slots.lora_upscale:
+        if enable_lora:
+            patcher.inputs("48")["lora_name"] = lora_name
         else:
-            _ensure_inputs(prompt, "9")["images"] = ["43", 0]
-
-    sampler_ids = []
-    for node_id, node in prompt.items():
-        class_type = node.get("class_type")
-        if isinstance(class_type, str) and class_type.startswith("KSampler"):
-            inputs = node.get("inputs")
-            if isinstance(inputs, dict):
-                inputs["cfg"] = cfg
-                sampler_ids.append(node_id)
-
-    if sampler_ids:
-        print(f"[INFO] CFG_APPLIED={cfg} sampler_nodes={sampler_ids}")
+            patcher.inputs("47")["model"] = ["46", 0]
+            patcher.inputs("45")["clip"] = ["39", 0]
+
+        if enable_upscale:
+            patcher.inputs("49")["model_name"] = upscale_model_name
+            patcher.inputs("9")["images"] = ["50", 0]
+        else:
+            patcher.inputs("9")["images"] = ["43", 0]
+
+    for node_id in slots.samplers:
+        patcher.inputs(node_id)["cfg"] = cfg
+
+    if slots.samplers:
+        print(f"[INFO] CFG_APPLIED={cfg} sampler_nodes={list(slots.samplers)}")
     else:
         print("[WARN] CFG not applied: sampler node not found")
 
-    return prompt
+    return patcher.prompt
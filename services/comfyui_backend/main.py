@@ -1,9 +1,28 @@
 from __future__ import annotations
 
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 
 from app.routers.comfyui import router as comfyui_router
+from app.services.http_pool import comfyui_pool
+from app.services.progress import progress_listener
+from app.services.task_store import task_store
+from app.services.workflow_builder import template_registry
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    template_registry.load_all()
+    await comfyui_pool.start()
+    progress_listener.start()
+    try:
+        yield
+    finally:
+        await progress_listener.stop()
+        await comfyui_pool.close()
+        await task_store.close()
 
 
-app = FastAPI(title="ComfyUI Backend", version="1.0.0")
+app = FastAPI(title="ComfyUI Backend", version="1.0.0", lifespan=lifespan)
 app.include_router(comfyui_router, prefix="/api", tags=["comfyui"])
@@ -1,13 +1,37 @@
+import os
+from contextlib import asynccontextmanager
 from typing import Any, Dict, Optional
 
 import httpx
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 
+from upstream import UpstreamPool
+
 VECTOR_BASE = "http://192.168.1.28:9001"
 TIMEOUT = 60
 
-app = FastAPI(title="Vector Backend API", version="0.1.0")
+vector_pool = UpstreamPool(
+    "vector",
+    max_connections=int(os.getenv("VECTOR_POOL_MAX_CONNECTIONS", "50")),
+    max_keepalive_connections=int(os.getenv("VECTOR_POOL_MAX_KEEPALIVE", "10")),
+    keepalive_expiry=float(os.getenv("VECTOR_POOL_KEEPALIVE_EXPIRY", "30")),
+    http2=os.getenv("VECTOR_HTTP2", "0").lower() in {"1", "true", "yes"},
+    timeout=httpx.Timeout(TIMEOUT),
+    verify=False,
+)
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    await vector_pool.start()
+    try:
+        yield
+    finally:
+        await vector_pool.close()
+
+
+app = FastAPI(title="Vector Backend API", version="0.1.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -34,8 +58,7 @@ async def _forward_request(
 ) -> Any:
     url = f"{VECTOR_BASE}{path}"
     try:
-        async with httpx.AsyncClient(timeout=TIMEOUT, verify=False) as client:
-            response = await client.request(method, url, params=params, json=json_body)
+        response = await vector_pool.client.request(method, url, params=params, json=json_body)
     except httpx.RequestError as exc:
         raise HTTPException(status_code=502, detail=f"Vector service unavailable: {exc}") from exc
 
@@ -81,3 +104,8 @@ async def vector_delete_item(item_id: str) -> Any:
 @app.delete("/api/vector/clear")
 async def vector_clear() -> Any:
     return await _forward_request("DELETE", "/v1/clear")
+
+
+@app.get("/api/vector/admin/pool")
+async def vector_pool_stats() -> Any:
+    return vector_pool.snapshot()